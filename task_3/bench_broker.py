@@ -0,0 +1,1097 @@
+#!/usr/bin/env python3
+# bench_broker.py - Benchmarks for HomeworkBroker
+# Usage: python bench_broker.py [scenario ...] [-n MESSAGES]
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from broker_auth import TopicCredential
+from broker_client import BrokerClient
+from broker_compress import DEFAULT_DICTIONARY, Compressor, available_codecs
+from broker_dedup import DEDUP_WINDOW, DedupIndex
+from broker_timers import TimingWheel
+from homework_broker import (
+    DEFAULT_SEND_QUEUE_SIZE,
+    HomeworkBroker,
+    _FRAMED_PROTOCOLS,
+    _NLJSONProtocol,
+    _message_size,
+    open_framed_connection,
+    read_frame,
+)
+
+HOST = "127.0.0.1"
+
+
+class BenchConn:
+    """Client connection in any wire mode that counts bytes on the wire."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, protocol: Any) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.framed = protocol is not _NLJSONProtocol
+        self.sent = 0
+        self.received = 0
+
+    @classmethod
+    async def open(cls, port: int, mode: str) -> "BenchConn":
+        if mode == "nljson":
+            reader, writer = await asyncio.open_connection(HOST, port)
+            return cls(reader, writer, _NLJSONProtocol)
+        reader, writer, protocol = await open_framed_connection(HOST, port, codec=mode.split("-", 1)[1])
+        return cls(reader, writer, protocol)
+
+    def send(self, obj: Dict[str, Any]) -> None:
+        data = self.protocol.encode(obj)
+        self.sent += len(data)
+        self.writer.write(data)
+
+    async def recv(self) -> Dict[str, Any]:
+        if self.framed:
+            body = await read_frame(self.reader)
+            self.received += len(body) + 4
+            return self.protocol.decode(body)
+        line = await self.reader.readline()
+        self.received += len(line)
+        return self.protocol.decode(line)
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class NullWriter:
+    """In-process stand-in for a subscriber socket that only counts bytes."""
+
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.writes = 0
+
+    def write(self, data: bytes) -> None:
+        self.bytes += len(data)
+        self.writes += 1
+
+    def writelines(self, chunks: List[bytes]) -> None:
+        for data in chunks:
+            self.write(data)
+
+    async def drain(self) -> None:
+        pass
+
+    def get_extra_info(self, name: str) -> None:
+        return None
+
+    def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class StalledWriter(NullWriter):
+    """A subscriber socket that stops emptying its buffer on stall(): drain() then waits until resume()."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+
+    def stall(self) -> None:
+        self.flowing.clear()
+
+    def resume(self) -> None:
+        self.flowing.set()
+
+    async def drain(self) -> None:
+        await self.flowing.wait()
+
+
+class DeliveryWriter(NullWriter):
+    """In-process consumer socket that keeps the ids of the deliveries written to it."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.ids: List[int] = []
+
+    def write(self, data: bytes) -> None:
+        super().write(data)
+        for line in data.splitlines():
+            msg = _NLJSONProtocol.decode(line)
+            if msg.get("type") == "delivery":
+                self.ids.append(msg["id"])
+
+
+def available_modes() -> List[str]:
+    return ["nljson"] + [f"framed-{codec}" for codec in _FRAMED_PROTOCOLS]
+
+
+def sample_message(size: int) -> Dict[str, Any]:
+    return {"id": 1, "kind": "order", "tags": ["a", "b"], "body": "x" * size}
+
+
+def report(title: str, rows: List[Dict[str, Any]]) -> None:
+    print(f"\n== {title}")
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    print("  ".join(f"{k:>14}" for k in keys))
+    for row in rows:
+        cells = [f"{v:>14.1f}" if isinstance(v, float) else f"{v!s:>14}" for v in row.values()]
+        print("  ".join(cells))
+
+
+# ---------------- Scenarios ----------------
+
+def bench_codec(n: int, size: int = 64) -> List[Dict[str, Any]]:
+    """Encode+decode cost of one publish request in each wire mode."""
+    msg = {"action": "publish", "topic": "bench", "message": sample_message(size), "priority": "normal"}
+    rows = []
+    for mode in available_modes():
+        protocol = _NLJSONProtocol if mode == "nljson" else _FRAMED_PROTOCOLS[mode.split("-", 1)[1]]
+        strip = (lambda b: b) if mode == "nljson" else (lambda b: b[4:])
+        start = time.perf_counter()
+        for _ in range(n):
+            protocol.decode(strip(protocol.encode(msg)))
+        elapsed = time.perf_counter() - start
+        rows.append({"mode": mode, "msgs_per_sec": n / elapsed, "bytes_per_msg": len(protocol.encode(msg))})
+    return rows
+
+
+async def bench_wire(n: int, size: int = 64) -> List[Dict[str, Any]]:
+    """Publisher -> broker -> subscriber over loopback, one connection pair per mode."""
+    rows = []
+    for mode in available_modes():
+        broker = HomeworkBroker(send_queue_size=n + 1)
+        server = await asyncio.start_server(broker.handle_client, HOST, 0)
+        port = server.sockets[0].getsockname()[1]
+        sub = await BenchConn.open(port, mode)
+        pub = await BenchConn.open(port, mode)
+        sub.send({"action": "subscribe", "topic": "bench"})
+        await sub.recv()
+
+        payload = sample_message(size)
+        start = time.perf_counter()
+
+        async def consume() -> None:
+            for _ in range(n):
+                await sub.recv()
+
+        async def acks() -> None:
+            for _ in range(n):
+                await pub.recv()
+
+        consumer = asyncio.create_task(consume())
+        acker = asyncio.create_task(acks())
+        for i in range(n):
+            pub.send({"action": "publish", "topic": "bench", "message": payload})
+            if i % 256 == 0:
+                await pub.writer.drain()
+        await pub.writer.drain()
+        await asyncio.gather(consumer, acker)
+        elapsed = time.perf_counter() - start
+
+        wire = pub.sent + pub.received + sub.received
+        rows.append({"mode": mode, "msgs_per_sec": n / elapsed, "wire_bytes_per_msg": wire / n})
+        await pub.close()
+        await sub.close()
+        await asyncio.sleep(0.05)  # let the server notice the disconnects
+        server.close()
+        await server.wait_closed()
+        await broker.close()
+    return rows
+
+
+async def bench_fanout(n: int, subscribers: int = 10000, size: int = 64) -> List[Dict[str, Any]]:
+    """publish() cost with a hot topic of many in-process subscribers (no sockets)."""
+    messages = max(1, n // 100)
+    broker = HomeworkBroker(send_queue_size=messages + 1)
+    writers = [NullWriter() for _ in range(subscribers)]
+    for w in writers:
+        await broker.subscribe("fan", w)
+    publisher = NullWriter()
+    payload = sample_message(size)
+    start = time.perf_counter()
+    for _ in range(messages):
+        await broker.publish("fan", payload, writer=publisher)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0)  # let outbox tasks flush
+    await broker.close()
+    return [{
+        "subscribers": subscribers,
+        "messages": messages,
+        "publish_ms": elapsed / messages * 1000,
+        "deliveries_per_sec": messages * subscribers / elapsed,
+    }]
+
+
+async def bench_slow(n: int, subscribers: int = 100, size: int = 64) -> List[Dict[str, Any]]:
+    """publish() latency on a topic with and without one subscriber that has stopped reading."""
+    messages = max(1, n // 10)
+    payload = sample_message(size)
+    rows = []
+    for stalled in (0, 1):
+        broker = HomeworkBroker(send_queue_size=1000)
+        writers = [NullWriter() for _ in range(subscribers - stalled)] + [StalledWriter() for _ in range(stalled)]
+        for w in writers:
+            await broker.subscribe("slow", w)
+            if isinstance(w, StalledWriter):
+                w.stall()
+        publisher = NullWriter()
+        latencies = []
+        for i in range(messages):
+            start = time.perf_counter()
+            await broker.publish("slow", payload, writer=publisher)
+            latencies.append(time.perf_counter() - start)
+            if i % 100 == 99:
+                await asyncio.sleep(0)  # outbox tasks write to the sockets that can take it
+        await asyncio.sleep(0)
+        state = broker.topics["slow"]
+        rows.append({
+            "stalled": stalled,
+            "subscribers": subscribers,
+            "publish_p50_us": _percentile(latencies, 0.5) * 1e6,
+            "publish_p99_us": _percentile(latencies, 0.99) * 1e6,
+            "fast_received": writers[0].writes,
+            "dropped": sum(state.dropped.values()),
+        })
+        for w in writers:
+            if isinstance(w, StalledWriter):
+                w.resume()
+            await broker._cleanup_writer(w)
+        await broker.close()
+    return rows
+
+
+async def bench_filter(n: int, subscribers: int = 1000, shards: int = 10, size: int = 64) -> List[Dict[str, Any]]:
+    """Fan-out with content filters: every subscriber wants 1 shard of ``shards``, matched server-side or not."""
+    messages = max(1, n // 10)
+    rows = []
+    variants = {
+        "none": lambda k, j: None,
+        "shared": lambda k, j: {"shard": k},
+        "unique": lambda k, j: {"shard": k, "sub": {"$ne": j}},
+    }
+    for variant, make_filter in variants.items():
+        broker = HomeworkBroker(send_queue_size=messages + 1)
+        writers = [NullWriter() for _ in range(subscribers)]
+        for j, w in enumerate(writers):
+            await broker.subscribe("fan", w, filter_spec=make_filter(j % shards, j))
+        publisher = NullWriter()
+        payloads = [dict(sample_message(size), shard=k) for k in range(shards)]
+        start = time.perf_counter()
+        for i in range(messages):
+            await broker.publish("fan", payloads[i % shards], writer=publisher)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0)  # let outbox tasks flush
+        rows.append({
+            "filters": variant,
+            "groups": len(broker.topics["fan"].fanout),
+            "publish_us": elapsed / messages * 1e6,
+            "sent_kb_per_msg": sum(w.bytes for w in writers) / messages / 1024,
+        })
+        for outbox in broker._outboxes.values():
+            outbox.close()
+        await broker.close()
+    return rows
+
+
+async def bench_replay(n: int, size: int = 64) -> List[Dict[str, Any]]:
+    """Catch-up of a subscriber replaying ``n`` retained messages, and publisher latency while it runs."""
+    broker = HomeworkBroker(retain=n, send_queue_size=DEFAULT_SEND_QUEUE_SIZE)
+    server = await asyncio.start_server(broker.handle_client, HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+    payload = sample_message(size)
+    for _ in range(n):
+        await broker.publish("replay", payload, writer=NullWriter())
+    pub = await BenchConn.open(port, "nljson")
+    request = {"action": "publish", "topic": "replay", "message": payload}
+
+    async def publish_for(count: int) -> List[float]:
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            pub.send(request)
+            await pub.recv()
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    rows = [{"phase": "idle", "replayed_per_sec": "-", "publish_p50_ms": 0.0, "publish_p99_ms": 0.0}]
+    idle = await publish_for(1000)
+    rows[0].update(publish_p50_ms=_percentile(idle, 0.5), publish_p99_ms=_percentile(idle, 0.99))
+
+    sub = await BenchConn.open(port, "nljson")
+    start = time.perf_counter()
+    sub.send({"action": "subscribe", "topic": "replay", "from_offset": 0})
+
+    async def catch_up() -> float:
+        # count lines instead of decoding them: the client shares the loop with the broker
+        lines = 0
+        while lines < n + 1:  # the subscribe response, then n messages
+            data = await sub.reader.read(1 << 16)
+            lines += data.count(b"\n")
+        return time.perf_counter() - start
+
+    replay_task = asyncio.create_task(catch_up())
+    busy = []
+    while not replay_task.done():
+        busy += await publish_for(50)
+    elapsed = await replay_task
+    rows.append({
+        "phase": "replaying",
+        "replayed_per_sec": n / elapsed,
+        "publish_p50_ms": _percentile(busy, 0.5),
+        "publish_p99_ms": _percentile(busy, 0.99),
+    })
+    await sub.close()
+    await pub.close()
+    await asyncio.sleep(0.05)
+    server.close()
+    await server.wait_closed()
+    await broker.close()
+    return rows
+
+
+async def bench_batch(n: int, size: int = 16, batch_size: int = 100) -> List[Dict[str, Any]]:
+    """Small-message publish throughput: one ack per round trip vs pipelined vs publish_batch."""
+    rows = []
+    payload = "x" * size
+    for mode in available_modes():
+        broker = HomeworkBroker()
+        server = await asyncio.start_server(broker.handle_client, HOST, 0)
+        port = server.sockets[0].getsockname()[1]
+        pub = await BenchConn.open(port, mode)
+        request = {"action": "publish", "topic": "bench", "message": payload}
+
+        # 1. request/response: wait for every ack before the next publish
+        start = time.perf_counter()
+        for _ in range(n):
+            pub.send(request)
+            await pub.recv()
+        sequential = n / (time.perf_counter() - start)
+
+        # 2. pipelined: write everything, then read the acks
+        start = time.perf_counter()
+        for i in range(n):
+            pub.send(request)
+            if i % 1024 == 0:
+                await pub.writer.drain()
+        for _ in range(n):
+            await pub.recv()
+        pipelined = n / (time.perf_counter() - start)
+
+        # 3. publish_batch: batch_size messages per request, one ack each
+        batches = max(1, n // batch_size)
+        batch = {"action": "publish_batch", "topic": "bench", "messages": [{"message": payload}] * batch_size}
+        start = time.perf_counter()
+        for i in range(batches):
+            pub.send(batch)
+            if i % 16 == 0:
+                await pub.writer.drain()
+        for _ in range(batches):
+            await pub.recv()
+        batched = batches * batch_size / (time.perf_counter() - start)
+
+        rows.append({
+            "mode": mode,
+            "sequential": sequential,
+            "pipelined": pipelined,
+            "batch": batched,
+            "speedup": batched / sequential,
+        })
+        await pub.close()
+        await asyncio.sleep(0.05)
+        server.close()
+        await server.wait_closed()
+        await broker.close()
+    return rows
+
+
+async def bench_wal(n: int, size: int = 64, publishers: int = 64) -> List[Dict[str, Any]]:
+    """Durable publish throughput per fsync policy (concurrent publishers), then recovery time."""
+    rows = []
+    payload = sample_message(size)
+    for policy in ("always", "interval", "never"):
+        with tempfile.TemporaryDirectory() as data_dir:
+            broker = HomeworkBroker(data_dir=data_dir, fsync=policy)
+            await broker.configure_topic("bench", NullWriter(), durable=True)
+            per_task = max(1, n // publishers)
+
+            async def produce() -> None:
+                w = NullWriter()
+                for _ in range(per_task):
+                    await broker.publish("bench", payload, writer=w)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(produce() for _ in range(publishers)))
+            elapsed = time.perf_counter() - start
+            await broker.close()
+
+            start = time.perf_counter()
+            restarted = HomeworkBroker(data_dir=data_dir, fsync=policy)
+            recovery = time.perf_counter() - start
+            recovered = len(restarted.topics["bench"].queue)
+            await restarted.close()
+        rows.append({
+            "fsync": policy,
+            "msgs_per_sec": per_task * publishers / elapsed,
+            "recovered": recovered,
+            "recovery_ms": recovery * 1000,
+        })
+    return rows
+
+
+async def bench_metrics(n: int, subscribers: int = 10, size: int = 64) -> List[Dict[str, Any]]:
+    """
+    Instrumentation overhead: the same publish workload with metrics off and on.
+
+    One broker is used per transport and its metrics are switched on and off
+    between small interleaved blocks, so heap state and CPU frequency drift hit
+    both variants alike; the per-request time is the median over the blocks.
+    """
+    raw = _NLJSONProtocol.encode({"action": "publish", "topic": "m", "message": sample_message(size)})
+    blocks = max(2, n // 200)
+
+    async def measure(broker: HomeworkBroker, run_block: Callable[[int], Any], block: int) -> Dict[bool, float]:
+        metrics = broker.metrics
+        samples: Dict[bool, List[float]] = {False: [], True: []}
+        for i in range(blocks):
+            for on in ((False, True) if i % 2 else (True, False)):
+                broker.metrics = metrics if on else None
+                start = time.perf_counter()
+                await run_block(block)
+                samples[on].append((time.perf_counter() - start) / block)
+        broker.metrics = metrics
+        return {on: _percentile(values, 0.5) for on, values in samples.items()}
+
+    # 1. in-process: process_message() with NullWriter subscribers, no sockets
+    broker = HomeworkBroker()
+    for _ in range(subscribers):
+        await broker.subscribe("m", NullWriter())
+    publisher = NullWriter()
+
+    async def inproc_block(block: int) -> None:
+        for _ in range(block):
+            await broker.process_message(raw, publisher)
+        await asyncio.sleep(0)  # let outbox tasks flush
+
+    inproc = await measure(broker, inproc_block, 200)
+    for outbox in broker._outboxes.values():
+        outbox.close()
+    await broker.close()
+
+    # 2. over TCP: pipelined publishes on one connection, one subscriber connection
+    broker = HomeworkBroker()
+    server = await asyncio.start_server(broker.handle_client, HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+    sub = await BenchConn.open(port, "nljson")
+    sub.send({"action": "subscribe", "topic": "m"})
+    await sub.recv()
+    pub = await BenchConn.open(port, "nljson")
+
+    async def drain_sub() -> None:
+        while await sub.reader.readline():
+            pass
+
+    draining = asyncio.create_task(drain_sub())
+
+    async def tcp_block(block: int) -> None:
+        pub.writer.write(raw * block)
+        for _ in range(block):
+            await pub.recv()
+
+    tcp = await measure(broker, tcp_block, 500)
+    draining.cancel()
+    await pub.close()
+    await sub.close()
+    await asyncio.sleep(0.05)
+    server.close()
+    await server.wait_closed()
+    await broker.close()
+
+    rows = []
+    for on in (False, True):
+        rows.append({
+            "metrics": "on" if on else "off",
+            "inproc_us": inproc[on] * 1e6,
+            "inproc_cost_%": (inproc[on] / inproc[False] - 1) * 100,
+            "tcp_us": tcp[on] * 1e6,
+            "tcp_cost_%": (tcp[on] / tcp[False] - 1) * 100,
+        })
+    return rows
+
+
+async def bench_client(n: int, size: int = 16, concurrency: int = 256) -> List[Dict[str, Any]]:
+    """BrokerClient publish throughput: awaited one by one, concurrent (pipelined), concurrent + batched."""
+    payload = "x" * size
+    broker = HomeworkBroker()
+    server = await asyncio.start_server(broker.handle_client, HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+    rows = []
+    for label, batch_size, parallel in (("sequential", 1, 1), ("pipelined", 1, concurrency), ("batched", 100, concurrency)):
+        async with BrokerClient(HOST, port, batch_size=batch_size) as client:
+            count = n if parallel > 1 else max(1, n // 10)
+
+            async def worker(k: int) -> None:
+                for _ in range(k):
+                    await client.publish("bench", payload)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(count // parallel) for _ in range(parallel)))
+            elapsed = time.perf_counter() - start
+            sent = count // parallel * parallel
+        rows.append({"mode": label, "messages": sent, "msgs_per_sec": sent / elapsed, "us_per_msg": elapsed / sent * 1e6})
+    await asyncio.sleep(0.05)
+    server.close()
+    await server.wait_closed()
+    await broker.close()
+    return rows
+
+
+async def bench_dispatch(n: int) -> List[Dict[str, Any]]:
+    """Per-request cost of handle_request (dispatch, validation, handler, response) on decoded requests."""
+    requests = {
+        "publish": {"action": "publish", "topic": "d", "message": "x", "priority": "high", "ttl": 60},
+        "publish_bad": {"action": "publish", "topic": "d", "message": "x", "priority": "urgent"},
+        "queue_length": {"action": "queue_length", "topic": "d"},
+        "ack_missing": {"action": "ack", "topic": "d", "id": 1},
+        "unsubscribe": {"action": "unsubscribe", "topic": "d"},
+        "unknown": {"action": "no_such_action"},
+    }
+    rows = []
+    for name, request in requests.items():
+        broker = HomeworkBroker(metrics=False)
+        writer = NullWriter()
+        await broker.handle_request(request, writer)  # warm up, creates the topic
+        best = float("inf")
+        for _ in range(7):
+            start = time.perf_counter()
+            for _ in range(n):
+                await broker.handle_request(request, writer)
+            best = min(best, (time.perf_counter() - start) / n)
+        if name == "publish":
+            broker.topics["d"].queue.clear()
+        await broker.close()
+        rows.append({"request": name, "us_per_request": best * 1e6, "per_sec": 1 / best})
+    return rows
+
+
+async def bench_queue(n: int) -> List[Dict[str, Any]]:
+    """Memory per queued message and publish() CPU with no subscribers (queue and retained log only)."""
+    payload = sample_message(64)  # shared, so only the broker's own bookkeeping is counted
+    publisher = NullWriter()
+    rows = []
+    for ttl in (None, 60):
+        for retain in (0, 1000):
+            broker = HomeworkBroker(retain=retain, metrics=False)
+            await broker.publish("q", payload, ttl=ttl, writer=publisher)  # creates the topic
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(n):
+                await broker.publish("q", payload, ttl=ttl, writer=publisher)
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            broker.topics["q"].queue.clear()
+            best = float("inf")
+            for _ in range(5):
+                start = time.process_time()
+                for _ in range(n):
+                    await broker.publish("q", payload, ttl=ttl, writer=publisher)
+                best = min(best, (time.process_time() - start) / n)
+                broker.topics["q"].queue.clear()
+            await broker.close()
+            rows.append({
+                "ttl": ttl or "-",
+                "retain": retain,
+                "bytes_per_msg": used / n,
+                "publish_us": best * 1e6,
+            })
+    return rows
+
+
+async def bench_consume(n: int, consumers: int = 4, size: int = 64) -> List[Dict[str, Any]]:
+    """Work-queue throughput: in-process consumers ack every delivery, per prefetch window."""
+    messages = max(1, n // 4)
+    payload = sample_message(size)
+    rows = []
+    for prefetch in (1, 10, 100):
+        broker = HomeworkBroker()
+        publisher = NullWriter()
+        for _ in range(messages):
+            await broker.publish("work", payload, writer=publisher)
+        writers = [DeliveryWriter() for _ in range(consumers)]
+        received = [0] * consumers
+        start = time.perf_counter()
+        for w in writers:
+            await broker.handle_request({"action": "consume", "topic": "work", "prefetch": prefetch}, w)
+        acked = 0
+        while acked < messages:
+            await asyncio.sleep(0)  # outbox tasks write the deliveries
+            for k, w in enumerate(writers):
+                ids, w.ids = w.ids, []
+                received[k] += len(ids)
+                for delivery_id in ids:
+                    await broker.handle_request({"action": "ack", "topic": "work", "id": delivery_id}, w)
+                acked += len(ids)
+        elapsed = time.perf_counter() - start
+        for w in writers:
+            await broker._cleanup_writer(w)
+        await broker.close()
+        rows.append({
+            "prefetch": prefetch,
+            "consumers": consumers,
+            "msgs_per_sec": messages / elapsed,
+            "min_share_pct": min(received) / messages * 100,
+            "max_share_pct": max(received) / messages * 100,
+        })
+    return rows
+
+
+async def bench_topics(n: int, publishers: int = 64, size: int = 16) -> List[Dict[str, Any]]:
+    """
+    Concurrent publishers spread over more and more topics, each with a subscriber.
+
+    Reports publish throughput, how many lock acquisitions had to wait, and the
+    cost of disconnecting a client subscribed to one topic. That cost only
+    depends on the client's own topics.
+    """
+    payload = sample_message(size)
+    rows = []
+    for topics in (1, 16, 256, 4096):
+        broker = HomeworkBroker(send_queue_size=n + 1)
+        names = [f"t{i}" for i in range(topics)]
+        subscriber = NullWriter()
+        for name in names:
+            await broker.subscribe(name, subscriber)
+        per_publisher = max(1, n // publishers)
+
+        async def publish_some(k: int) -> None:
+            writer = NullWriter()
+            for i in range(per_publisher):
+                await broker.publish(names[(k + i * publishers) % topics], payload, writer=writer)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(publish_some(k) for k in range(publishers)))
+        elapsed = time.perf_counter() - start
+        lock_waits = broker.metrics.histograms["lock_wait"].count
+        leaver = NullWriter()
+        await broker.subscribe(names[-1], leaver)
+        start = time.perf_counter()
+        await broker._cleanup_writer(leaver)
+        cleanup_us = (time.perf_counter() - start) * 1e6
+        await broker._cleanup_writer(subscriber)
+        await broker.close()
+        rows.append({
+            "topics": topics,
+            "publishers": publishers,
+            "msgs_per_sec": per_publisher * publishers / elapsed,
+            "lock_waits": lock_waits,
+            "disconnect_us": cleanup_us,
+        })
+    return rows
+
+
+async def bench_spill(n: int, size: int = 1024) -> List[Dict[str, Any]]:
+    """Publish a backlog nobody consumes, without and with a memory quota spilling to disk, then drain it."""
+    payload = "x" * size
+    publisher = NullWriter()
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, kwargs in (
+            ("no quota", {}),
+            ("1 MiB quota, spill", {"topic_memory_limit": 1 << 20, "spill_dir": tmp}),
+        ):
+            broker = HomeworkBroker(metrics=False, **kwargs)
+            start = time.perf_counter()
+            for _ in range(n):
+                await broker.publish("s", payload, writer=publisher)
+            published = time.perf_counter() - start
+            queue = broker.topics["s"].queue
+            row = {
+                "mode": label,
+                "publish_us": published / n * 1e6,
+                # estimated the way quotas count it
+                "queued_mb": (queue.bytes if queue.limit else n * _message_size(payload)) / 2**20,
+                "spilled": queue.spilled,
+            }
+            start = time.perf_counter()
+            while queue.pop() is not None:
+                pass
+            row["drain_us"] = (time.perf_counter() - start) / n * 1e6
+            await broker.close()
+            rows.append(row)
+    return rows
+
+
+async def bench_auth(n: int) -> List[Dict[str, Any]]:
+    """Per-publish cost of the topic access check: public topic, password in every request, auth session."""
+    cases = (
+        ("public topic", None, {}),
+        ("password per request", "pw", {"password": "pw"}),
+        ("auth once, no password", "pw", {}),
+    )
+    rows = []
+    for label, password, extra in cases:
+        broker = HomeworkBroker(metrics=False)
+        writer = NullWriter()
+        await broker.publish("a", "x", password=password, writer=writer)  # creates the topic, first check
+        request = {"action": "publish", "topic": "a", "message": "x", **extra}
+        best = float("inf")
+        for _ in range(7):
+            start = time.perf_counter()
+            for _ in range(n):
+                await broker.handle_request(request, writer)
+            best = min(best, (time.perf_counter() - start) / n)
+            broker.topics["a"].queue.clear()
+        await broker.close()
+        rows.append({"mode": label, "us_per_publish": best * 1e6})
+    # what a grant saves: one PBKDF2 run per connection and topic
+    credential = TopicCredential.create("pw")
+    start = time.perf_counter()
+    for _ in range(20):
+        credential.verify("pw")
+    rows.append({"mode": "first check (PBKDF2)", "us_per_publish": (time.perf_counter() - start) / 20 * 1e6})
+    return rows
+
+
+async def bench_dedup(n: int) -> List[Dict[str, Any]]:
+    """Per-publish cost of idempotency keys (fresh and retried) and the memory each dedup window keeps."""
+    # 1000 (producer, topic) windows, each with a full window of sequence numbers behind it
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = DedupIndex()
+    for producer in range(1000):
+        index.add((f"producer-{producer}", "a"), DEDUP_WINDOW - 1)
+        index.add((f"producer-{producer}", "a"), 0)
+    per_window = (tracemalloc.get_traced_memory()[0] - before) / len(index)
+    tracemalloc.stop()
+    rows = []
+    for label, idempotent, retry in (("plain", False, False), ("producer+seq", True, False), ("retry (duplicate)", True, True)):
+        broker = HomeworkBroker(metrics=False)
+        writer = NullWriter()
+        best = float("inf")
+        for _ in range(7):
+            keys = [{"producer": "p", "seq": 0 if retry else i} if idempotent else {} for i in range(n)]
+            requests = [{"action": "publish", "topic": "a", "message": "x", **key} for key in keys]
+            broker._dedup = DedupIndex()
+            await broker.handle_request(requests[0], writer)
+            start = time.perf_counter()
+            for request in requests:
+                await broker.handle_request(request, writer)
+            best = min(best, (time.perf_counter() - start) / n)
+            broker.topics["a"].queue.clear()
+        await broker.close()
+        rows.append({"mode": label, "us_per_publish": best * 1e6, "bytes_per_window": per_window if idempotent else 0})
+    return rows
+
+
+async def bench_timers(n: int) -> List[Dict[str, Any]]:
+    """Cost of n pending delayed messages: the shared timer wheel vs one call_later handle each."""
+    loop = asyncio.get_running_loop()
+    base = time.monotonic()
+    deadlines = [base + 60 + (i * 7919 % 3600) for i in range(n)]
+    rows = []
+
+    def _cancel(kept: List[Any]) -> None:
+        for handle in kept:
+            if handle is not None:
+                handle.cancel()
+
+    def measure(label: str, make: Callable[[], Callable[[float], Any]]) -> None:
+        schedule = make()
+        start = time.perf_counter()
+        kept = [schedule(d) for d in deadlines]
+        elapsed = time.perf_counter() - start
+        _cancel(kept)
+        # memory in a separate run: tracing slows the calls down
+        schedule = make()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [schedule(d) for d in deadlines]
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        _cancel(kept)
+        rows.append({"mode": label, "us_per_timer": elapsed / n * 1e6, "bytes_per_timer": used / n})
+
+    measure("timer wheel", lambda: partial(TimingWheel().schedule, item=None))
+    measure("call_later each", lambda: lambda d: loop.call_later(d - base, int))
+    # the whole publish path, delayed vs immediate
+    for label, extra in (("publish", {}), ("publish with delay", {"delay": 3600})):
+        broker = HomeworkBroker(metrics=False)
+        writer = NullWriter()
+        request = {"action": "publish", "topic": "a", "message": "x", **extra}
+        await broker.handle_request(request, writer)
+        start = time.perf_counter()
+        for _ in range(n):
+            await broker.handle_request(request, writer)
+        rows.append({"mode": label, "us_per_timer": (time.perf_counter() - start) / n * 1e6, "bytes_per_timer": 0})
+        await broker.close()
+    return rows
+
+
+def _order(i: int) -> Dict[str, Any]:
+    """A JSON document of the repetitive kind compression is for (~1.5 KB)."""
+    return {
+        "order_id": f"ord-{i:08d}",
+        "customer": {"id": i % 977, "name": f"customer {i % 977}", "country": "NL", "tier": "gold"},
+        "status": "created",
+        "items": [
+            {"sku": f"sku-{(i + k) % 50:04d}", "title": "widget", "quantity": k + 1, "price": 9.99, "currency": "EUR"}
+            for k in range(8)
+        ],
+        "shipping": {"method": "standard", "address": {"street": "Main st", "city": "Amsterdam", "zip": "1011"}},
+    }
+
+
+async def bench_compression(n: int, subscribers: int = 100) -> List[Dict[str, Any]]:
+    """Frame bytes and CPU per message for each compression, and the fan-out cost of compressing once."""
+    messages = max(1, n // 100)
+    orders = [_order(i) for i in range(messages)]
+    bodies = [_FRAMED_PROTOCOLS["json"].encode({"type": "message", "topic": "orders", "payload": o})[4:] for o in orders]
+    # a dictionary of typical payloads, as given to run_server.py --compression-dict
+    trained = b"".join(_FRAMED_PROTOCOLS["json"].encode(_order(-k))[4:] for k in range(1, 4))
+    modes: List[Any] = [("none", None, b"")]
+    for name in available_codecs():
+        modes += [(name, name, b""), (f"{name}+envelope", name, DEFAULT_DICTIONARY), (f"{name}+trained", name, trained)]
+    rows = []
+    for label, name, dictionary in modes:
+        row: Dict[str, Any] = {"mode": label, "bytes_per_msg": sum(map(len, bodies)) / messages}
+        row.update(us_compress=0.0, us_decompress=0.0)
+        if name is not None:
+            compressor = Compressor(name, dictionary)
+            start = time.perf_counter()
+            packed = [compressor.compress(body) for body in bodies]
+            row["us_compress"] = (time.perf_counter() - start) / messages * 1e6
+            start = time.perf_counter()
+            for data in packed:
+                compressor.decompress(data)
+            row["us_decompress"] = (time.perf_counter() - start) / messages * 1e6
+            row["bytes_per_msg"] = sum(map(len, packed)) / messages + 1  # + the marker byte
+        # publish to subscribers that all negotiated this compression: compressed once per message
+        broker = HomeworkBroker(send_queue_size=messages + 1, metrics=False, compression_dictionary=dictionary)
+        writers = [NullWriter() for _ in range(subscribers)]
+        for w in writers:
+            broker._protocols[w] = _FRAMED_PROTOCOLS["json"]
+            if name is not None:
+                await broker.handle_request({"action": "compression", "codecs": [name]}, w)
+            await broker.subscribe("orders", w)
+            w.bytes = 0
+        publisher = NullWriter()
+        start = time.perf_counter()
+        for order in orders:
+            await broker.publish("orders", order, writer=publisher)
+        row["us_publish"] = (time.perf_counter() - start) / messages * 1e6
+        await asyncio.sleep(0)  # let outbox tasks flush
+        row["wire_bytes_per_delivery"] = sum(w.bytes for w in writers) / (messages * subscribers)
+        for w in writers:
+            await broker._cleanup_writer(w)  # stops the outbox tasks before the next broker
+        await broker.close()
+        rows.append(row)
+    return rows
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+async def _load(port: int, seconds: float, connections: int, batch_size: int, topics: int) -> int:
+    """Publish batches to many topics over several connections; returns acked messages."""
+    async def one(conn_index: int) -> int:
+        reader, writer = await asyncio.open_connection(HOST, port)
+        acked = 0
+        deadline = time.perf_counter() + seconds
+        i = 0
+        while time.perf_counter() < deadline:
+            batch = [{"topic": f"t{(i + k) % topics}", "message": "x" * 16} for k in range(batch_size)]
+            i += batch_size
+            for _ in range(8):  # keep a few batches in flight
+                writer.write(_NLJSONProtocol.encode({"action": "publish_batch", "messages": batch}))
+            await writer.drain()
+            for _ in range(8):
+                acked += _NLJSONProtocol.decode(await reader.readline()).get("published", 0)
+        writer.close()
+        return acked
+
+    return sum(await asyncio.gather(*(one(c) for c in range(connections))))
+
+
+def _load_process(port: int, seconds: float, connections: int, batch_size: int, topics: int, results: Any) -> None:
+    results.put(asyncio.run(_load(port, seconds, connections, batch_size, topics)))
+
+
+def bench_workers(n: int, seconds: float = 3.0, clients: int = 0) -> List[Dict[str, Any]]:
+    """Aggregate publish throughput of the SO_REUSEPORT multi-process broker per worker count."""
+    from broker_workers import start_workers
+
+    cpus = os.cpu_count() or 1
+    clients = clients or max(1, cpus)
+    counts = sorted({1, 2, min(4, max(2, cpus)), cpus})
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    for workers in counts:
+        port = _free_port()
+        procs = start_workers(workers, HOST, port)
+        time.sleep(1.0)  # workers start up
+        results = ctx.Queue()
+        loaders = [ctx.Process(target=_load_process, args=(port, seconds, 4, 100, 256, results)) for _ in range(clients)]
+        for proc in loaders:
+            proc.start()
+        total = sum(results.get() for _ in loaders)
+        for proc in loaders:
+            proc.join()
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+        rows.append({"workers": workers, "load_procs": clients, "cpus": cpus, "msgs_per_sec": total / seconds})
+    return rows
+
+
+def bench_wildcard(n: int, depth: int = 4) -> List[Dict[str, Any]]:
+    """Uncached pattern matching per published topic: trie walk vs checking every pattern."""
+    from broker_trie import TopicTrie, matches
+
+    rows = []
+    topic = ".".join(["svc7"] + [f"l{d}" for d in range(1, depth)])
+    for count in (10, 1000, 100000):
+        trie = TopicTrie()
+        patterns = [f"svc{i}.*.#" if i % 2 else f"svc{i}.l1.*" for i in range(count)]
+        for pattern in patterns:
+            trie.add(pattern, pattern)
+        rounds = max(1, n // 10)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            trie._cache.clear()
+            trie.match(topic)
+        trie_us = (time.perf_counter() - start) / rounds * 1e6
+        scan_rounds = max(1, min(rounds, 200000 // count))
+        start = time.perf_counter()
+        for _ in range(scan_rounds):
+            [p for p in patterns if matches(p, topic)]
+        scan_us = (time.perf_counter() - start) / scan_rounds * 1e6
+        rows.append({"patterns": count, "trie_us": trie_us, "scan_us": scan_us, "matched": len(trie.match(topic))})
+    return rows
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def bench_cluster(n: int, nodes: int = 3, size: int = 64) -> List[Dict[str, Any]]:
+    """Replicated cluster on localhost: publish latency/throughput per ack level and entry node, then failover time."""
+    from broker_cluster import ClusterBroker, ClusterNode
+
+    rows = []
+    request = {"action": "publish", "topic": "bench", "message": sample_message(size)}
+    for acks in ("leader", "quorum"):
+        members = [ClusterNode(HOST, _free_port(), _free_port()) for _ in range(nodes)]
+        brokers = [ClusterBroker(i, members, acks=acks) for i in range(nodes)]
+        for broker in brokers:
+            await broker.start()
+        await asyncio.sleep(0.3)
+        leader = brokers[0].owner("bench")
+        entries = {"leader": leader, "proxy": (leader + 1) % nodes}
+        for entry, node in entries.items():
+            conn = await BenchConn.open(members[node].port, "nljson")
+            latencies = []
+            for _ in range(max(100, n // 10)):
+                start = time.perf_counter()
+                conn.send(request)
+                await conn.recv()
+                latencies.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            for i in range(n):
+                conn.send(request)
+                if i % 1024 == 0:
+                    await conn.writer.drain()
+            for _ in range(n):
+                await conn.recv()
+            rate = n / (time.perf_counter() - start)
+            await conn.close()
+            rows.append({
+                "acks": acks,
+                "entry": entry,
+                "msgs_per_sec": rate,
+                "p50_ms": _percentile(latencies, 0.5),
+                "p99_ms": _percentile(latencies, 0.99),
+                "failover_ms": "-",
+            })
+
+        # fault injection: stop the leader and time until a publish through a survivor succeeds
+        survivor = entries["proxy"]
+        await brokers[leader].close()
+        start = time.perf_counter()
+        while True:
+            conn = await BenchConn.open(members[survivor].port, "nljson")
+            conn.send(request)
+            ok = (await conn.recv()).get("status") == "success"
+            await conn.close()
+            if ok:
+                break
+            await asyncio.sleep(0.01)
+        rows[-1]["failover_ms"] = (time.perf_counter() - start) * 1000
+        for i, broker in enumerate(brokers):
+            if i != leader:
+                await broker.close()
+    return rows
+
+
+SCENARIOS: Dict[str, Callable[[int], Any]] = {
+    "codec": bench_codec,
+    "wire": bench_wire,
+    "fanout": bench_fanout,
+    "slow": bench_slow,
+    "filter": bench_filter,
+    "replay": bench_replay,
+    "batch": bench_batch,
+    "wal": bench_wal,
+    "workers": bench_workers,
+    "cluster": bench_cluster,
+    "wildcard": bench_wildcard,
+    "metrics": bench_metrics,
+    "client": bench_client,
+    "dispatch": bench_dispatch,
+    "queue": bench_queue,
+    "consume": bench_consume,
+    "topics": bench_topics,
+    "spill": bench_spill,
+    "auth": bench_auth,
+    "dedup": bench_dedup,
+    "timers": bench_timers,
+    "compression": bench_compression,
+}
+
+
+async def run(names: List[str], n: int) -> None:
+    for name in names:
+        result = SCENARIOS[name](n)
+        if asyncio.iscoroutine(result):
+            result = await result
+        report(f"{name} (n={n})", result)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="HomeworkBroker benchmarks")
+    parser.add_argument("scenarios", nargs="*", help=f"any of: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("-n", "--messages", type=int, default=20000)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    asyncio.run(run(args.scenarios or list(SCENARIOS), args.messages))
+
+
+if __name__ == "__main__":
+    main()
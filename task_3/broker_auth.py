@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# broker_auth.py
+# Topic credentials and per-connection grants for HomeworkBroker.
+#
+# A topic password is kept only as a salted PBKDF2-SHA256 key. A connection
+# proves it knows the password once, either by sending it ("auth" with
+# "password") or by answering a challenge without sending it:
+#   {"action": "auth_challenge", "topic": t}  ->  salt, iterations, nonce
+#   {"action": "auth", "topic": t, "proof": hex(HMAC-SHA256(key, nonce))}
+# where key = PBKDF2-SHA256(password, salt, iterations) (see client_proof).
+# Grants are remembered per connection, so later requests need no password.
+# Passwords still sent with every request are checked once per connection and
+# topic; at most GRANT_CACHE_SIZE of those grants are kept. A refused password
+# is remembered too, so retrying it costs no second hash.
+
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+CREDENTIAL_ITERATIONS = 10_000
+SALT_BYTES = 16
+NONCE_BYTES = 16
+# topics a connection keeps from passwords sent with requests (auth grants are not evicted)
+GRANT_CACHE_SIZE = 64
+
+
+def derive_key(password: Any, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", str(password).encode("utf-8"), salt, iterations)
+
+
+def same_password(a: Any, b: Any) -> bool:
+    """Whether two plain passwords derive the same key, without deriving it."""
+    return hmac.compare_digest(str(a).encode("utf-8"), str(b).encode("utf-8"))
+
+
+def client_proof(password: str, salt: str, iterations: int, nonce: str) -> str:
+    """Answer to an auth_challenge response (its hex ``salt`` and ``nonce``), for the "proof" field."""
+    key = derive_key(password, bytes.fromhex(salt), iterations)
+    return hmac.new(key, bytes.fromhex(nonce), hashlib.sha256).hexdigest()
+
+
+class TopicCredential:
+    """Salted hash of a topic password; the password itself is not kept."""
+
+    __slots__ = ("salt", "iterations", "key")
+
+    def __init__(self, salt: bytes, iterations: int, key: bytes) -> None:
+        self.salt = salt
+        self.iterations = iterations
+        self.key = key
+
+    @classmethod
+    def create(cls, password: Any, iterations: int = CREDENTIAL_ITERATIONS) -> "TopicCredential":
+        salt = os.urandom(SALT_BYTES)
+        return cls(salt, iterations, derive_key(password, salt, iterations))
+
+    def verify(self, password: Any) -> bool:
+        if password is None:
+            return False
+        return hmac.compare_digest(derive_key(password, self.salt, self.iterations), self.key)
+
+    def verify_proof(self, nonce: bytes, proof: Any) -> bool:
+        try:
+            given = bytes.fromhex(proof)
+        except (TypeError, ValueError):
+            return False
+        return hmac.compare_digest(hmac.new(self.key, nonce, hashlib.sha256).digest(), given)
+
+    def to_record(self) -> Dict[str, Any]:
+        return {"salt": self.salt.hex(), "iterations": self.iterations, "key": self.key.hex()}
+
+    @classmethod
+    def from_record(cls, rec: Dict[str, Any]) -> "TopicCredential":
+        return cls(bytes.fromhex(rec["salt"]), int(rec["iterations"]), bytes.fromhex(rec["key"]))
+
+
+def load_credential(config: Dict[str, Any]) -> Optional[TopicCredential]:
+    """Credential of a topic config record; records written before hashing carry the plain password."""
+    rec = config.get("credential")
+    if rec is not None:
+        return TopicCredential.from_record(rec)
+    password = config.get("password")
+    return TopicCredential.create(password) if password else None
+
+
+class Grants(OrderedDict):
+    """
+    Topics one connection has proven the password of: topic -> that topic's set of granted connections.
+
+    The connection is a member of each of those sets, so the broker's check is a
+    single ``writer in state.granted``; this object bounds and undoes the
+    membership. Topics opened with "auth" (``sessions``) are kept for the life
+    of the connection, the others are dropped oldest first beyond ``size``.
+    """
+
+    def __init__(self, owner: Any, size: int = GRANT_CACHE_SIZE) -> None:
+        super().__init__()
+        self.owner = owner
+        self.size = size
+        self.sessions: Set[str] = set()
+        # topic -> nonce of the outstanding auth_challenge
+        self.nonces: Dict[str, bytes] = {}
+        # topic -> (credential, password) it refused; a new credential makes the entry stale
+        self.refused: Dict[str, Tuple[Any, Any]] = {}
+
+    def add(self, topic: str, granted: Set[Any], session: bool = False) -> None:
+        self.refused.pop(topic, None)
+        granted.add(self.owner)
+        self[topic] = granted
+        self.move_to_end(topic)
+        if session:
+            self.sessions.add(topic)
+        elif len(self) - len(self.sessions) > self.size:
+            for oldest in self:
+                if oldest not in self.sessions:
+                    self.pop(oldest).discard(self.owner)
+                    break
+
+    def refuse(self, topic: str, credential: Any, password: Any) -> None:
+        self.refused.pop(topic, None)
+        self.refused[topic] = (credential, password)
+        if len(self.refused) > self.size:
+            del self.refused[next(iter(self.refused))]
+
+    def was_refused(self, topic: str, credential: Any, password: Any) -> bool:
+        entry = self.refused.get(topic)
+        return entry is not None and entry[0] is credential and entry[1] == password
+
+    def lend(self, other: Any) -> None:
+        """Let ``other`` act with these grants until take_back()."""
+        for granted in self.values():
+            granted.add(other)
+
+    def take_back(self, other: Any) -> None:
+        for granted in self.values():
+            granted.discard(other)
+
+    def revoke(self) -> None:
+        self.take_back(self.owner)
+        self.clear()
+        self.sessions.clear()
+        self.refused.clear()
+
+    def challenge(self, topic: str) -> bytes:
+        nonce = self.nonces[topic] = os.urandom(NONCE_BYTES)
+        return nonce
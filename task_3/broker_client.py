@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+# broker_client.py
+# Programmatic asyncio client for HomeworkBroker.
+#
+#   async with BrokerClient("127.0.0.1", 8888) as client:
+#       subscription = await client.subscribe("news")
+#       await client.publish("news", {"text": "hello"})
+#       async for message in subscription:
+#           print(message.topic, message.payload)
+#
+# Every request carries a "request_id" that the server echoes in its response,
+# so requests are pipelined: any number of them can be in flight on one
+# connection. Requests are spread over a small pool of connections; a lost
+# connection is re-established in the background and its subscriptions are
+# renewed (concrete topics resume from the next offset, so retained messages
+# missed while disconnected are replayed). publish() calls are coalesced into
+# publish_batch requests by size and linger time. An ``idempotent`` client tags
+# publishes with its producer id and a per-topic sequence number and retries
+# them after a lost connection or timeout; the broker stores each one once.
+
+import asyncio
+import itertools
+import uuid
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from broker_auth import client_proof
+from broker_trie import TopicTrie, is_pattern
+from homework_broker import _NLJSONProtocol, open_framed_connection, read_frame
+
+HOST = "127.0.0.1"
+PORT = 8888
+
+DEFAULT_POOL_SIZE = 2
+# publish(): at most this many messages per publish_batch request, and how long
+# (seconds) the first one waits for others; 0 batches what is published in one loop turn
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_LINGER = 0.0
+DEFAULT_TIMEOUT = 30.0
+# extra attempts of an idempotent publish after a lost connection or timeout
+DEFAULT_PUBLISH_RETRIES = 3
+# reconnect backoff (seconds), doubled after each failed attempt
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+# longest line accepted from the server in NLJSON mode
+READ_LIMIT = 16 * 1024 * 1024
+
+
+class BrokerError(Exception):
+    """The server answered a request with {"status": "error"}."""
+
+    def __init__(self, response: Dict[str, Any]) -> None:
+        super().__init__(response.get("message", "Request failed"))
+        self.response = response
+
+
+class Message(NamedTuple):
+    topic: str
+    payload: Any
+    priority: str
+    offset: Optional[int]
+    expires_at: Optional[str]
+
+
+_CLOSED = object()
+
+
+class Subscription:
+    """
+    Messages of one subscribed topic or pattern; iterate with ``async for``.
+
+    Messages are buffered here until read; with ``maxsize`` the oldest ones are
+    dropped once the buffer is full (counted in ``dropped``). Iteration ends
+    after ``close()``.
+    """
+
+    def __init__(
+        self,
+        client: "BrokerClient",
+        topic: str,
+        password: Optional[str] = None,
+        filter_spec: Any = None,
+        maxsize: int = 0,
+    ) -> None:
+        self.topic = topic
+        self.password = password
+        self.filter = filter_spec
+        self.pattern = is_pattern(topic)
+        # offset to resume from after a reconnect (concrete topics only)
+        self.next_offset: Optional[int] = None
+        self.dropped = 0
+        self.closed = False
+        self._client = client
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self._connection: Optional["_Connection"] = None
+
+    def _push(self, message: Message) -> None:
+        if message.offset is not None and not self.pattern:
+            self.next_offset = message.offset + 1
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(message)
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Message:
+        if self.closed and self._queue.empty():
+            raise StopAsyncIteration
+        message = await self._queue.get()
+        if message is _CLOSED:
+            raise StopAsyncIteration
+        return message
+
+    async def get(self, timeout: Optional[float] = None) -> Message:
+        """Next message; raises asyncio.TimeoutError after ``timeout`` seconds."""
+        message = await asyncio.wait_for(self.__anext__(), timeout)
+        return message
+
+    async def close(self) -> None:
+        """Unsubscribe and end the iteration."""
+        await self._client._unsubscribe(self)
+
+    def _finish(self) -> None:
+        if not self.closed:
+            self.closed = True
+            if self._queue.full():
+                self._queue.get_nowait()
+            self._queue.put_nowait(_CLOSED)
+
+
+class _Connection:
+    """One pooled socket: sends requests, matches responses by request_id, routes pushed messages."""
+
+    def __init__(
+        self, client: "BrokerClient", reader: asyncio.StreamReader, writer: asyncio.StreamWriter, protocol: Any
+    ) -> None:
+        self.client = client
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.closed = False
+        self._waiters: Dict[int, asyncio.Future] = {}
+        # subscriptions made over this connection by topic or pattern; patterns also in a trie
+        self.subscriptions: Dict[str, Subscription] = {}
+        self.patterns = TopicTrie()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    @classmethod
+    async def open(cls, client: "BrokerClient") -> "_Connection":
+        if client.codec is None:
+            reader, writer = await asyncio.open_connection(client.host, client.port, limit=READ_LIMIT)
+            return cls(client, reader, writer, _NLJSONProtocol)
+        reader, writer, protocol = await open_framed_connection(
+            client.host, client.port, codec=client.codec, compression=client.compression
+        )
+        return cls(client, reader, writer, protocol)
+
+    def add(self, sub: Subscription) -> None:
+        self.subscriptions[sub.topic] = sub
+        if sub.pattern:
+            self.patterns.add(sub.topic, sub.topic, sub)
+        sub._connection = self
+
+    def discard(self, sub: Subscription) -> None:
+        if self.subscriptions.pop(sub.topic, None) is not None and sub.pattern:
+            self.patterns.remove(sub.topic, sub.topic)
+        if sub._connection is self:
+            sub._connection = None
+
+    async def call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Send one request and wait for its response (other requests may be sent meanwhile)."""
+        if self.closed:
+            raise ConnectionError("Connection to broker lost")
+        request_id = next(self.client._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = future
+        try:
+            self.writer.write(self.protocol.encode(dict(request, request_id=request_id)))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, self.client.timeout)
+        finally:
+            self._waiters.pop(request_id, None)
+
+    async def _read(self) -> Optional[Dict[str, Any]]:
+        if self.protocol is _NLJSONProtocol:
+            line = await self.reader.readline()
+            return self.protocol.decode(line) if line else None
+        body = await read_frame(self.reader)
+        return None if body is None else self.protocol.decode(body)
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                msg = await self._read()
+                if msg is None:
+                    break
+                request_id = msg.get("request_id")
+                if request_id is not None:
+                    future = self._waiters.get(request_id)
+                    if future is not None and not future.done():
+                        future.set_result(msg)
+                elif msg.get("type") == "message":
+                    self._route(msg)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._lost()
+
+    def _route(self, msg: Dict[str, Any]) -> None:
+        topic = msg.get("topic")
+        message = Message(topic, msg.get("payload"), msg.get("priority"), msg.get("offset"), msg.get("expires_at"))
+        sub = self.subscriptions.get(topic)
+        if sub is not None and not sub.pattern:
+            sub._push(message)
+        if len(self.patterns):
+            for _, pattern_sub in self.patterns.match(topic):
+                pattern_sub._push(message)
+
+    def _lost(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection to broker lost"))
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        self.client._connection_lost(self)
+
+    async def close(self) -> None:
+        self.closed = True
+        self._reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class BrokerClient:
+    """
+    Pooled, pipelined client of HomeworkBroker.
+
+    ``codec`` None speaks newline-delimited JSON, "json" or "msgpack" the framed
+    binary mode; ``compression`` lists the frame compressions to ask the broker
+    for, preferred first (framed only, see broker_compress). Requests that fail because their connection was lost raise
+    ConnectionError and are not retried; error responses raise BrokerError.
+    """
+
+    def __init__(
+        self,
+        host: str = HOST,
+        port: int = PORT,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        codec: Optional[str] = None,
+        reconnect: bool = True,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        linger: float = DEFAULT_LINGER,
+        timeout: float = DEFAULT_TIMEOUT,
+        idempotent: bool = False,
+        publish_retries: int = DEFAULT_PUBLISH_RETRIES,
+        compression: Iterable[str] = (),
+    ) -> None:
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        compression = tuple(compression)
+        if compression and codec is None:
+            raise ValueError("compression needs a framed codec")
+        self.host = host
+        self.port = port
+        self.codec = codec
+        self.compression = compression
+        self.reconnect = reconnect
+        self.batch_size = batch_size
+        self.linger = linger
+        self.timeout = timeout
+        # idempotent publishing: this client's producer id and the next seq per topic
+        self.producer: Optional[str] = uuid.uuid4().hex if idempotent else None
+        self.publish_retries = publish_retries
+        self._next_seq: Dict[str, int] = {}
+        self._slots: List[Optional[_Connection]] = [None] * pool_size
+        self._next_slot = 0
+        self._request_ids = itertools.count(1)
+        self._available = asyncio.Event()
+        self._reconnects: Dict[int, asyncio.Task] = {}
+        # topic or pattern -> its subscription (one per client)
+        self._subscriptions: Dict[str, Subscription] = {}
+        # publish() calls waiting to be sent as one publish_batch
+        self._batch: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: set = set()
+        # topic -> password proven on every pooled connection (see authenticate)
+        self._credentials: Dict[str, str] = {}
+        self._closed = False
+
+    async def __aenter__(self) -> "BrokerClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    async def connect(self) -> None:
+        conns = await asyncio.gather(*(_Connection.open(self) for _ in self._slots))
+        self._slots = list(conns)
+        self._available.set()
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        await self.flush()
+        self._closed = True
+        for task in self._reconnects.values():
+            task.cancel()
+        for sub in list(self._subscriptions.values()):
+            sub._finish()
+        self._subscriptions.clear()
+        for conn in self._slots:
+            if conn is not None:
+                await conn.close()
+        self._available.set()  # wake requests waiting for a connection
+
+    # ---------------- Requests ----------------
+
+    async def _connection(self) -> _Connection:
+        """A live pooled connection, round-robin; waits while all of them are reconnecting."""
+        while True:
+            if self._closed:
+                raise ConnectionError("Client is closed")
+            n = len(self._slots)
+            for i in range(n):
+                slot = (self._next_slot + i) % n
+                conn = self._slots[slot]
+                if conn is not None and not conn.closed:
+                    self._next_slot = (slot + 1) % n
+                    return conn
+            if not self.reconnect:
+                raise ConnectionError("Connection to broker lost")
+            self._available.clear()
+            await asyncio.wait_for(self._available.wait(), self.timeout)
+
+    async def request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Send any action; returns the success response or raises BrokerError."""
+        conn = await self._connection()
+        return _checked(await conn.call(request))
+
+    async def list_topics(self) -> List[str]:
+        return (await self.request({"action": "list_topics"}))["topics"]
+
+    async def queue_length(self, topic: str) -> int:
+        return (await self.request({"action": "queue_length", "topic": topic}))["messages"]
+
+    async def clear_topic(self, topic: str, password: Optional[str] = None) -> None:
+        await self.request(_without_none({"action": "clear_topic", "topic": topic, "password": password}))
+
+    async def configure_topic(self, topic: str, **options: Any) -> Dict[str, Any]:
+        return await self.request(_without_none({"action": "configure_topic", "topic": topic, **options}))
+
+    async def stats(self) -> Dict[str, Any]:
+        return (await self.request({"action": "stats"}))["stats"]
+
+    async def authenticate(self, topic: str, password: str) -> None:
+        """
+        Prove a topic password on every pooled connection without sending it.
+
+        Later requests for the topic need no password; reconnected connections
+        prove it again before they are used.
+        """
+        conns = [conn for conn in self._slots if conn is not None and not conn.closed]
+        await asyncio.gather(*(_authenticate_on(conn, topic, password) for conn in conns))
+        self._credentials[topic] = password
+
+    # ---------------- Publishing ----------------
+
+    async def publish(
+        self,
+        topic: str,
+        message: Any,
+        priority: str = "normal",
+        ttl: Optional[int] = None,
+        password: Optional[str] = None,
+        delay: Optional[float] = None,
+        deliver_at: Any = None,
+    ) -> None:
+        """
+        Publish one message; returns once the server has accepted it.
+
+        With ``delay`` (seconds) or ``deliver_at`` (epoch seconds or ISO 8601)
+        the server holds the message and delivers it at that time.
+
+        Concurrent calls share publish_batch requests: a batch is sent when it
+        reaches ``batch_size`` messages or ``linger`` seconds after its first one.
+        An idempotent client retries up to ``publish_retries`` times with the
+        same sequence number, so a publish is stored once even if an ack is lost.
+        """
+        item = _without_none(
+            {
+                "topic": topic,
+                "message": message,
+                "priority": priority,
+                "ttl": ttl,
+                "password": password,
+                "delay": delay,
+                "deliver_at": deliver_at,
+            }
+        )
+        if self.producer is None:
+            await self._publish_item(item)
+            return
+        seq = self._next_seq.get(topic, 0)
+        self._next_seq[topic] = seq + 1
+        item["producer"] = self.producer
+        item["seq"] = seq
+        for attempt in range(self.publish_retries + 1):
+            try:
+                await self._publish_item(item)
+                return
+            except (ConnectionError, asyncio.TimeoutError):
+                if attempt == self.publish_retries or self._closed:
+                    raise
+
+    async def _publish_item(self, item: Dict[str, Any]) -> None:
+        if self.batch_size <= 1:
+            await self.request(dict(item, action="publish"))
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((item, future))
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(self.linger, self._flush_batch)
+        await future
+
+    async def flush(self) -> None:
+        """Send the pending batch now and wait until every batch in flight is acknowledged."""
+        self._flush_batch()
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+
+    def _flush_batch(self) -> None:
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.create_task(self._send_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        try:
+            conn = await self._connection()
+            response = await conn.call({"action": "publish_batch", "messages": [item for item, _ in batch]})
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        errors = {error.get("index"): error for error in response.get("errors", ())}
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            error = errors.get(index)
+            if error is not None:
+                future.set_exception(BrokerError({"status": "error", "message": error.get("message")}))
+            elif response.get("status") != "success" and not errors:
+                # the request as a whole was rejected
+                future.set_exception(BrokerError(response))
+            else:
+                future.set_result(None)
+
+    # ---------------- Subscriptions ----------------
+
+    async def subscribe(
+        self,
+        topic: str,
+        password: Optional[str] = None,
+        filter: Any = None,
+        from_offset: Optional[int] = None,
+        from_timestamp: Any = None,
+        maxsize: int = 0,
+    ) -> Subscription:
+        """Subscribe to a topic or pattern; see Subscription."""
+        if topic in self._subscriptions:
+            raise ValueError(f"Already subscribed to '{topic}'")
+        sub = Subscription(self, topic, password, filter, maxsize)
+        # taken before the first await, so a concurrent subscribe to the same topic is refused too
+        self._subscriptions[topic] = sub
+        try:
+            conn = await self._connection()
+            await self._subscribe_on(conn, sub, from_offset, from_timestamp)
+        except BaseException:
+            if self._subscriptions.get(topic) is sub:
+                del self._subscriptions[topic]
+            raise
+        return sub
+
+    async def _subscribe_on(
+        self, conn: _Connection, sub: Subscription, from_offset: Optional[int] = None, from_timestamp: Any = None
+    ) -> Dict[str, Any]:
+        request = _without_none(
+            {
+                "action": "subscribe",
+                "topic": sub.topic,
+                "password": sub.password,
+                "filter": sub.filter,
+                "from_offset": from_offset,
+                "from_timestamp": from_timestamp,
+            }
+        )
+        # registered first: replayed messages can arrive before the response
+        conn.add(sub)
+        try:
+            response = _checked(await conn.call(request))
+        except Exception:
+            conn.discard(sub)
+            raise
+        # where this subscription starts: the replay start, or the first live offset
+        start = response.get("from_offset", response.get("next_offset"))
+        if not sub.pattern and start is not None and (sub.next_offset is None or sub.next_offset < start):
+            sub.next_offset = start
+        return response
+
+    async def _unsubscribe(self, sub: Subscription) -> None:
+        if self._subscriptions.get(sub.topic) is sub:
+            del self._subscriptions[sub.topic]
+        conn = sub._connection
+        sub._finish()
+        if conn is None:
+            return
+        conn.discard(sub)
+        if not conn.closed:
+            try:
+                await conn.call({"action": "unsubscribe", "topic": sub.topic})
+            except ConnectionError:
+                pass  # the server forgets the subscription with the connection anyway
+
+    # ---------------- Reconnect ----------------
+
+    def _connection_lost(self, conn: _Connection) -> None:
+        if self._closed or conn not in self._slots:
+            return
+        slot = self._slots.index(conn)
+        subscriptions = list(conn.subscriptions.values())
+        for sub in subscriptions:
+            conn.discard(sub)
+        if self.reconnect and slot not in self._reconnects:
+            self._reconnects[slot] = asyncio.create_task(self._reconnect(slot, subscriptions))
+        else:
+            for sub in subscriptions:
+                sub._finish()
+
+    async def _reconnect(self, slot: int, subscriptions: List[Subscription]) -> None:
+        delay = RECONNECT_DELAY
+        try:
+            while not self._closed:
+                try:
+                    conn = await _Connection.open(self)
+                except OSError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                    continue
+                try:
+                    await self._reauthenticate(conn)
+                except (ConnectionError, asyncio.TimeoutError):
+                    await conn.close()
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                    continue
+                self._slots[slot] = conn
+                self._available.set()
+                # from here on a new loss of this slot starts a new reconnect
+                del self._reconnects[slot]
+                await self._resubscribe(conn, subscriptions)
+                return
+        finally:
+            if self._reconnects.get(slot) is asyncio.current_task():
+                del self._reconnects[slot]
+
+    async def _reauthenticate(self, conn: _Connection) -> None:
+        for topic, password in list(self._credentials.items()):
+            try:
+                await _authenticate_on(conn, topic, password)
+            except BrokerError:
+                pass  # e.g. a restarted server without the topic; its requests will report that
+
+    async def _resubscribe(self, conn: _Connection, subscriptions: List[Subscription]) -> None:
+        live = [sub for sub in subscriptions if not sub.closed]
+        # all registered up front, so that losing the connection midway hands every one on
+        for sub in live:
+            conn.add(sub)
+        for sub in live:
+            try:
+                response = await self._subscribe_on(conn, sub, sub.next_offset)
+                if sub.next_offset is not None and response.get("next_offset", sub.next_offset) < sub.next_offset:
+                    # offsets went back: the server restarted, take whatever it retains
+                    response = await self._subscribe_on(conn, sub, 0)
+            except ConnectionError:
+                # lost again: the next reconnect takes over all of them
+                return
+            except (BrokerError, asyncio.TimeoutError):
+                conn.discard(sub)
+                sub._finish()
+
+
+async def _authenticate_on(conn: _Connection, topic: str, password: str) -> None:
+    challenge = _checked(await conn.call({"action": "auth_challenge", "topic": topic}))
+    proof = client_proof(password, challenge["salt"], challenge["iterations"], challenge["nonce"])
+    _checked(await conn.call({"action": "auth", "topic": topic, "proof": proof}))
+
+
+def _checked(response: Dict[str, Any]) -> Dict[str, Any]:
+    if response.get("status") != "success":
+        raise BrokerError(response)
+    return response
+
+
+def _without_none(obj: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in obj.items() if v is not None}
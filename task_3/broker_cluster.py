@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# broker_cluster.py
+# Replicated HomeworkBroker cluster. Topics are hashed into partitions
+# (crc32(topic) % partitions); partition p is replicated on nodes
+# p, p+1, ... (mod N) and led by the first of them that is alive and in sync.
+# The leader logs every change of a topic as WAL-style records and streams
+# them to the followers; publishes are acked after the leader applied them
+# ("leader") or after a majority of the replicas did ("quorum").
+# Clients may connect to any node: requests are proxied to the partition
+# leader over the same links the multi-process mode uses, and the "locate"
+# action tells smart clients where to connect directly.
+#
+# Extra link frames (on top of broker_workers'):
+#   {"op": "ping", "rid": int}                                 -> reply {"ready": bool}
+#   {"op": "replicate", "rid": int, "records": [[kind, rec]]}  leader -> follower, reply when applied
+#   {"op": "sync", "rid": int, "partition": int}               -> reply {"records": [...], "seq": int}
+#   {"op": "install", "partition": int, "records": [...], "seq": int}  leader -> follower that missed records
+
+import argparse
+import asyncio
+import time
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import broker_wal
+from broker_auth import load_credential
+from broker_workers import LINK_PROTOCOL, ShardedBroker
+from homework_broker import _TopicState, _config_record
+
+ACK_LEVELS = ("leader", "quorum")
+DEFAULT_PARTITIONS = 16
+DEFAULT_REPLICATION = 3
+HEARTBEAT_INTERVAL = 0.1
+FAILURE_TIMEOUT = 0.5
+REPLICATION_TIMEOUT = 2.0
+
+
+class ClusterNode(NamedTuple):
+    host: str
+    port: int  # clients
+    peer_port: int  # other nodes
+
+
+def parse_nodes(spec: str) -> List[ClusterNode]:
+    """Parse ``host:port:peer_port,host:port:peer_port,...``."""
+    nodes = []
+    for part in spec.split(","):
+        host, port, peer_port = part.strip().rsplit(":", 2)
+        nodes.append(ClusterNode(host, int(port), int(peer_port)))
+    return nodes
+
+
+def _quorum(futures: List[asyncio.Future], needed: int, timeout: float) -> asyncio.Future:
+    """Future that resolves once ``needed`` of ``futures`` succeeded and fails once that is impossible."""
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+    if needed <= 0:
+        result.set_result(None)
+        return result
+    if len(futures) < needed:
+        result.set_exception(ConnectionError("Not enough replicas are available"))
+        return result
+    counts = [0, 0]  # acked, failed
+
+    def on_done(future: asyncio.Future) -> None:
+        if result.done():
+            return
+        if future.cancelled() or future.exception() is not None:
+            counts[1] += 1
+        else:
+            counts[0] += 1
+        if counts[0] >= needed:
+            result.set_result(None)
+        elif len(futures) - counts[1] < needed:
+            result.set_exception(ConnectionError("Not enough replicas acknowledged"))
+
+    def on_timeout() -> None:
+        if not result.done():
+            result.set_exception(asyncio.TimeoutError("Replication timed out"))
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    timer = loop.call_later(timeout, on_timeout)
+    result.add_done_callback(lambda _: timer.cancel())
+    return result
+
+
+class _Replicator:
+    """Records on their way to one follower; those logged in one loop iteration travel in one frame."""
+
+    def __init__(self, broker: "ClusterBroker", peer: int) -> None:
+        self.broker = broker
+        self.peer = peer
+        self._records: List[Tuple[int, Dict[str, Any]]] = []
+        self._waiter: Optional[asyncio.Future] = None
+
+    def append(self, kind: int, record: Dict[str, Any]) -> asyncio.Future:
+        if self._waiter is None:
+            loop = asyncio.get_running_loop()
+            self._waiter = loop.create_future()
+            loop.call_soon(self._flush)
+        self._records.append((kind, record))
+        return self._waiter
+
+    def _flush(self) -> None:
+        records, self._records = self._records, []
+        waiter, self._waiter = self._waiter, None
+        task = asyncio.ensure_future(self.broker._link(self.peer).request({"op": "replicate", "records": records}))
+
+        def on_done(task: asyncio.Task) -> None:
+            failed = task.cancelled() or task.exception() is not None
+            if failed:
+                self.broker._replication_failed(self.peer)
+            if waiter.done():
+                return
+            if failed:
+                waiter.set_exception(ConnectionError(f"Node {self.peer} did not acknowledge"))
+                waiter.exception()  # with acks=leader nobody waits for it
+            else:
+                waiter.set_result(None)
+
+        task.add_done_callback(on_done)
+
+
+class ClusterBroker(ShardedBroker):
+    """
+    One node of a replicated broker cluster.
+
+    Every node keeps a copy of the queues of the partitions it replicates; only
+    the leader serves subscribers and consumers. Failure detection is heartbeat
+    based and leadership is derived from it deterministically, so there is no
+    election round: after ``failure_timeout`` without a heartbeat the next
+    replica in order takes over with the queue it already has. A network
+    partition may briefly produce two leaders; the cluster does not fence them.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        nodes: List[ClusterNode],
+        partitions: int = DEFAULT_PARTITIONS,
+        replication: int = DEFAULT_REPLICATION,
+        acks: str = "leader",
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        failure_timeout: float = FAILURE_TIMEOUT,
+        **kwargs: Any,
+    ) -> None:
+        if acks not in ACK_LEVELS:
+            raise ValueError(f"acks must be one of {ACK_LEVELS}")
+        # set before the base class recovers durable topics through _get_or_create_topic
+        self.partitions = partitions
+        self.ready = False
+        self._leaders: List[Optional[int]] = [None] * partitions
+        super().__init__(index, len(nodes), "", **kwargs)
+        self.nodes = nodes
+        self.replication = min(replication, len(nodes))
+        self.acks = acks
+        self.heartbeat_interval = heartbeat_interval
+        self.failure_timeout = failure_timeout
+        self.link_connect_timeout = heartbeat_interval
+        self._last_seen: Dict[int, float] = {}
+        self._peer_ready: Dict[int, bool] = {}
+        self._alive: Set[int] = set()
+        self._ready_peers: Set[int] = set()
+        self._resync: Set[int] = set()
+        self._replicators: Dict[int, _Replicator] = {}
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[Any] = set()
+
+    # ---------------- Placement ----------------
+
+    def partition(self, topic: str) -> int:
+        return zlib.crc32(topic.encode("utf-8")) % self.partitions
+
+    def replicas(self, partition: int) -> List[int]:
+        return [(partition + k) % self.count for k in range(self.replication)]
+
+    def owner(self, topic: str) -> Optional[int]:
+        return self._leaders[self.partition(topic)]
+
+    def _elect(self, partition: int) -> Optional[int]:
+        for node in self.replicas(partition):
+            if (node == self.index and self.ready) or node in self._ready_peers:
+                return node
+        return None
+
+    def _reachable_peers(self) -> List[int]:
+        return sorted(self._ready_peers)
+
+    # ---------------- Lifecycle ----------------
+
+    async def open_link(self, peer: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        node = self.nodes[peer]
+        return await asyncio.open_connection(node.host, node.peer_port)
+
+    async def start_link_server(self) -> None:
+        node = self.nodes[self.index]
+        self._link_server = await asyncio.start_server(self._serve_peer, node.host, node.peer_port)
+
+    async def start(self) -> None:
+        """Join the cluster: catch up on the replicated partitions, then serve clients."""
+        self.resume_sweeper()
+        await self.start_link_server()
+        await self._ping_all()
+        for partition in range(self.partitions):
+            if self.index not in self.replicas(partition):
+                continue
+            source = next((n for n in self.replicas(partition) if n in self._ready_peers), None)
+            if source is None:
+                continue
+            try:
+                reply = await self._link(source).request({"op": "sync", "partition": partition})
+            except ConnectionError:
+                continue
+            self._install(partition, reply["records"], reply["seq"])
+        self.ready = True
+        self._update_view()
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        node = self.nodes[self.index]
+        self._server = await asyncio.start_server(self._serve_client, node.host, node.port)
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections.add(writer)
+        try:
+            await self.handle_client(reader, writer)
+        finally:
+            self._connections.discard(writer)
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections.add(writer)
+        try:
+            await self._serve_link(reader, writer)
+        finally:
+            self._connections.discard(writer)
+
+    async def close(self) -> None:
+        """Leave the cluster; all connections are dropped, so peers see it as a crashed node."""
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+        await super().close()
+
+    # ---------------- Failure detection ----------------
+
+    async def _ping(self, peer: int) -> None:
+        try:
+            reply = await asyncio.wait_for(self._link(peer).request({"op": "ping"}), self.failure_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return
+        self._last_seen[peer] = asyncio.get_running_loop().time()
+        self._peer_ready[peer] = bool(reply.get("ready"))
+
+    async def _ping_all(self) -> None:
+        await asyncio.gather(*(self._ping(p) for p in range(self.count) if p != self.index))
+        self._update_view()
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self._ping_all()
+
+    def _update_view(self) -> None:
+        now = asyncio.get_running_loop().time()
+        alive = {p for p, seen in self._last_seen.items() if now - seen < self.failure_timeout}
+        for peer in self._alive - alive:
+            self._on_peer_down(peer)
+        self._alive = alive
+        self._ready_peers = {p for p in alive if self._peer_ready.get(p)}
+        for peer in self._resync & self._ready_peers:
+            self._resync.discard(peer)
+            self._push_snapshot(peer)
+        leaders = [self._elect(p) for p in range(self.partitions)]
+        for partition, (old, new) in enumerate(zip(self._leaders, leaders)):
+            if old == self.index and new != self.index:
+                self._step_down(partition)
+        self._leaders = leaders
+
+    def _on_peer_down(self, peer: int) -> None:
+        self._resync.add(peer)
+        # subscriptions held on the dead node are gone: let those clients reconnect and resubscribe
+        for writer, owners in list(self._client_owners.items()):
+            if peer in owners:
+                writer.close()
+
+    def _replication_failed(self, peer: int) -> None:
+        # the follower missed records; it gets a snapshot once it answers heartbeats again
+        self._resync.add(peer)
+        self._last_seen.pop(peer, None)
+
+    def _step_down(self, partition: int) -> None:
+        """Another node leads the partition now: disconnect the clients that subscribed here."""
+        for state in self._partition_topics(partition):
+            for writer in set(state.subscribers) | set(state.consumers):
+                writer.close()
+
+    # ---------------- Replication (leader side) ----------------
+
+    def _journaled(self, state: _TopicState) -> bool:
+        return True
+
+    def _log(
+        self, state: _TopicState, kind: int, record: Dict[str, Any], commits: Optional[List[asyncio.Future]] = None
+    ) -> None:
+        super()._log(state, kind, record, commits)
+        followers = [n for n in self.replicas(self.partition(state.name)) if n != self.index and n in self._alive]
+        futures = [self._replicator(n).append(kind, record) for n in followers]
+        if self.acks == "quorum" and commits is not None:
+            # the leader itself is one of the majority
+            commits.append(_quorum(futures, self.replication // 2, REPLICATION_TIMEOUT))
+
+    def _replicator(self, peer: int) -> _Replicator:
+        replicator = self._replicators.get(peer)
+        if replicator is None:
+            replicator = self._replicators[peer] = _Replicator(self, peer)
+        return replicator
+
+    def _get_or_create_topic(self, topic: str, password: Optional[str] = None) -> _TopicState:
+        created = topic not in self.topics
+        state = super()._get_or_create_topic(topic, password)
+        if created and self.owner(topic) == self.index:
+            self._log(state, broker_wal.CONFIG, _config_record(state))
+        return state
+
+    def _partition_topics(self, partition: int) -> List[_TopicState]:
+        return [state for name, state in self.topics.items() if self.partition(name) == partition]
+
+    def _snapshot(self, partition: int) -> List[Tuple[int, Dict[str, Any]]]:
+        """CONFIG and PUT records that rebuild the partition's topics, unacked deliveries included."""
+        records: List[Tuple[int, Dict[str, Any]]] = []
+        for state in self._partition_topics(partition):
+            records.append((broker_wal.CONFIG, _config_record(state)))
+            messages = list(state.queue.messages()) + [record[0] for record in state.inflight.values()]
+            for m in sorted(messages, key=lambda m: m.seq):
+                record = broker_wal.put_record(state.name, m.seq, m.priority, m.created, m.expires_at(), m.payload)
+                records.append((broker_wal.PUT, record))
+        return records
+
+    def _push_snapshot(self, peer: int) -> None:
+        link = self._link(peer)
+        for partition in range(self.partitions):
+            if self._leaders[partition] == self.index and peer in self.replicas(partition):
+                link.send({"op": "install", "partition": partition, "records": self._snapshot(partition), "seq": self._seq})
+
+    # ---------------- Replication (follower side) ----------------
+
+    async def _handle_link_frame(self, frame: Dict[str, Any], link_writer: asyncio.StreamWriter) -> None:
+        op = frame.get("op")
+        reply: Optional[Dict[str, Any]] = None
+        if op == "ping":
+            reply = {"ready": self.ready}
+        elif op == "replicate":
+            self._apply(frame["records"])
+            reply = {}
+        elif op == "sync":
+            reply = {"records": self._snapshot(frame["partition"]), "seq": self._seq}
+        elif op == "install":
+            self._install(frame["partition"], frame["records"], frame["seq"])
+        if reply is not None and "rid" in frame:
+            reply.update(op="reply", rid=frame["rid"])
+            link_writer.write(LINK_PROTOCOL.encode(reply))
+
+    def _apply(self, records: List[Tuple[int, Dict[str, Any]]]) -> None:
+        """Replay records of a leader; PUTs are idempotent so a snapshot may overlap the stream."""
+        loop_now = asyncio.get_running_loop().time()
+        now_wall = time.time()
+        for kind, rec in records:
+            topic = rec["t"]
+            state = self.topics.get(topic) or super()._get_or_create_topic(topic)
+            if kind == broker_wal.PUT:
+                self._seq = max(self._seq, rec["s"])
+                if rec["s"] in state.queue.index or rec["s"] in state.inflight:
+                    continue
+                message = self._message_from_record(rec, now_wall, loop_now)
+                if message is None:
+                    continue
+                # a replica is never refused for quota reasons
+                if not state.queue.put(message):
+                    state.queue.push(message)
+                if message.deadline is not None:
+                    self._ttl_topics.add(topic)
+                    self._ensure_sweeper()
+            elif kind == broker_wal.DELETE:
+                state.queue.discard(rec["s"])
+            elif kind == broker_wal.CLEAR:
+                for seq in [s for s in state.queue.index if s <= rec["s"]]:
+                    state.queue.discard(seq)
+            elif kind == broker_wal.CONFIG:
+                state.set_credential(load_credential(rec))
+                state.overflow = rec.get("overflow")
+                self._set_dead_letter(state, rec.get("dead_letter"))
+                state.max_attempts = rec.get("max_attempts")
+                if rec.get("durable") and self._wal is not None:
+                    state.durable = True
+            if state.durable:
+                self._wal.append(kind, rec)
+
+    def _install(self, partition: int, records: List[Tuple[int, Dict[str, Any]]], seq: int) -> None:
+        """Apply a leader's snapshot: messages it no longer has (up to ``seq``) are dropped here too."""
+        keep = {rec["s"] for kind, rec in records if kind == broker_wal.PUT}
+        for state in self._partition_topics(partition):
+            for s in [s for s in state.queue.index if s <= seq and s not in keep]:
+                state.queue.discard(s)
+        self._seq = max(self._seq, seq)
+        self._apply(records)
+
+    # ---------------- Routing ----------------
+
+    async def handle_request(self, msg: Dict[str, Any], writer: Any) -> None:
+        if msg.get("action") == "locate":
+            await self.locate(msg.get("topic"), writer)
+            return
+        await super().handle_request(msg, writer)
+
+    async def locate(self, topic: Any, writer: Any) -> None:
+        """Tell a client which node leads the topic's partition, so it can connect there directly."""
+        if not isinstance(topic, str) or not topic:
+            await self.send_response({"status": "error", "message": "Missing 'topic' field"}, writer)
+            return
+        partition = self.partition(topic)
+        leader = self._leaders[partition]
+        if leader is None:
+            await self.send_response({"status": "error", "message": f"No node can serve topic '{topic}'"}, writer)
+            return
+        node = self.nodes[leader]
+        await self.send_response(
+            {"status": "success", "topic": topic, "partition": partition, "leader": leader, "address": f"{node.host}:{node.port}"},
+            writer,
+        )
+
+
+async def serve_node(index: int, nodes: List[ClusterNode], **kwargs: Any) -> None:
+    broker = ClusterBroker(index, nodes, **kwargs)
+    await broker.start()
+    node = nodes[index]
+    print(f"Cluster node {index}/{len(nodes)} listening on {node.host}:{node.port} (peers on {node.peer_port})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await broker.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run one node of a HomeworkBroker cluster")
+    parser.add_argument("--nodes", required=True, help="host:port:peer_port of every node, comma separated")
+    parser.add_argument("--node-id", type=int, required=True, help="index of this node in --nodes")
+    parser.add_argument("--partitions", type=int, default=DEFAULT_PARTITIONS)
+    parser.add_argument("--replication", type=int, default=DEFAULT_REPLICATION)
+    parser.add_argument("--acks", choices=ACK_LEVELS, default="leader")
+    parser.add_argument("--data-dir", help="enable durable topics, stored in this directory")
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            serve_node(
+                args.node_id,
+                parse_nodes(args.nodes),
+                partitions=args.partitions,
+                replication=args.replication,
+                acks=args.acks,
+                data_dir=args.data_dir,
+            )
+        )
+    except KeyboardInterrupt:
+        print("Server stopped")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# broker_dedup.py
+# Duplicate detection for idempotent publishes.
+#
+# A publisher that may retry tags each publish with "producer" (its id) and
+# "seq" (increasing per producer and topic; gaps are fine). For every
+# (producer, topic) the broker remembers which of the last DEDUP_WINDOW
+# sequence numbers it has stored, as one bitmap relative to the highest seen:
+#
+#   bit i of ``bits`` set  <=>  sequence number ``high - i`` was stored
+#
+# so a window costs a few hundred bytes however busy the producer is.
+# Windows are kept in least-recently-used order: ones idle for longer than
+# DEDUP_IDLE seconds are forgotten, and beyond ``max_producers`` the least
+# recently used goes first. The index is in memory only; a retry that
+# arrives after a restart (or a cluster failover) is not recognised.
+
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+DEDUP_WINDOW = 1024
+DEDUP_IDLE = 600.0
+DEDUP_MAX_PRODUCERS = 10_000
+
+# outcomes of DedupIndex.check
+FRESH = 0
+DUPLICATE = 1
+STALE = 2  # older than the window: cannot tell
+
+
+class _Window:
+    __slots__ = ("high", "bits", "used")
+
+    def __init__(self) -> None:
+        self.high = -1
+        self.bits = 0
+        self.used = 0.0
+
+
+class DedupIndex:
+    """Sequence numbers recently stored per (producer, topic), in bounded memory."""
+
+    def __init__(
+        self, window: int = DEDUP_WINDOW, idle: float = DEDUP_IDLE, max_producers: int = DEDUP_MAX_PRODUCERS
+    ) -> None:
+        self.window = window
+        self.idle = idle
+        self.max_producers = max_producers
+        self._mask = (1 << window) - 1
+        self._windows: "OrderedDict[Hashable, _Window]" = OrderedDict()
+        self.forgotten = 0  # windows dropped for idleness or the producer limit
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def check(self, key: Hashable, seq: int) -> int:
+        w = self._windows.get(key)
+        if w is None or seq > w.high:
+            return FRESH
+        distance = w.high - seq
+        if distance >= self.window:
+            return STALE
+        return DUPLICATE if w.bits >> distance & 1 else FRESH
+
+    def add(self, key: Hashable, seq: int, now: Optional[float] = None) -> None:
+        """Remember a stored sequence number (after check() returned FRESH)."""
+        now = time.monotonic() if now is None else now
+        windows = self._windows
+        w = windows.get(key)
+        if w is None:
+            w = windows[key] = _Window()
+            w.used = now
+            self._evict(now)
+        else:
+            windows.move_to_end(key)
+            w.used = now
+        if seq > w.high:
+            shift = seq - w.high
+            w.bits = ((w.bits << shift) | 1) & self._mask if shift < self.window else 1
+            w.high = seq
+        else:
+            w.bits |= 1 << (w.high - seq)
+
+    def _evict(self, now: float) -> None:
+        windows = self._windows
+        # least recently used first: stop at the first window still in use
+        while windows:
+            key, w = next(iter(windows.items()))
+            if len(windows) <= self.max_producers and now - w.used < self.idle:
+                break
+            del windows[key]
+            self.forgotten += 1
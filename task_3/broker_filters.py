@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# broker_filters.py
+# Content filters for HomeworkBroker subscriptions. A filter is a JSON object
+# over payload fields (dotted paths reach into nested objects):
+#   {"region": "eu"}                                   equality
+#   {"price": {"$gte": 10, "$lt": 100}}                ranges: $gt $gte $lt $lte, also $eq $ne
+#   {"status": {"$in": ["new", "paid"]}}               membership: $in $nin
+#   {"coupon": {"$exists": false}}                     presence
+#   {"$or": [{...}, {...}]}, {"$and": [...]}, {"$not": {...}}
+# Keys of one object are combined with AND. A payload that is not an object
+# (or lacks a field) does not match comparisons on that field.
+
+import json
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+Predicate = Callable[[Any], bool]
+
+# compiled filters by canonical text; identical filters share one Filter
+FILTER_CACHE_SIZE = 10000
+
+_MISSING = object()
+
+
+class Filter:
+    """A compiled subscription filter; ``key`` is its canonical JSON text."""
+
+    __slots__ = ("key", "predicate")
+
+    def __init__(self, key: str, predicate: Predicate) -> None:
+        self.key = key
+        self.predicate = predicate
+
+    def __call__(self, payload: Any) -> bool:
+        return self.predicate(payload)
+
+    def __repr__(self) -> str:
+        return f"Filter({self.key})"
+
+
+_compiled: Dict[str, Filter] = {}
+
+
+def compile_filter(spec: Any) -> Filter:
+    """Compile a filter object once; raises ValueError when it is malformed."""
+    if not isinstance(spec, dict):
+        raise ValueError("filter must be an object")
+    key = json.dumps(spec, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    cached = _compiled.get(key)
+    if cached is not None:
+        return cached
+    if len(_compiled) >= FILTER_CACHE_SIZE:
+        _compiled.clear()
+    compiled = _compiled[key] = Filter(key, _compile_object(spec))
+    return compiled
+
+
+def any_of(filters: Sequence[Filter]) -> Filter:
+    """One filter matching when any of ``filters`` does (a writer subscribed more than once)."""
+    keys = sorted({f.key for f in filters})
+    if len(keys) == 1:
+        return filters[0]
+    return compile_filter({"$or": [json.loads(k) for k in keys]})
+
+
+def _compile_object(spec: Dict[str, Any]) -> Predicate:
+    parts = []
+    for name, condition in spec.items():
+        if name == "$and" or name == "$or":
+            if not isinstance(condition, list) or not condition:
+                raise ValueError(f"{name} expects a non-empty list of filters")
+            subs = [_compile_object(_expect_object(c, name)) for c in condition]
+            parts.append(_all(subs) if name == "$and" else _any(subs))
+        elif name == "$not":
+            inner = _compile_object(_expect_object(condition, name))
+            parts.append(lambda doc, inner=inner: not inner(doc))
+        elif name.startswith("$"):
+            raise ValueError(f"Unknown operator {name}")
+        else:
+            parts.append(_compile_field(name, condition))
+    if not parts:
+        return lambda doc: True
+    return parts[0] if len(parts) == 1 else _all(parts)
+
+
+def _expect_object(spec: Any, op: str) -> Dict[str, Any]:
+    if not isinstance(spec, dict):
+        raise ValueError(f"{op} expects filter objects")
+    return spec
+
+
+def _all(preds: List[Predicate]) -> Predicate:
+    if len(preds) == 1:
+        return preds[0]
+    return lambda doc: all(p(doc) for p in preds)
+
+
+def _any(preds: List[Predicate]) -> Predicate:
+    if len(preds) == 1:
+        return preds[0]
+    return lambda doc: any(p(doc) for p in preds)
+
+
+def _getter(path: str) -> Callable[[Any], Any]:
+    parts = path.split(".")
+    if len(parts) == 1:
+        return lambda doc: doc.get(path, _MISSING) if type(doc) is dict else _MISSING
+
+    def get(doc: Any) -> Any:
+        for part in parts:
+            if type(doc) is not dict:
+                return _MISSING
+            doc = doc.get(part, _MISSING)
+            if doc is _MISSING:
+                break
+        return doc
+
+    return get
+
+
+def _compile_field(path: str, condition: Any) -> Predicate:
+    get = _getter(path)
+    if not isinstance(condition, dict) or not any(k.startswith("$") for k in condition):
+        # plain value: equality
+        return lambda doc: get(doc) == condition
+    tests = [_compile_operator(op, arg) for op, arg in condition.items()]
+    test = tests[0] if len(tests) == 1 else (lambda v: all(t(v) for t in tests))
+    return lambda doc: test(get(doc))
+
+
+def _compile_operator(op: str, arg: Any) -> Callable[[Any], bool]:
+    if op == "$eq":
+        return lambda v: v == arg
+    if op == "$ne":
+        return lambda v: v != arg
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        if isinstance(arg, bool) or not isinstance(arg, (int, float, str)):
+            raise ValueError(f"{op} expects a number or a string")
+        compare = _COMPARISONS[op]
+
+        def ordered(v: Any) -> bool:
+            if v is _MISSING:
+                return False
+            try:
+                return compare(v, arg)
+            except TypeError:
+                return False
+
+        return ordered
+    if op in ("$in", "$nin"):
+        if not isinstance(arg, list):
+            raise ValueError(f"{op} expects a list")
+        try:
+            values: Any = frozenset(arg)
+        except TypeError:
+            values = list(arg)  # unhashable members (objects): linear search
+
+        def member(v: Any) -> bool:
+            try:
+                return v in values
+            except TypeError:
+                return False
+
+        if op == "$in":
+            return lambda v: v is not _MISSING and member(v)
+        return lambda v: v is _MISSING or not member(v)
+    if op == "$exists":
+        return (lambda v: v is not _MISSING) if arg else (lambda v: v is _MISSING)
+    raise ValueError(f"Unknown operator {op}")
+
+
+_COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "$gt": lambda a, b: a > b,
+    "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b,
+    "$lte": lambda a, b: a <= b,
+}
+
+
+def parse_filter(spec: Any) -> Optional[Filter]:
+    """``None`` for no filter, else the compiled filter (ValueError when malformed)."""
+    if spec is None:
+        return None
+    return compile_filter(spec)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# broker_metrics.py
+# Instrumentation for HomeworkBroker: plain integer counters and log-linear
+# (HDR-style) latency histograms, exported as a JSON snapshot (the "stats"
+# action) or as Prometheus text exposition over a small HTTP endpoint.
+#
+# Recording is an integer increment or one list slot update, so the hot path
+# stays cheap; percentiles are computed only when somebody asks for them.
+
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# 2**SUB_BUCKET_BITS buckets per power of two: values are kept with ~6% relative error
+SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+_LINEAR_LIMIT = 2 * _SUB_BUCKETS  # values below this get a bucket each
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# timed sections of the broker (nanoseconds)
+HISTOGRAMS = ("process_message", "publish_fanout", "purge_expired", "send_response", "lock_wait", "outbox_drain")
+# monotonically increasing counts
+COUNTERS = (
+    "connections_opened",
+    "connections_closed",
+    "messages_published",
+    "messages_delivered",
+    "messages_expired",
+    "outbox_queued",
+    "request_errors",
+    "publishes_rejected",
+    "auth_failures",
+    "publishes_deduplicated",
+    "messages_delayed",
+    "delayed_rejected",
+    "messages_dead_lettered",
+    "dead_letters_rejected",
+    "messages_discarded",
+)
+# counters/gauges reported per label value, and the name of that label
+LABELS = {"messages_dropped": "policy", "queue_depth": "topic"}
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _bucket_index(value: int) -> int:
+    if value < _LINEAR_LIMIT:
+        return value if value > 0 else 0
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def _bucket_value(index: int) -> int:
+    """Upper bound of the values that land in bucket ``index``."""
+    if index < _LINEAR_LIMIT:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = _SUB_BUCKETS + (index & (_SUB_BUCKETS - 1))
+    return ((mantissa + 1) << shift) - 1
+
+
+# enough buckets for any 64-bit value, so record() never has to grow the list
+_BUCKETS = _bucket_index((1 << 64) - 1) + 1
+
+
+class Histogram:
+    """
+    Log-linear histogram of non-negative integers (here: nanoseconds).
+
+    Small values are counted exactly; above that every power of two is split
+    into ``2**SUB_BUCKET_BITS`` buckets, so any quantile is off by at most one
+    bucket width (~6%). The bucket array is fixed, recording is one index
+    computation and three additions.
+    """
+
+    __slots__ = ("counts", "total", "max")
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * _BUCKETS
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        if value < _LINEAR_LIMIT:
+            self.counts[value if value > 0 else 0] += 1
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            self.counts[(shift << SUB_BUCKET_BITS) + (value >> shift)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, q: float) -> int:
+        """Smallest recorded bucket bound that covers fraction ``q`` of the values."""
+        count = self.count
+        if not count:
+            return 0
+        rank = max(1, int(q * count + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(_bucket_value(index), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        """Count, mean and quantiles in microseconds."""
+        count = self.count
+        result: Dict[str, Any] = {"count": count}
+        if count:
+            result["mean_us"] = round(self.total / count / 1000, 3)
+            for q in QUANTILES:
+                result[f"p{_quantile_label(q)}_us"] = round(self.percentile(q) / 1000, 3)
+            result["max_us"] = round(self.max / 1000, 3)
+        return result
+
+
+def _quantile_label(q: float) -> str:
+    # 0.5 -> "50", 0.99 -> "99", 0.999 -> "999"
+    return f"{q * 100:g}".replace(".", "")
+
+
+class Metrics:
+    """Counters and histograms of one broker; gauges are read from its state on demand."""
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = dict.fromkeys(COUNTERS, 0)
+        self.histograms: Dict[str, Histogram] = {name: Histogram() for name in HISTOGRAMS}
+
+    def observe(self, name: str, start_ns: int) -> None:
+        """Record the time elapsed since ``start_ns`` (a ``time.perf_counter_ns()`` reading)."""
+        # Histogram.record inlined: this runs several times per request
+        value = time.perf_counter_ns() - start_ns
+        h = self.histograms[name]
+        if value < _LINEAR_LIMIT:
+            h.counts[value if value > 0 else 0] += 1
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            h.counts[(shift << SUB_BUCKET_BITS) + (value >> shift)] += 1
+        h.total += value
+        if value > h.max:
+            h.max = value
+
+    def snapshot(self, gauges: Dict[str, Any], counters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """JSON-friendly view; ``counters`` adds counts the broker keeps elsewhere."""
+        merged: Dict[str, Any] = dict(self.counters)
+        if counters:
+            merged.update(counters)
+        return {
+            "counters": merged,
+            "gauges": gauges,
+            "latency": {name: h.summary() for name, h in self.histograms.items()},
+        }
+
+    def render(self, gauges: Dict[str, Any], counters: Optional[Dict[str, Any]] = None, prefix: str = "broker") -> str:
+        """Prometheus text exposition format; histograms are exported as summaries in seconds."""
+        lines: List[str] = []
+        merged: Dict[str, Any] = dict(self.counters)
+        if counters:
+            merged.update(counters)
+        for name, value in merged.items():
+            full = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {full} counter")
+            lines.extend(_samples(full, name, value))
+        for name, value in gauges.items():
+            full = f"{prefix}_{name}"
+            lines.append(f"# TYPE {full} gauge")
+            lines.extend(_samples(full, name, value))
+        for name, h in self.histograms.items():
+            full = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {full} summary")
+            for q in QUANTILES:
+                lines.append(f'{full}{{quantile="{q:g}"}} {h.percentile(q) / 1e9:.9f}')
+            lines.append(f"{full}_sum {h.total / 1e9:.9f}")
+            lines.append(f"{full}_count {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _samples(full: str, name: str, value: Any) -> List[str]:
+    if not isinstance(value, dict):
+        return [f"{full} {value}"]
+    label = LABELS.get(name, "key")
+    return [f'{full}{{{label}="{_escape(str(k))}"}} {v}' for k, v in sorted(value.items())]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+async def start_http_server(render: Callable[[], str], host: str = "127.0.0.1", port: int = 9100) -> asyncio.AbstractServer:
+    """Serve ``render()`` at GET /metrics (one request per connection)."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            # skip the headers, nothing in them matters here
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            head = (
+                f"HTTP/1.1 {status}\r\nContent-Type: {PROMETHEUS_CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            )
+            writer.write(head.encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
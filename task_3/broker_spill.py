@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# broker_spill.py
+# On-disk overflow for topic queues that pass their memory quota.
+#
+# Every (topic, priority) pair keeps a FIFO of spilled messages in append-only
+# segment files that use the WAL record framing:
+#   [body length: u32][crc32 of kind+body: u32][kind: u8][body]
+# A segment is deleted as soon as readers are past it. Spill files are scratch
+# space, not durability: the directory is emptied when a store is opened, and
+# durable topics are rebuilt from the write-ahead log instead.
+#
+# Writes go through a buffered file on the event loop (like WAL appends; spill
+# files are never fsynced). Reads are done ahead in a worker thread: after each
+# page-in the next SPILL_READ_AHEAD records of the level are read into memory,
+# so the following page-in usually finds them there. At most max_open FIFOs
+# keep files open; the least recently used one closes its files and reopens
+# them where it stopped when it is needed again.
+
+import asyncio
+import heapq
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from broker_wal import RECORD_HEADER, _codec_pair, msgpack
+
+SPILL = 1  # the only record kind in a spill segment
+DEFAULT_SPILL_SEGMENT_BYTES = 4 * 1024 * 1024
+# FIFOs (topic and priority pairs) with open files; each holds a reader and a writer
+DEFAULT_SPILL_OPEN_FIFOS = 128
+# records of a level read from disk in a worker thread before a page-in needs them
+SPILL_READ_AHEAD = 64
+
+
+def spill_segment_name(topic_key: int, priority: int, index: int) -> str:
+    return f"spill-{topic_key:06d}-{priority}-{index:06d}.seg"
+
+
+class SpillStore:
+    """Spill directory and disk budget shared by every topic of one broker."""
+
+    def __init__(
+        self,
+        directory: str,
+        limit: Optional[int] = None,
+        segment_bytes: int = DEFAULT_SPILL_SEGMENT_BYTES,
+        max_open: int = DEFAULT_SPILL_OPEN_FIFOS,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith("spill-") and name.endswith(".seg"):
+                os.remove(os.path.join(directory, name))
+        self.directory = directory
+        self.limit = limit  # bytes of unread records (None: only the file system limits it)
+        self.segment_bytes = segment_bytes
+        self.max_open = max_open
+        self.used = 0
+        self.messages = 0
+        self.written = 0  # messages ever spilled
+        codec = b"m" if msgpack is not None else b"j"
+        self.encode, self.decode = _codec_pair(codec)
+        self._next_key = 0
+        # FIFOs holding open files, least recently used first
+        self._open: "OrderedDict[_SpillFifo, None]" = OrderedDict()
+
+    def topic(self) -> "TopicSpill":
+        self._next_key += 1
+        return TopicSpill(self, self._next_key)
+
+    def opened(self, fifo: "_SpillFifo") -> None:
+        """Mark ``fifo`` as the latest user of open files; the least recent one beyond ``max_open`` closes its own."""
+        self._open[fifo] = None
+        self._open.move_to_end(fifo)
+        if len(self._open) > self.max_open:
+            for other in self._open:
+                # a FIFO busy reading ahead is skipped
+                if other is not fifo and other.close_files():
+                    break
+
+    def open_files(self) -> int:
+        return sum(f.open_files() for f in self._open)
+
+
+class TopicSpill:
+    """Spilled messages of one topic: a FIFO per priority level."""
+
+    def __init__(self, store: SpillStore, key: int) -> None:
+        self.store = store
+        self.key = key
+        self.fifos: Dict[int, _SpillFifo] = {}
+        self.total = 0
+
+    def count(self, priority: int) -> int:
+        """Records of a level on disk, expired ones included: while there are any, new ones queue behind them."""
+        fifo = self.fifos.get(priority)
+        return fifo.count if fifo is not None else 0
+
+    def live(self) -> int:
+        """Records on disk that have not expired (expired ones are dropped when read back)."""
+        if not self.total:
+            return 0
+        now = time.time()
+        return self.total - sum(fifo.expire(now) for fifo in self.fifos.values())
+
+    def average_size(self, priority: int) -> float:
+        """Mean bytes on disk of the unread records of a level (0 when it is empty)."""
+        fifo = self.fifos.get(priority)
+        return fifo.unread / fifo.count if fifo is not None and fifo.count else 0.0
+
+    def first_priority(self) -> Optional[int]:
+        """Most urgent priority level that has messages on disk."""
+        levels = [p for p, fifo in self.fifos.items() if fifo.count]
+        return min(levels) if levels else None
+
+    def append(self, priority: int, record: Dict[str, Any]) -> bool:
+        """Write one record at the tail of its priority level; False when the disk budget is used up."""
+        body = self.store.encode(record)
+        crc = zlib.crc32(body, zlib.crc32(bytes((SPILL,))))
+        data = RECORD_HEADER.pack(len(body), crc, SPILL) + body
+        store = self.store
+        if store.limit is not None and store.used + len(data) > store.limit:
+            return False
+        fifo = self.fifos.get(priority)
+        if fifo is None:
+            fifo = self.fifos[priority] = _SpillFifo(self, priority)
+        fifo.write(data, record.get("e"))
+        store.used += len(data)
+        store.messages += 1
+        store.written += 1
+        self.total += 1
+        return True
+
+    def read(self, priority: int, limit: int) -> List[Dict[str, Any]]:
+        """Take up to ``limit`` records from the head of a priority level."""
+        fifo = self.fifos.get(priority)
+        if fifo is None:
+            return []
+        records = []
+        store = self.store
+        for size, body in fifo.take(limit):
+            records.append(store.decode(body))
+            store.used -= size
+        store.messages -= len(records)
+        self.total -= len(records)
+        if fifo.count:
+            fifo.read_ahead()
+        return records
+
+    def scan(self) -> Iterator[Dict[str, Any]]:
+        """Every unread record, without consuming anything (for snapshots)."""
+        for priority in sorted(self.fifos):
+            for body in self.fifos[priority].peek():
+                yield self.store.decode(body)
+
+    def clear(self) -> None:
+        for fifo in self.fifos.values():
+            self.store.used -= fifo.unread
+            self.store.messages -= fifo.count
+            fifo.remove()
+        self.fifos.clear()
+        self.total = 0
+
+
+class _SpillFifo:
+    """
+    Append-only segments of one priority level, read from the front.
+
+    Records go through a buffered file object that is flushed before each read.
+    Records read ahead wait in ``ahead`` and still count as unread. The reader
+    state (``_reader``, ``_position``, ``segments[0]``, ``ahead``) belongs to
+    whoever holds ``_lock``: the event loop or a read-ahead in a worker thread.
+    When the FIFO runs empty all of its files are removed, so a drained topic
+    holds no disk space.
+    """
+
+    def __init__(self, owner: TopicSpill, priority: int) -> None:
+        self.owner = owner
+        self.priority = priority
+        self.segments: Deque[str] = deque()
+        self.count = 0
+        self.unread = 0  # bytes of records not read yet
+        self.ahead: Deque[Tuple[int, bytes]] = deque()
+        self._index = 0
+        self._writer = None
+        self._written = 0  # bytes in the segment being written
+        self._reader = None  # open file of segments[0]
+        self._position = 0  # offset of the next record in segments[0] not read yet
+        self._lock = threading.Lock()
+        self._reading: Optional[asyncio.Future] = None
+        self._peeking = 0  # scans in progress: no read-ahead may delete the segments they walk
+        # records are numbered in order; (expires wall time, number) of the unread ones with a TTL
+        self._written_no = 0
+        self._read_no = 0
+        self._deadlines: List[Tuple[float, int]] = []
+        self._expired: Set[int] = set()  # numbers of unread records known to have expired
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.owner.store.directory, spill_segment_name(self.owner.key, self.priority, index))
+
+    def open_files(self) -> int:
+        return (self._reader is not None) + (self._writer is not None)
+
+    def close_files(self) -> bool:
+        """Close the files until they are needed again; False while a read-ahead holds them."""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            for f in (self._reader, self._writer):
+                if f is not None:
+                    f.close()
+            self._reader = self._writer = None
+            self.owner.store._open.pop(self, None)
+        finally:
+            self._lock.release()
+        return True
+
+    def write(self, data: bytes, expires: Optional[float] = None) -> None:
+        if self._writer is None or self._written >= self.owner.store.segment_bytes:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if not self.segments or self._written >= self.owner.store.segment_bytes:
+                self._index += 1
+                self._written = 0
+                self._writer = open(self._path(self._index), "wb")
+                # only once the previous segment is complete on disk may a reader move past it
+                self.segments.append(self._path(self._index))
+            else:
+                # reopened after close_files()
+                self._writer = open(self._path(self._index), "ab")
+            self.owner.store.opened(self)
+        self._writer.write(data)
+        self._written += len(data)
+        if expires is not None:
+            heapq.heappush(self._deadlines, (expires, self._written_no))
+        self._written_no += 1
+        self.count += 1
+        self.unread += len(data)
+
+    def expire(self, now: float) -> int:
+        """How many unread records have expired by ``now`` (wall clock)."""
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, number = heapq.heappop(deadlines)
+            if number >= self._read_no:
+                self._expired.add(number)
+        return len(self._expired)
+
+    def _open_reader(self) -> None:
+        self._reader = open(self.segments[0], "rb")
+        self._reader.seek(self._position)
+
+    def _read(self, limit: int) -> List[Tuple[int, bytes]]:
+        """Up to ``limit`` complete records from the files; the caller holds ``_lock``."""
+        out: List[Tuple[int, bytes]] = []
+        while len(out) < limit and self.segments:
+            if self._reader is None:
+                self._open_reader()
+            # a segment followed by another one is complete on disk; the last one may still be written
+            sealed = len(self.segments) > 1
+            header = self._reader.read(RECORD_HEADER.size)
+            if len(header) == RECORD_HEADER.size:
+                length, _, _ = RECORD_HEADER.unpack(header)
+                body = self._reader.read(length)
+                if len(body) == length:
+                    self._position += RECORD_HEADER.size + length
+                    out.append((RECORD_HEADER.size + length, body))
+                    continue
+            if not sealed:
+                # the end of what the writer has flushed so far
+                self._reader.seek(self._position)
+                break
+            # past the end of a sealed segment: it is no longer needed
+            self._reader.close()
+            self._reader = None
+            self._position = 0
+            os.remove(self.segments.popleft())
+        return out
+
+    def take(self, limit: int) -> List[tuple]:
+        """Up to ``limit`` (framed size, body) pairs from the front."""
+        out = []
+        if self._writer is not None:
+            self._writer.flush()
+        with self._lock:
+            ahead = self.ahead
+            while ahead and len(out) < limit:
+                out.append(ahead.popleft())
+            if len(out) < limit and self.count > len(out):
+                if self._reader is None:
+                    self.owner.store.opened(self)
+                out.extend(self._read(min(limit, self.count) - len(out)))
+        for size, _ in out:
+            self._expired.discard(self._read_no)
+            self._read_no += 1
+            self.count -= 1
+            self.unread -= size
+        # entries of records read back stay in the heap until due; rebuild once they dominate
+        if len(self._deadlines) > 2 * self.count + 64:
+            self._deadlines = [e for e in self._deadlines if e[1] >= self._read_no]
+            heapq.heapify(self._deadlines)
+        if not self.count:
+            self.remove()
+        return out
+
+    def read_ahead(self) -> None:
+        """Read the next SPILL_READ_AHEAD records in a worker thread, when there is an event loop."""
+        if self._reading is not None or len(self.ahead) >= min(self.count, SPILL_READ_AHEAD):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._writer is not None:
+            self._writer.flush()
+        if self._reader is None:
+            # files are opened on the loop, where the open-file bound is kept
+            self.owner.store.opened(self)
+            self._open_reader()
+        self._reading = loop.run_in_executor(None, self._read_ahead, min(self.count, SPILL_READ_AHEAD))
+        self._reading.add_done_callback(self._read_ahead_done)
+
+    def _read_ahead(self, limit: int) -> None:
+        with self._lock:
+            if self._reader is None or self._peeking:
+                return  # closed or removed meanwhile, or being scanned
+            try:
+                self.ahead.extend(self._read(limit - len(self.ahead)))
+            except (OSError, ValueError):
+                pass  # files removed or closed meanwhile; take() reads on the loop instead
+
+    def _read_ahead_done(self, future: asyncio.Future) -> None:
+        self._reading = None
+
+    def peek(self) -> Iterator[bytes]:
+        if self._writer is not None:
+            self._writer.flush()
+        with self._lock:
+            self._peeking += 1
+            bodies = [body for _, body in self.ahead]
+            position, segments = self._position, list(self.segments)
+        try:
+            yield from bodies
+            for i, path in enumerate(segments):
+                with open(path, "rb") as f:
+                    if i == 0:
+                        f.seek(position)
+                    while True:
+                        header = f.read(RECORD_HEADER.size)
+                        if len(header) < RECORD_HEADER.size:
+                            break
+                        length, _, _ = RECORD_HEADER.unpack(header)
+                        yield f.read(length)
+        finally:
+            self._peeking -= 1
+
+    def remove(self) -> None:
+        with self._lock:
+            for f in (self._reader, self._writer):
+                if f is not None:
+                    f.close()
+            self._reader = self._writer = None
+            self._written = 0
+            self._position = 0
+            for path in self.segments:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.segments.clear()
+            self.ahead.clear()
+        self.owner.store._open.pop(self, None)
+        self.count = 0
+        self.unread = 0
+        self._read_no = self._written_no
+        self._deadlines.clear()
+        self._expired.clear()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# broker_timers.py
+# Hierarchical timing wheel for delayed message delivery.
+#
+# Time is counted in ticks of TIMER_TICK seconds. Level k of the wheel has
+# TIMER_SLOTS slots of TIMER_SLOTS**k ticks each, so four levels of 256 slots
+# at 10 ms cover about 497 days; later deadlines wait in the last level and
+# are placed again each time it comes round (also when that level is level 0,
+# so a timer is only fired once its own tick is reached). A timer goes into the coarsest
+# level its distance needs: one append to a list, whatever the number of
+# pending timers. Advancing the wheel empties one level-0 slot per tick; when
+# a level wraps, the next level's current slot is "cascaded", i.e. its timers
+# are placed again, now into finer levels. Each timer is moved at most once
+# per level, so expiry costs O(1) amortized as well.
+
+import math
+import time
+from typing import Any, List, Optional, Tuple
+
+TIMER_TICK = 0.01
+TIMER_SLOT_BITS = 8
+TIMER_SLOTS = 1 << TIMER_SLOT_BITS
+TIMER_LEVELS = 4
+
+
+class TimingWheel:
+    """Pending items keyed by a monotonic deadline; ``advance()`` returns the ones that are due."""
+
+    def __init__(self, tick: float = TIMER_TICK, levels: int = TIMER_LEVELS, start: Optional[float] = None) -> None:
+        self.tick = tick
+        self.levels = levels
+        self._origin = time.monotonic() if start is None else start
+        # ticks since origin that advance() has handled
+        self._now = 0
+        # level -> slot -> [(due tick, item), ...]
+        self._wheels: List[List[List[Tuple[int, Any]]]] = [[[] for _ in range(TIMER_SLOTS)] for _ in range(levels)]
+        self._count = 0
+        # timers per level: while the finer levels are empty, advance() skips to the next cascade
+        self._sizes = [0] * levels
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(self, deadline: float, item: Any) -> None:
+        """Hold ``item`` until ``deadline`` (time.monotonic() seconds); a past deadline is due on the next tick."""
+        # rounded up: a timer may fire up to a tick late, never early
+        due = math.ceil((deadline - self._origin) / self.tick)
+        self._place(max(due, self._now + 1), item)
+        self._count += 1
+
+    def _place(self, due: int, item: Any) -> None:
+        # the coarsest level whose slots are no longer than the distance
+        level = (((due - self._now) | 1).bit_length() - 1) // TIMER_SLOT_BITS
+        if level < self.levels:
+            slot = (due >> (TIMER_SLOT_BITS * level)) & (TIMER_SLOTS - 1)
+        else:
+            # beyond the last level: park in its farthest slot, placed again when that comes round
+            level = self.levels - 1
+            slot = ((self._now >> (TIMER_SLOT_BITS * level)) - 1) & (TIMER_SLOTS - 1)
+        self._wheels[level][slot].append((due, item))
+        self._sizes[level] += 1
+
+    def advance(self, now: Optional[float] = None) -> List[Any]:
+        """Move the wheel to ``now`` and return the items that became due, earliest tick first."""
+        now = time.monotonic() if now is None else now
+        target = int((now - self._origin) / self.tick)
+        if self._count == 0:
+            self._now = max(self._now, target)
+            return []
+        due: List[Any] = []
+        mask = TIMER_SLOTS - 1
+        level0 = self._wheels[0]
+        sizes = self._sizes
+        while self._now < target and self._count:
+            lowest = 0
+            while not sizes[lowest]:
+                lowest += 1
+            if lowest:
+                # nothing fires before level ``lowest`` next wraps
+                shift = TIMER_SLOT_BITS * lowest
+                self._now = min(target - 1, (((self._now >> shift) + 1) << shift) - 1)
+            self._now += 1
+            tick = self._now
+            # wrapped levels first, so their timers due at this tick land in the slot emptied below
+            level = 1
+            while level < self.levels and not tick & ((1 << (TIMER_SLOT_BITS * level)) - 1):
+                self._cascade(level, (tick >> (TIMER_SLOT_BITS * level)) & mask)
+                level += 1
+            slot = level0[tick & mask]
+            if slot:
+                level0[tick & mask] = []
+                sizes[0] -= len(slot)
+                for when, item in slot:
+                    if when > tick:
+                        # parked here from beyond the last level (a wheel of one level): not due yet
+                        self._place(when, item)
+                    else:
+                        due.append(item)
+                        self._count -= 1
+        if not self._count:
+            self._now = max(self._now, target)
+        return due
+
+    def _cascade(self, level: int, index: int) -> None:
+        slot = self._wheels[level][index]
+        if slot:
+            self._wheels[level][index] = []
+            self._sizes[level] -= len(slot)
+            for due, item in slot:
+                self._place(due, item)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# broker_trie.py
+# Hierarchical topic patterns for HomeworkBroker subscriptions.
+# Topic names are dot-separated levels ("orders.eu.created"); in a pattern
+# "*" matches exactly one level and "#" matches zero or more levels:
+#   orders.*      -> orders.eu, orders.us            (not orders, orders.eu.created)
+#   metrics.#     -> metrics, metrics.cpu, metrics.cpu.host1
+#   *.errors.#    -> api.errors, db.errors.timeout
+
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+SEPARATOR = "."
+ONE_LEVEL = "*"
+ANY_LEVELS = "#"
+# concrete topics remembered by match(); the cache starts over when full
+MATCH_CACHE_SIZE = 10000
+
+
+def is_pattern(topic: str) -> bool:
+    """True when some level of the name is a wildcard."""
+    if ONE_LEVEL not in topic and ANY_LEVELS not in topic:
+        return False
+    return any(level in (ONE_LEVEL, ANY_LEVELS) for level in topic.split(SEPARATOR))
+
+
+def matches(pattern: str, topic: str) -> bool:
+    """Whether one pattern matches one concrete topic."""
+    trie = TopicTrie()
+    trie.add(pattern, None)
+    return bool(trie.match(topic))
+
+
+class _Node:
+    __slots__ = ("children", "subscriptions")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        # key -> value of subscriptions whose pattern ends at this node
+        self.subscriptions: Dict[Hashable, Any] = {}
+
+
+class TopicTrie:
+    """
+    Pattern subscriptions indexed level by level.
+
+    ``match(topic)`` walks only the branches the topic's levels (and the
+    wildcards) lead to, so its cost depends on the topic depth rather than on
+    the number of subscriptions. Results are cached per concrete topic; any
+    add/remove drops the cache.
+    """
+
+    def __init__(self) -> None:
+        self._root = _Node()
+        self._cache: Dict[str, Tuple[Tuple[Hashable, Any], ...]] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, pattern: str, key: Hashable, value: Any = None) -> None:
+        node = self._root
+        for level in pattern.split(SEPARATOR):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _Node()
+            node = child
+        if key not in node.subscriptions:
+            self._size += 1
+        node.subscriptions[key] = value
+        self._cache.clear()
+
+    def remove(self, pattern: str, key: Hashable) -> bool:
+        path: List[Tuple[_Node, str]] = []
+        node: Optional[_Node] = self._root
+        for level in pattern.split(SEPARATOR):
+            path.append((node, level))
+            node = node.children.get(level)
+            if node is None:
+                return False
+        if key not in node.subscriptions:
+            return False
+        del node.subscriptions[key]
+        self._size -= 1
+        # prune branches that no longer lead to a subscription
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.children or child.subscriptions:
+                break
+            del parent.children[level]
+        self._cache.clear()
+        return True
+
+    def match(self, topic: str) -> Tuple[Tuple[Hashable, Any], ...]:
+        """``(key, value)`` of every subscription whose pattern matches ``topic``."""
+        cached = self._cache.get(topic)
+        if cached is not None:
+            return cached
+        found: Dict[Hashable, Any] = {}
+        if self._size:
+            self._walk(self._root, topic.split(SEPARATOR), 0, found)
+        result = tuple(found.items())
+        if len(self._cache) >= MATCH_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[topic] = result
+        return result
+
+    def _walk(self, node: _Node, levels: List[str], i: int, found: Dict[Hashable, Any]) -> None:
+        hash_node = node.children.get(ANY_LEVELS)
+        if hash_node is not None:
+            # "#" swallows levels[i:j] for every j, including nothing
+            for j in range(i, len(levels) + 1):
+                self._walk(hash_node, levels, j, found)
+        if i == len(levels):
+            found.update(node.subscriptions)
+            return
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._walk(child, levels, i + 1, found)
+        star = node.children.get(ONE_LEVEL)
+        if star is not None:
+            self._walk(star, levels, i + 1, found)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# broker_wal.py
+# Append-only, segmented, CRC-checked write-ahead log for durable broker topics.
+#
+# Segment file: SEGMENT_MAGIC + version byte + codec byte, then records:
+#   [body length: u32][crc32 of kind+body: u32][kind: u8][body]
+# Bodies are msgpack when available, JSON otherwise (the codec is per segment).
+
+import asyncio
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:  # optional: more compact records and native bytes payloads
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the environment
+    msgpack = None
+
+
+SEGMENT_MAGIC = b"BWAL"
+SEGMENT_VERSION = 1
+SEGMENT_HEADER_SIZE = len(SEGMENT_MAGIC) + 2
+RECORD_HEADER = struct.Struct("!IIB")
+
+# record kinds
+PUT = 1  # {"t": topic, "s": seq, "p": priority, "c": created_ts, "e": expires_epoch|None, "d": payload}
+DELETE = 2  # {"t": topic, "s": seq}
+CLEAR = 3  # {"t": topic, "s": last seq}: every message of the topic up to s is gone
+CONFIG = 4  # {"t": topic, "credential": ..., "overflow": ..., "durable": bool, "dead_letter": ..., "max_attempts": ...}
+
+FSYNC_POLICIES = ("always", "interval", "never")
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 0.05
+# sealed segments to accumulate before they are compacted into one
+DEFAULT_COMPACT_AFTER = 4
+
+
+class WALCorruption(Exception):
+    """A segment header is unreadable; records after a bad CRC are treated as a torn tail instead."""
+
+
+def _codec_pair(codec: bytes) -> Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]:
+    if codec == b"m":
+        if msgpack is None:
+            raise WALCorruption("Segment was written with msgpack, which is not installed")
+        return (lambda obj: msgpack.packb(obj, use_bin_type=True)), (lambda data: msgpack.unpackb(data, raw=False))
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    return (lambda obj: encoder.encode(obj).encode("utf-8")), json.loads
+
+
+def segment_name(index: int) -> str:
+    return f"wal-{index:08d}.log"
+
+
+# a finished compaction waiting to replace its input segments (see WriteAheadLog.compact)
+COMPACTED_SUFFIX = ".compacted"
+
+
+def _fsync_dir(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_segment(path: str) -> Tuple[List[Tuple[int, Dict[str, Any]]], int]:
+    """
+    Read every intact record of a segment through mmap.
+
+    Returns (records, valid_length). Reading stops at the first truncated or
+    CRC-mismatching record, which is what a crash in the middle of a write leaves.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < SEGMENT_HEADER_SIZE:
+            return [], 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[: len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                raise WALCorruption(f"{path}: not a WAL segment")
+            _, decode = _codec_pair(mm[len(SEGMENT_MAGIC) + 1 : SEGMENT_HEADER_SIZE])
+            records = []
+            pos = SEGMENT_HEADER_SIZE
+            while pos + RECORD_HEADER.size <= size:
+                length, crc, kind = RECORD_HEADER.unpack_from(mm, pos)
+                start = pos + RECORD_HEADER.size
+                end = start + length
+                if end > size:
+                    break
+                body = mm[start:end]
+                if zlib.crc32(body, zlib.crc32(bytes((kind,)))) != crc:
+                    break
+                try:
+                    records.append((kind, decode(body)))
+                except ValueError:
+                    break
+                pos = end
+            return records, pos
+
+
+class WriteAheadLog:
+    """
+    Segmented append-only log with group commit.
+
+    ``append`` only buffers the encoded record; everything appended during one
+    event-loop iteration is written with a single ``write`` and, under the
+    ``always`` policy, made durable with a single ``fsync`` in a worker thread.
+    Records appended while that fsync runs form the next group.
+
+    fsync policies:
+    - ``always``   -- append returns a future resolved once the record is on disk
+    - ``interval`` -- records are written right away, fsync at most every ``fsync_interval`` s
+    - ``never``    -- records are written right away, the OS decides when to flush
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync: str = "always",
+        segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+        fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+        compact_after: int = DEFAULT_COMPACT_AFTER,
+    ) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}'")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+        self.codec = b"m" if msgpack is not None else b"j"
+        self._encode, _ = _codec_pair(self.codec)
+
+        self._buffer: List[bytes] = []
+        self._waiters: List[asyncio.Future] = []
+        self._flush_scheduled = False
+        self._syncing = False
+        self._dirty = False
+        self._sync_timer: Optional[asyncio.TimerHandle] = None
+        self._compacting: Optional[asyncio.Future] = None
+        self._file = None
+        self._size = 0
+        self._active_index = 0
+
+    # ---------------- Segments ----------------
+
+    def segments(self) -> List[int]:
+        indexes = []
+        for name in os.listdir(self.directory):
+            if name.startswith("wal-") and name.endswith(".log"):
+                indexes.append(int(name[4:-4]))
+        return sorted(indexes)
+
+    def _path(self, index: int) -> str:
+        return os.path.join(self.directory, segment_name(index))
+
+    def _open_segment(self, index: int) -> None:
+        self._active_index = index
+        self._file = open(self._path(index), "ab")
+        header = SEGMENT_MAGIC + bytes((SEGMENT_VERSION,)) + self.codec
+        self._file.write(header)
+        self._file.flush()
+        self._size = len(header)
+
+    def _rotate(self) -> None:
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._open_segment(self._active_index + 1)
+        self._maybe_compact()
+
+    # ---------------- Recovery ----------------
+
+    def recover(self) -> Tuple[Dict[str, Dict[str, Any]], List[Dict[str, Any]], int]:
+        """
+        Stream all segments and return (topic configs, live PUT records by seq, max seq).
+
+        A torn tail of the newest segment is truncated. New appends always go to a
+        fresh segment, so recovered segments are never written to again.
+        """
+        self._finish_compaction()
+        configs: Dict[str, Dict[str, Any]] = {}
+        puts: Dict[int, Dict[str, Any]] = {}
+        max_seq = 0
+        indexes = self.segments()
+        for i, index in enumerate(indexes):
+            path = self._path(index)
+            records, valid = read_segment(path)
+            if i == len(indexes) - 1 and valid < os.path.getsize(path):
+                with open(path, "r+b") as f:
+                    f.truncate(max(valid, 0))
+            for kind, rec in records:
+                seq = rec.get("s", 0)
+                max_seq = max(max_seq, seq)
+                if kind == PUT:
+                    puts[seq] = rec
+                elif kind == DELETE:
+                    puts.pop(seq, None)
+                elif kind == CLEAR:
+                    for s in [s for s, r in puts.items() if r["t"] == rec["t"] and s <= seq]:
+                        del puts[s]
+                elif kind == CONFIG:
+                    configs[rec["t"]] = rec
+        self._open_segment((indexes[-1] + 1) if indexes else 1)
+        return configs, [puts[s] for s in sorted(puts)], max_seq
+
+    # ---------------- Appending ----------------
+
+    def append(self, kind: int, record: Dict[str, Any]) -> Optional[asyncio.Future]:
+        """Buffer one record; returns a future for the fsync under the ``always`` policy."""
+        if self._file is None:
+            self._open_segment((self.segments() or [0])[-1] + 1)
+        body = self._encode(record)
+        crc = zlib.crc32(body, zlib.crc32(bytes((kind,))))
+        self._buffer.append(RECORD_HEADER.pack(len(body), crc, kind) + body)
+        loop = asyncio.get_running_loop()
+        waiter = None
+        if self.fsync == "always":
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+        if not self._flush_scheduled and not self._syncing:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return waiter
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        if self._syncing or not self._buffer:
+            return
+        if self._size >= self.segment_bytes:
+            self._rotate()
+        data = b"".join(self._buffer)
+        waiters = self._waiters
+        self._buffer = []
+        self._waiters = []
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        if self.fsync == "always":
+            self._syncing = True
+            loop = asyncio.get_running_loop()
+            done = loop.run_in_executor(None, os.fsync, self._file.fileno())
+            done.add_done_callback(lambda f: self._synced(f, waiters))
+        elif self.fsync == "interval":
+            self._dirty = True
+            if self._sync_timer is None:
+                self._sync_timer = asyncio.get_running_loop().call_later(self.fsync_interval, self._interval_sync)
+
+    def _synced(self, result: asyncio.Future, waiters: List[asyncio.Future]) -> None:
+        self._syncing = False
+        error = result.exception()
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(None)
+        if self._buffer and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _interval_sync(self) -> None:
+        self._sync_timer = None
+        if self._dirty and self._file is not None:
+            self._dirty = False
+            asyncio.get_running_loop().run_in_executor(None, os.fsync, self._file.fileno())
+
+    def flush_sync(self) -> None:
+        """Write and fsync everything buffered, blocking; used on shutdown."""
+        if self._file is None:
+            return
+        if self._buffer:
+            self._file.write(b"".join(self._buffer))
+            self._buffer = []
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters = []
+
+    async def close(self) -> None:
+        while self._syncing or self._flush_scheduled:
+            await asyncio.sleep(0)
+        if self._compacting is not None:
+            await self._compacting
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        self.flush_sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # ---------------- Compaction ----------------
+
+    def _maybe_compact(self) -> None:
+        sealed = [i for i in self.segments() if i < self._active_index]
+        if len(sealed) < self.compact_after or self._compacting is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.compact(sealed)
+            return
+        self._compacting = loop.run_in_executor(None, self.compact, sealed)
+        self._compacting.add_done_callback(lambda _: setattr(self, "_compacting", None))
+
+    def compact(self, sealed: List[int]) -> None:
+        """
+        Rewrite sealed segments into one that holds only live messages and the last
+        config of each topic. Deletes found in newer segments are applied too.
+        The result is fsynced and renamed to ``<newest sealed>.compacted``, which
+        marks it complete; then every input is removed and the result takes the
+        newest one's name. Until the inputs are gone they keep their tombstones,
+        and a crash after the marker is finished by recovery (_finish_compaction),
+        so deleted messages never come back.
+        """
+        if not sealed:
+            return
+        deleted = set()
+        cleared: Dict[str, int] = {}
+        for index in [i for i in self.segments() if i >= sealed[0]]:
+            try:
+                records, _ = read_segment(self._path(index))
+            except (OSError, WALCorruption):
+                continue
+            for kind, rec in records:
+                if kind == DELETE:
+                    deleted.add(rec["s"])
+                elif kind == CLEAR:
+                    cleared[rec["t"]] = max(cleared.get(rec["t"], 0), rec["s"])
+
+        configs: Dict[str, Dict[str, Any]] = {}
+        live: Dict[int, Dict[str, Any]] = {}
+        for index in sealed:
+            records, _ = read_segment(self._path(index))
+            for kind, rec in records:
+                if kind == PUT:
+                    seq = rec["s"]
+                    if seq not in deleted and seq > cleared.get(rec["t"], 0):
+                        live[seq] = rec
+                elif kind == CONFIG:
+                    configs[rec["t"]] = rec
+
+        target = self._path(sealed[-1])
+        tmp = target + ".compact"
+        with open(tmp, "wb") as f:
+            f.write(SEGMENT_MAGIC + bytes((SEGMENT_VERSION,)) + self.codec)
+            for kind, rec in [(CONFIG, c) for c in configs.values()] + [(PUT, live[s]) for s in sorted(live)]:
+                body = self._encode(rec)
+                f.write(RECORD_HEADER.pack(len(body), zlib.crc32(body, zlib.crc32(bytes((kind,)))), kind) + body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target + COMPACTED_SUFFIX)
+        _fsync_dir(self.directory)
+        self._install_compacted(sealed[-1])
+
+    def _install_compacted(self, index: int) -> None:
+        """Replace every segment up to ``index`` with the completed compaction output."""
+        for old in self.segments():
+            if old <= index:
+                os.remove(self._path(old))
+        os.replace(self._path(index) + COMPACTED_SUFFIX, self._path(index))
+        _fsync_dir(self.directory)
+
+    def _finish_compaction(self) -> None:
+        """Complete a compaction a crash interrupted, or drop one that never finished writing."""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.startswith("wal-"):
+                continue
+            if name.endswith(".log.compact"):
+                os.remove(os.path.join(self.directory, name))
+            elif name.endswith(".log" + COMPACTED_SUFFIX):
+                self._install_compacted(int(name[4:-len(".log" + COMPACTED_SUFFIX)]))
+
+
+def put_record(topic: str, seq: int, prio: int, created: float, expires: Optional[float], data: Any) -> Dict[str, Any]:
+    return {"t": topic, "s": seq, "p": prio, "c": created, "e": expires, "d": data}
+
+
+def remaining_ttl(record: Dict[str, Any], now: Optional[float] = None) -> Optional[float]:
+    """Seconds a recovered message still has to live (None: no TTL)."""
+    expires = record.get("e")
+    if expires is None:
+        return None
+    return expires - (time.time() if now is None else now)
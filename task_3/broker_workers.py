@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+# broker_workers.py
+# Multi-process HomeworkBroker: N worker processes share one TCP port through
+# SO_REUSEPORT, every topic is owned by exactly one worker (crc32(topic) % N),
+# and requests for topics owned elsewhere are forwarded over Unix-socket links.
+#
+# Link frames (length-prefixed, msgpack or JSON bodies):
+#   {"op": "call", "rid": int, "client": int, "msg": {...}}   worker -> owner
+#   {"op": "reply", "rid": int, "responses": [{...}, ...]}    owner -> worker
+#   {"op": "push", "client": int, "obj": {...}}               owner -> worker (messages, deliveries)
+#   {"op": "gone", "client": int}                             worker -> owner (client disconnected)
+#   {"op": "close", "client": int}                            owner -> worker (disconnect the client)
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+import tempfile
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from broker_compress import COMPRESSION_MIN_SIZE, DEFAULT_DICTIONARY
+from broker_metrics import start_http_server
+from broker_trie import is_pattern
+from homework_broker import (
+    READ_CHUNK_SIZE,
+    HomeworkBroker,
+    _FramedProtocol,
+    _TopicState,
+    _NLJSONProtocol,
+    _message_envelope,
+    split_frames,
+    start_broker_server,
+    use_event_loop,
+)
+
+LINK_PROTOCOL = _FramedProtocol.negotiate(b"m")
+LINK_CONNECT_TIMEOUT = 10.0
+
+
+class _LinkProtocol:
+    """Pass-through wire protocol for clients of other workers: objects travel as-is inside link frames."""
+
+    name = "link"
+    decode_error = "Invalid link message"
+
+    @staticmethod
+    def encode(obj: Dict[str, Any]) -> Dict[str, Any]:
+        return obj
+
+    @staticmethod
+    def encode_message(
+        topic: str, payload: Any, priority: str, expires_at: Optional[str], offset: Optional[int] = None
+    ) -> Dict[str, Any]:
+        return _message_envelope(topic, payload, priority, expires_at, offset)
+
+
+class _Collector:
+    """Writer that keeps the response objects written to it."""
+
+    def __init__(self) -> None:
+        self.objects: List[Dict[str, Any]] = []
+
+    def write(self, obj: Dict[str, Any]) -> None:
+        self.objects.append(obj)
+
+    def writelines(self, objs: List[Dict[str, Any]]) -> None:
+        self.objects.extend(objs)
+
+    async def drain(self) -> None:
+        pass
+
+    def get_extra_info(self, name: str) -> None:
+        return None
+
+    def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class _RemoteWriter(_Collector):
+    """Stand-in on the owning worker for a client connected to another worker."""
+
+    def __init__(self, link_writer: asyncio.StreamWriter, client: int) -> None:
+        super().__init__()
+        self.link_writer = link_writer
+        self.client = client
+        self.closed = False
+
+    def write(self, obj: Dict[str, Any]) -> None:
+        self.link_writer.write(LINK_PROTOCOL.encode({"op": "push", "client": self.client, "obj": obj}))
+
+    def writelines(self, objs: List[Dict[str, Any]]) -> None:
+        self.link_writer.writelines(
+            [LINK_PROTOCOL.encode({"op": "push", "client": self.client, "obj": obj}) for obj in objs]
+        )
+
+    async def drain(self) -> None:
+        await self.link_writer.drain()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.link_writer.write(LINK_PROTOCOL.encode({"op": "close", "client": self.client}))
+
+
+class _PeerLink:
+    """Outgoing link from this worker to the owner of some topics."""
+
+    def __init__(self, broker: "ShardedBroker", peer: int) -> None:
+        self.broker = broker
+        self.peer = peer
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self._rids = itertools.count(1)
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connecting: Optional[asyncio.Future] = None
+
+    async def connect(self) -> None:
+        if self.writer is not None:
+            return
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+            self._connecting.add_done_callback(self._connect_done)
+        await asyncio.shield(self._connecting)
+
+    def _connect_done(self, future: asyncio.Future) -> None:
+        self._connecting = None
+        if not future.cancelled():
+            future.exception()  # retrieved here too: the callers may have stopped waiting
+
+    async def _connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.broker.link_connect_timeout
+        while True:
+            try:
+                reader, writer = await self.broker.open_link(self.peer)
+                break
+            except OSError:
+                # the peer process may still be starting
+                if loop.time() > deadline:
+                    raise ConnectionError(f"Worker {self.peer} is unavailable")
+                await asyncio.sleep(0.05)
+        self.writer = writer
+        self._reader_task = asyncio.create_task(self._read_loop(reader))
+
+    def send(self, frame: Dict[str, Any]) -> None:
+        if self.writer is not None:
+            self.writer.write(LINK_PROTOCOL.encode(frame))
+
+    async def request(self, frame: Dict[str, Any]) -> Dict[str, Any]:
+        """Send a frame with a fresh request id and wait for the peer's reply frame."""
+        await self.connect()
+        rid = next(self._rids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[rid] = future
+        frame["rid"] = rid
+        try:
+            self.send(frame)
+            await self.writer.drain()
+            return await future
+        finally:
+            self._calls.pop(rid, None)
+
+    async def call(self, client: int, msg: Dict[str, Any]) -> List[Dict[str, Any]]:
+        reply = await self.request({"op": "call", "client": client, "msg": msg})
+        return reply["responses"]
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        buf = bytearray()
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                buf += data
+                for body in split_frames(buf):
+                    frame = LINK_PROTOCOL.decode(body)
+                    op = frame.get("op")
+                    if op == "reply":
+                        future = self._calls.pop(frame["rid"], None)
+                        if future is not None and not future.done():
+                            future.set_result(frame)
+                    elif op == "push":
+                        self.broker._push_to_client(frame["client"], frame["obj"])
+                    elif op == "close":
+                        self.broker._close_client(frame["client"])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            self.writer = None
+            for future in self._calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Worker {self.peer} is unavailable"))
+            self._calls.clear()
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+
+class ShardedBroker(HomeworkBroker):
+    """
+    One worker of a multi-process broker.
+
+    The worker keeps queues and subscribers only for topics it owns. Requests for
+    other topics are forwarded to their owner, which sees the client as a
+    ``_RemoteWriter``; responses come back in order, pushed messages asynchronously.
+    """
+
+    def __init__(self, index: int, count: int, socket_dir: str, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.index = index
+        self.count = count
+        self.socket_dir = socket_dir
+        self._links: Dict[int, _PeerLink] = {}
+        self._link_server: Optional[asyncio.AbstractServer] = None
+        # local clients that used other workers: id <-> writer, and which owners they touched
+        self._client_seq = itertools.count(1)
+        self._client_ids: Dict[Any, int] = {}
+        self._clients: Dict[int, Any] = {}
+        self._client_owners: Dict[Any, Set[int]] = {}
+        self.link_connect_timeout = LINK_CONNECT_TIMEOUT
+        # stands in for a client when dead letters go to a topic of another worker
+        self._dead_letter_writer: Optional[_Collector] = None
+
+    def owner(self, topic: str) -> Optional[int]:
+        # crc32, unlike hash(), is the same in every process
+        return zlib.crc32(topic.encode("utf-8")) % self.count
+
+    def socket_path(self, index: int) -> str:
+        return os.path.join(self.socket_dir, f"worker-{index}.sock")
+
+    async def open_link(self, peer: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_unix_connection(self.socket_path(peer))
+
+    async def start_link_server(self) -> None:
+        path = self.socket_path(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._link_server = await asyncio.start_unix_server(self._serve_link, path=path)
+
+    # ---------------- Routing ----------------
+
+    async def handle_request(self, msg: Dict[str, Any], writer: Any) -> None:
+        action = msg.get("action")
+        if action == "list_topics":
+            await self._list_all_topics(writer)
+            return
+        if action == "publish_batch" and isinstance(msg.get("messages"), list) and msg["messages"]:
+            await self._publish_batch_sharded(msg, writer)
+            return
+        topic = msg.get("topic")
+        if action in ("subscribe", "unsubscribe") and isinstance(topic, str) and is_pattern(topic):
+            await self._subscribe_everywhere(msg, writer)
+            return
+        if isinstance(topic, str) and topic:
+            owner = self.owner(topic)
+            if owner is None:
+                await self.send_response({"status": "error", "message": f"No node can serve topic '{topic}'"}, writer)
+                return
+            if owner != self.index:
+                for obj in await self._forward(owner, msg, writer):
+                    await self.send_response(obj, writer)
+                return
+        await super().handle_request(msg, writer)
+
+    def _link(self, peer: int) -> _PeerLink:
+        link = self._links.get(peer)
+        if link is None:
+            link = self._links[peer] = _PeerLink(self, peer)
+        return link
+
+    async def _forward(self, owner: int, msg: Dict[str, Any], writer: Any) -> List[Dict[str, Any]]:
+        client = self._client_ids.get(writer)
+        if client is None:
+            client = self._client_ids[writer] = next(self._client_seq)
+            self._clients[client] = writer
+        self._client_owners.setdefault(writer, set()).add(owner)
+        try:
+            return await self._link(owner).call(client, msg)
+        except ConnectionError as e:
+            return [{"status": "error", "message": str(e)}]
+
+    async def _run_local(self, msg: Dict[str, Any], writer: Any) -> List[Dict[str, Any]]:
+        collector = _Collector()
+        self._protocols[collector] = _LinkProtocol
+        # the part runs on behalf of the client, with the client's topic grants
+        grants = self._grants.get(writer)
+        if grants is not None:
+            grants.lend(collector)
+        try:
+            await HomeworkBroker.handle_request(self, msg, collector)
+        finally:
+            self._protocols.pop(collector, None)
+            if grants is not None:
+                grants.take_back(collector)
+            gained = self._grants.pop(collector, None)
+            if gained is not None:
+                gained.revoke()
+        return collector.objects
+
+    async def _list_all_topics(self, writer: Any) -> None:
+        topics = set(self.topics)
+        peers = self._reachable_peers()
+        replies = await asyncio.gather(*(self._forward(p, {"action": "list_topics"}, writer) for p in peers))
+        for responses in replies:
+            for obj in responses:
+                topics.update(obj.get("topics", ()))
+        await self.send_response({"status": "success", "topics": sorted(topics)}, writer)
+
+    async def _subscribe_everywhere(self, msg: Dict[str, Any], writer: Any) -> None:
+        """A wildcard pattern spans topics of every worker, so it is registered on all of them."""
+        await asyncio.gather(*(self._forward(p, msg, writer) for p in self._reachable_peers()))
+        await HomeworkBroker.handle_request(self, msg, writer)
+
+    def _reachable_peers(self) -> List[int]:
+        return [p for p in range(self.count) if p != self.index]
+
+    async def _publish_batch_sharded(self, msg: Dict[str, Any], writer: Any) -> None:
+        """Split a batch by owning worker, publish the parts concurrently, merge the acks."""
+        default_topic = msg.get("topic")
+        password = msg.get("password")
+        producer = msg.get("producer")
+        errors: List[Dict[str, Any]] = []
+        groups: Dict[int, List[Tuple[int, Dict[str, Any]]]] = {}
+        for index, item in enumerate(msg["messages"]):
+            if not isinstance(item, dict):
+                errors.append({"index": index, "message": "Batch item must be an object"})
+                continue
+            topic = item.get("topic", default_topic)
+            if not isinstance(topic, str) or not topic or item.get("message") is None:
+                errors.append({"index": index, "message": "Missing 'topic' or 'message' field"})
+                continue
+            entry = dict(item, topic=topic)
+            if password is not None and "password" not in entry:
+                entry["password"] = password
+            if producer is not None and "producer" not in entry:
+                entry["producer"] = producer
+            owner = self.owner(topic)
+            if owner is None:
+                errors.append({"index": index, "message": f"No node can serve topic '{topic}'"})
+                continue
+            groups.setdefault(owner, []).append((index, entry))
+
+        async def run_group(owner: int, entries: List[Tuple[int, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+            sub = {"action": "publish_batch", "messages": [entry for _, entry in entries]}
+            if owner == self.index:
+                return await self._run_local(sub, writer)
+            return await self._forward(owner, sub, writer)
+
+        owners = list(groups)
+        replies = await asyncio.gather(*(run_group(o, groups[o]) for o in owners))
+        published = 0
+        duplicates = 0
+        for owner, responses in zip(owners, replies):
+            entries = groups[owner]
+            reply = responses[-1] if responses else {"message": "No response"}
+            if "published" not in reply or reply.get("message"):
+                # the whole part failed (e.g. the worker is down or could not persist)
+                for index, _ in entries:
+                    errors.append({"index": index, "message": reply.get("message", "Publish failed")})
+                continue
+            published += reply["published"]
+            duplicates += reply.get("duplicates", 0)
+            for err in reply.get("errors", ()):
+                errors.append({"index": entries[err["index"]][0], "message": err["message"]})
+        response: Dict[str, Any] = {
+            "status": "success" if published or duplicates else "error",
+            "published": published,
+        }
+        if duplicates:
+            response["duplicates"] = duplicates
+        if errors:
+            response["errors"] = sorted(errors, key=lambda e: e["index"])
+        await self.send_response(response, writer)
+
+    # ---------------- Dead letters ----------------
+
+    async def _move_dead_letters(self, state: _TopicState) -> None:
+        if self.owner(state.name) != self.index:
+            # a replica: the owner of the topic moves its dead letters
+            state.dead.clear()
+            return
+        await super()._move_dead_letters(state)
+
+    async def _publish_dead_letters(self, topic: str, items: List[Dict[str, Any]]) -> int:
+        owner = self.owner(topic)
+        if owner == self.index:
+            return await super()._publish_dead_letters(topic, items)
+        if owner is None:
+            return 0
+        if self._dead_letter_writer is None:
+            self._dead_letter_writer = _Collector()
+        request = {"action": "publish_batch", "topic": topic, "messages": items}
+        replies = await self._forward(owner, request, self._dead_letter_writer)
+        return sum(reply.get("published", 0) for reply in replies)
+
+    # ---------------- Messages from owners ----------------
+
+    def _push_to_client(self, client: int, obj: Dict[str, Any]) -> None:
+        writer = self._clients.get(client)
+        if writer is None:
+            return
+        data = self._protocols.get(writer, _NLJSONProtocol).encode(obj)
+        if self._outbox_for(writer).put(data, self.overflow_policy) == "disconnect":
+            self._close_client(client)
+
+    def _close_client(self, client: int) -> None:
+        writer = self._clients.get(client)
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def _cleanup_writer(self, writer: Any) -> None:
+        await super()._cleanup_writer(writer)
+        client = self._client_ids.pop(writer, None)
+        if client is None:
+            return
+        self._clients.pop(client, None)
+        for owner in self._client_owners.pop(writer, ()):
+            self._link(owner).send({"op": "gone", "client": client})
+
+    # ---------------- Link server (this worker as owner) ----------------
+
+    async def _serve_link(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        remote: Dict[int, _RemoteWriter] = {}
+        calls: Set[asyncio.Task] = set()
+        buf = bytearray()
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                buf += data
+                for body in split_frames(buf):
+                    frame = LINK_PROTOCOL.decode(body)
+                    client = frame.get("client")
+                    if frame.get("op") == "call":
+                        rw = remote.get(client)
+                        if rw is None:
+                            rw = remote[client] = _RemoteWriter(writer, client)
+                            self._protocols[rw] = _LinkProtocol
+                        # a worker waits for each reply before sending that client's next call,
+                        # so calls of different clients may run concurrently
+                        task = asyncio.create_task(self._serve_call(rw, frame["rid"], frame["msg"], writer))
+                        calls.add(task)
+                        task.add_done_callback(calls.discard)
+                    elif frame.get("op") == "gone":
+                        rw = remote.pop(client, None)
+                        if rw is not None:
+                            await self._drop_remote(rw)
+                    else:
+                        await self._handle_link_frame(frame, writer)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            for rw in remote.values():
+                await self._drop_remote(rw)
+            writer.close()
+
+    async def _handle_link_frame(self, frame: Dict[str, Any], link_writer: asyncio.StreamWriter) -> None:
+        """Hook for link operations other than call/gone; workers have none."""
+
+    async def _serve_call(self, rw: _RemoteWriter, rid: int, msg: Dict[str, Any], link_writer: asyncio.StreamWriter) -> None:
+        self._pending_responses[rw] = []
+        try:
+            await HomeworkBroker.handle_request(self, msg, rw)
+        except Exception as e:
+            self._pending_responses[rw].append({"status": "error", "message": f"Server exception: {e.__class__.__name__}"})
+        finally:
+            responses = self._pending_responses.pop(rw, [])
+        link_writer.write(LINK_PROTOCOL.encode({"op": "reply", "rid": rid, "responses": responses}))
+        try:
+            await link_writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _drop_remote(self, rw: _RemoteWriter) -> None:
+        rw.closed = True
+        await HomeworkBroker._cleanup_writer(self, rw)
+        self._protocols.pop(rw, None)
+
+    async def close(self) -> None:
+        for link in self._links.values():
+            await link.close()
+        if self._link_server is not None:
+            self._link_server.close()
+            await self._link_server.wait_closed()
+            try:
+                os.unlink(self.socket_path(self.index))
+            except FileNotFoundError:
+                pass
+        await super().close()
+
+
+# ---------------- Processes ----------------
+
+async def serve_worker(
+    index: int,
+    count: int,
+    host: str,
+    port: int,
+    socket_dir: str,
+    data_dir: Optional[str] = None,
+    fsync: str = "always",
+    transport: str = "streams",
+    memory_limit: Optional[int] = None,
+    topic_memory_limit: Optional[int] = None,
+    spill_dir: Optional[str] = None,
+    spill_limit: Optional[int] = None,
+    metrics_port: Optional[int] = None,
+    compression_min_size: int = COMPRESSION_MIN_SIZE,
+    compression_dictionary: bytes = DEFAULT_DICTIONARY,
+) -> None:
+    """
+    Run worker ``index`` of ``count``. Quotas apply to each worker on its own; a
+    spill store empties its directory when opened, so every worker spills to a
+    subdirectory of its own. Worker N serves its metrics on ``metrics_port + N``.
+    """
+    worker_dir = os.path.join(data_dir, f"worker-{index}") if data_dir else None
+    worker_spill = os.path.join(spill_dir, f"worker-{index}") if spill_dir else None
+    broker = ShardedBroker(
+        index,
+        count,
+        socket_dir,
+        data_dir=worker_dir,
+        fsync=fsync,
+        memory_limit=memory_limit,
+        topic_memory_limit=topic_memory_limit,
+        spill_dir=worker_spill,
+        spill_limit=spill_limit,
+        compression_min_size=compression_min_size,
+        compression_dictionary=compression_dictionary,
+    )
+    broker.resume_sweeper()
+    await broker.start_link_server()
+    server = await start_broker_server(broker, host, port, transport, reuse_port=True)
+    print(f"Worker {index}/{count} (pid {os.getpid()}) listening on {host}:{port}")
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = await start_http_server(broker.render_metrics, host, metrics_port + index)
+        print(f"Worker {index} metrics on http://{host}:{metrics_port + index}/metrics")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await broker.close()
+
+
+def _worker_entry(*args: Any, loop: str = "asyncio", **kwargs: Any) -> None:
+    use_event_loop(loop)
+    try:
+        asyncio.run(serve_worker(*args, **kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(
+    workers: int,
+    host: str = "127.0.0.1",
+    port: int = 8888,
+    socket_dir: Optional[str] = None,
+    data_dir: Optional[str] = None,
+    fsync: str = "always",
+    transport: str = "streams",
+    loop: str = "asyncio",
+    memory_limit: Optional[int] = None,
+    topic_memory_limit: Optional[int] = None,
+    spill_dir: Optional[str] = None,
+    spill_limit: Optional[int] = None,
+    metrics_port: Optional[int] = None,
+    compression_min_size: int = COMPRESSION_MIN_SIZE,
+    compression_dictionary: bytes = DEFAULT_DICTIONARY,
+) -> List[multiprocessing.Process]:
+    """Spawn ``workers`` broker processes sharing host:port; returns the processes."""
+    options = {
+        "loop": loop,
+        "memory_limit": memory_limit,
+        "topic_memory_limit": topic_memory_limit,
+        "spill_dir": spill_dir,
+        "spill_limit": spill_limit,
+        "metrics_port": metrics_port,
+        "compression_min_size": compression_min_size,
+        "compression_dictionary": compression_dictionary,
+    }
+    socket_dir = socket_dir or tempfile.mkdtemp(prefix="broker-links-")
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(
+            target=_worker_entry,
+            args=(i, workers, host, port, socket_dir, data_dir, fsync, transport),
+            kwargs=options,
+            name=f"broker-worker-{i}",
+        )
+        for i in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+    return procs
+
+
+def run_workers(workers: int, host: str = "127.0.0.1", port: int = 8888, **kwargs: Any) -> None:
+    procs = start_workers(workers, host, port, **kwargs)
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            proc.join()
@@ -1,33 +1,25 @@
 #!/usr/bin/env python3
-# client.py - Interactive asyncio client for HomeworkBroker
+# client.py - Interactive asyncio client for HomeworkBroker (a menu over broker_client.BrokerClient)
 import asyncio
 import json
 from typing import Any, Dict
 
+from broker_client import BrokerClient, BrokerError, Subscription
+
 HOST = "127.0.0.1"
 PORT = 8888
 
-def jline(obj: Dict[str, Any]) -> bytes:
-    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
-
 async def ainput(prompt: str = "") -> str:
     # run blocking input in a thread so event loop stays responsive
     return await asyncio.to_thread(input, prompt)
 
-async def reader_task(reader: asyncio.StreamReader):
-    while True:
-        line = await reader.readline()
-        if not line:
-            print("\n[Disconnected]")
-            return
-        try:
-            msg = json.loads(line.decode("utf-8").strip())
-            if msg.get("type") == "message":
-                print(f"\n[Message] topic={msg['topic']} priority={msg.get('priority')}: {msg['payload']}")
-            else:
-                print(f"\n[Response] {json.dumps(msg, ensure_ascii=False)}")
-        except Exception as e:
-            print(f"\n[Bad line] {line!r} ({e})")
+def show_response(response: Dict[str, Any]):
+    response = {k: v for k, v in response.items() if k != "request_id"}
+    print(f"\n[Response] {json.dumps(response, ensure_ascii=False)}")
+
+async def printer_task(subscription: Subscription):
+    async for msg in subscription:
+        print(f"\n[Message] topic={msg.topic} priority={msg.priority}: {msg.payload}")
 
 def show_menu():
     print("\n=== Message Broker Client ===")
@@ -40,74 +32,77 @@ def show_menu():
     print("7. Exit")
 
 async def main():
-    reader, writer = await asyncio.open_connection(HOST, PORT)
+    # one connection is plenty for a person typing; publishes are sent right away
+    client = BrokerClient(HOST, PORT, pool_size=1, batch_size=1)
+    await client.connect()
     print(f"Connected to {HOST}:{PORT}")
-    # start background reader
-    rt = asyncio.create_task(reader_task(reader))
+    subscriptions: Dict[str, Subscription] = {}
+    printers = []
 
     try:
         while True:
             show_menu()
             choice = (await ainput("Select option: ")).strip()
+            try:
+                if choice == "1":
+                    show_response(await client.request({"action": "list_topics"}))
 
-            if choice == "1":
-                writer.write(jline({"action": "list_topics"}))
-                await writer.drain()
-
-            elif choice == "2":
-                topic = (await ainput("Topic: ")).strip()
-                pwd = (await ainput("Password (optional): ")).strip() or None
-                msg = {"action": "subscribe", "topic": topic}
-                if pwd: msg["password"] = pwd
-                writer.write(jline(msg)); await writer.drain()
+                elif choice == "2":
+                    topic = (await ainput("Topic: ")).strip()
+                    pwd = (await ainput("Password (optional): ")).strip() or None
+                    sub = await client.subscribe(topic, password=pwd)
+                    subscriptions[topic] = sub
+                    printers.append(asyncio.create_task(printer_task(sub)))
+                    print(f"\n[Subscribed] {topic}")
 
-            elif choice == "3":
-                topic = (await ainput("Topic: ")).strip()
-                text = (await ainput("Message: ")).strip()
-                priority = (await ainput("Priority [high|normal|low] (default normal): ")).strip() or "normal"
-                ttl = (await ainput("TTL seconds (optional): ")).strip()
-                pwd = (await ainput("Password (optional): ")).strip() or None
-                msg = {"action": "publish", "topic": topic, "message": text, "priority": priority}
-                if ttl:
-                    try:
-                        msg["ttl"] = int(ttl)
-                    except ValueError:
-                        print("TTL must be an integer; ignoring.")
-                if pwd: msg["password"] = pwd
-                writer.write(jline(msg)); await writer.drain()
+                elif choice == "3":
+                    topic = (await ainput("Topic: ")).strip()
+                    text = (await ainput("Message: ")).strip()
+                    priority = (await ainput("Priority [high|normal|low] (default normal): ")).strip() or "normal"
+                    ttl = (await ainput("TTL seconds (optional): ")).strip()
+                    pwd = (await ainput("Password (optional): ")).strip() or None
+                    msg = {"action": "publish", "topic": topic, "message": text, "priority": priority}
+                    if ttl:
+                        try:
+                            msg["ttl"] = int(ttl)
+                        except ValueError:
+                            print("TTL must be an integer; ignoring.")
+                    if pwd: msg["password"] = pwd
+                    show_response(await client.request(msg))
 
-            elif choice == "4":
-                topic = (await ainput("Topic: ")).strip()
-                writer.write(jline({"action": "queue_length", "topic": topic})); await writer.drain()
+                elif choice == "4":
+                    topic = (await ainput("Topic: ")).strip()
+                    show_response(await client.request({"action": "queue_length", "topic": topic}))
 
-            elif choice == "5":
-                topic = (await ainput("Topic: ")).strip()
-                pwd = (await ainput("Password (optional): ")).strip() or None
-                msg = {"action": "clear_topic", "topic": topic}
-                if pwd: msg["password"] = pwd
-                writer.write(jline(msg)); await writer.drain()
+                elif choice == "5":
+                    topic = (await ainput("Topic: ")).strip()
+                    pwd = (await ainput("Password (optional): ")).strip() or None
+                    msg = {"action": "clear_topic", "topic": topic}
+                    if pwd: msg["password"] = pwd
+                    show_response(await client.request(msg))
 
-            elif choice == "6":
-                topic = (await ainput("Topic: ")).strip()
-                writer.write(jline({"action": "unsubscribe", "topic": topic})); await writer.drain()
+                elif choice == "6":
+                    topic = (await ainput("Topic: ")).strip()
+                    sub = subscriptions.pop(topic, None)
+                    if sub is None:
+                        print("Not subscribed to this topic.")
+                    else:
+                        await sub.close()
+                        print(f"\n[Unsubscribed] {topic}")
 
-            elif choice == "7":
-                print("Bye!")
-                break
-            else:
-                print("Unknown option.")
+                elif choice == "7":
+                    print("Bye!")
+                    break
+                else:
+                    print("Unknown option.")
+            except BrokerError as e:
+                show_response(e.response)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                print(f"\n[Disconnected] {e}")
     finally:
-        writer.close()
-        try:
-            await writer.wait_closed()
-        except Exception:
-            pass
-        await asyncio.sleep(0.05)
-        rt.cancel()
-        try:
-            await rt
-        except Exception:
-            pass
+        await client.close()
+        for task in printers:
+            task.cancel()
 
 if __name__ == "__main__":
     try:
@@ -1,77 +1,1241 @@
 #!/usr/bin/env python3
 # homework_broker.py
 # Async message broker with topics, priorities, TTL, and basic auth for topics.
-# Protocol: newline-delimited JSON (one JSON object per line).
+# Protocol: newline-delimited JSON (one JSON object per line), or length-prefixed
+# binary frames (JSON or msgpack bodies) negotiated at connect time.
 # Each response is a JSON object with at least {"status": "success"|"error", ...}
 
 import asyncio
+import base64
+import heapq
 import json
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, Optional, Tuple, Set
+import math
+import struct
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Deque, Dict, Any, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Set
+
+import broker_wal
+from broker_auth import Grants, TopicCredential, load_credential, same_password
+from broker_compress import (
+    COMPRESSED_MARKER,
+    COMPRESSION_MIN_SIZE,
+    DEFAULT_DICTIONARY,
+    Compressor,
+    available_codecs,
+    pick_codec,
+)
+from broker_dedup import DEDUP_MAX_PRODUCERS, DUPLICATE, FRESH, DedupIndex
+from broker_filters import Filter, any_of, parse_filter
+from broker_metrics import Metrics, start_http_server
+from broker_spill import SpillStore, TopicSpill
+from broker_timers import TIMER_TICK, TimingWheel
+from broker_trie import TopicTrie, is_pattern, matches
+from broker_wal import WriteAheadLog
+
+try:  # optional: compact binary payloads for framed connections
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the environment
+    msgpack = None
+
+try:  # optional: faster event loop, selected with use_event_loop("uvloop")
+    import uvloop
+except ImportError:  # pragma: no cover - depends on the environment
+    uvloop = None
 
 
 PRIORITY_ORDER = {"high": 0, "normal": 1, "low": 2}
+PRIORITY_NAMES = ("high", "normal", "low")
+
+# What to do when a subscriber's outbound queue is full
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+DEFAULT_SEND_QUEUE_SIZE = 1000
+# How often the background sweeper drops expired messages (seconds)
+DEFAULT_SWEEP_INTERVAL = 0.5
+# Work-queue consumers: default prefetch window and ack deadline (seconds)
+DEFAULT_PREFETCH = 10
+DEFAULT_VISIBILITY_TIMEOUT = 30.0
+# retained messages per topic for replay (subscribe with from_offset / from_timestamp)
+DEFAULT_RETAIN = 1000
+REPLAY_CHUNK_SIZE = 64
+# delayed messages released between yields to the event loop
+RELEASE_CHUNK_SIZE = 64
+# Memory quotas: bytes a queued message costs besides its payload (record, heap entry,
+# index slot; see bench_broker.py queue), and how many spilled messages are read back at once
+MESSAGE_OVERHEAD = 280
+PAGE_IN_BATCH = 64
+
+# Framed mode handshake: client sends FRAMED_MAGIC + codec byte, server echoes the
+# codec it accepted. NUL never starts a JSON line, so both modes share one port.
+FRAMED_MAGIC = b"\x00BRK"
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# handle_client reads whatever is available (up to this much) and handles every
+# complete line/frame in it before reading again
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def _json_default(obj: Any) -> Any:
+    # binary payloads published over msgpack reach JSON clients as base64 text
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode("ascii")
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
 
-def utcnow():
-    return datetime.now(tz=timezone.utc)
+# reusable encoders: json.dumps builds a new encoder whenever options are passed
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, default=_json_default)
+_COMPACT_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_json_default)
+
+
+def _message_envelope(
+    topic: str, payload: Any, priority: str, expires_at: Optional[str], offset: Optional[int] = None
+) -> Dict[str, Any]:
+    message = {"type": "message", "topic": topic, "payload": payload, "priority": priority}
+    if expires_at:
+        message["expires_at"] = expires_at
+    if offset is not None:
+        message["offset"] = offset
+    return message
 
 
 class _NLJSONProtocol:
     """Small helpers for newline-delimited JSON messages."""
 
+    name = "nljson"
+    decode_error = "Invalid JSON format"
+
     @staticmethod
     def encode(obj: Dict[str, Any]) -> bytes:
-        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        return (_JSON_ENCODER.encode(obj) + "\n").encode("utf-8")
 
     @staticmethod
     def decode_line(data: bytes) -> Dict[str, Any]:
         return json.loads(data.decode("utf-8").strip())
 
+    decode = decode_line
+
+    @staticmethod
+    def encode_message(
+        topic: str, payload: Any, priority: str, expires_at: Optional[str], offset: Optional[int] = None
+    ) -> bytes:
+        """Serialize a pushed message once; the bytes are shared by every subscriber."""
+        return _NLJSONProtocol.encode(_message_envelope(topic, payload, priority, expires_at, offset))
+
+
+class _FramedProtocol:
+    """
+    Length-prefixed frames: 4-byte big-endian body size, then a JSON or msgpack body.
+
+    With a ``compressor`` (negotiated by the "compression" action, see
+    broker_compress) bodies of ``min_size`` bytes or more are sent compressed
+    when that makes them smaller, and compressed bodies are accepted.
+    """
+
+    codecs = {b"j": "json", b"m": "msgpack"}
+
+    def __init__(self, codec: str, compressor: Optional[Compressor] = None, min_size: int = COMPRESSION_MIN_SIZE) -> None:
+        if codec == "msgpack" and msgpack is None:
+            raise ValueError("msgpack is not installed")
+        self.codec = codec
+        self.compressor = compressor
+        self.min_size = min_size
+        self.name = f"framed-{codec}" if compressor is None else f"framed-{codec}-{compressor.name}"
+        self.codec_byte = b"m" if codec == "msgpack" else b"j"
+        self.decode_error = f"Invalid {codec} frame"
+
+    def encode(self, obj: Dict[str, Any]) -> bytes:
+        if self.codec == "msgpack":
+            body = msgpack.packb(obj, use_bin_type=True)
+        else:
+            body = _COMPACT_JSON_ENCODER.encode(obj).encode("utf-8")
+        compressor = self.compressor
+        if compressor is not None and len(body) >= self.min_size:
+            packed = compressor.compress(body)
+            if len(packed) < len(body) - 1:
+                body = COMPRESSED_MARKER + packed
+        return FRAME_HEADER.pack(len(body)) + body
+
+    def encode_message(
+        self, topic: str, payload: Any, priority: str, expires_at: Optional[str], offset: Optional[int] = None
+    ) -> bytes:
+        return self.encode(_message_envelope(topic, payload, priority, expires_at, offset))
+
+    def decode(self, body: bytes) -> Dict[str, Any]:
+        if body[:1] == COMPRESSED_MARKER:
+            if self.compressor is None:
+                raise ValueError("Compressed frame, but no compression was negotiated")
+            body = self.compressor.decompress(body[1:])
+        if self.codec == "msgpack":
+            return msgpack.unpackb(body, raw=False)
+        return json.loads(body)
+
+    @classmethod
+    def negotiate(cls, codec_byte: bytes) -> "_FramedProtocol":
+        """Pick the protocol for a requested codec, falling back to JSON bodies."""
+        codec = cls.codecs.get(codec_byte, "json")
+        if codec == "msgpack" and msgpack is None:
+            codec = "json"
+        return _FRAMED_PROTOCOLS[codec]
+
+
+# one shared instance per codec, so fan-out can encode once per protocol
+_FRAMED_PROTOCOLS: Dict[str, _FramedProtocol] = {"json": _FramedProtocol("json")}
+if msgpack is not None:
+    _FRAMED_PROTOCOLS["msgpack"] = _FramedProtocol("msgpack")
+
+
+def split_lines(buf: bytearray) -> List[bytes]:
+    """Remove and return all complete newline-terminated lines from buf."""
+    end = buf.rfind(b"\n")
+    if end < 0:
+        if len(buf) > MAX_FRAME_SIZE:
+            raise ValueError(f"Line too long ({len(buf)} bytes)")
+        return []
+    lines = bytes(buf[:end]).split(b"\n")
+    del buf[: end + 1]
+    return lines
+
+
+def split_frames(buf: bytearray) -> List[bytes]:
+    """Remove and return the bodies of all complete length-prefixed frames in buf."""
+    frames = []
+    pos = 0
+    header = FRAME_HEADER.size
+    while len(buf) - pos >= header:
+        (size,) = FRAME_HEADER.unpack_from(buf, pos)
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large ({size} bytes)")
+        if len(buf) - pos - header < size:
+            break
+        frames.append(bytes(buf[pos + header : pos + header + size]))
+        pos += header + size
+    if pos:
+        del buf[:pos]
+    return frames
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """Read one length-prefixed frame body; None on a clean EOF."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large ({size} bytes)")
+    return await reader.readexactly(size)
+
+
+async def open_framed_connection(
+    host: str, port: int, codec: str = "msgpack", compression: Iterable[str] = ()
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, _FramedProtocol]:
+    """
+    Connect and negotiate framed mode; returns the protocol the server accepted.
+
+    ``compression`` lists the codecs to ask for, preferred first (see
+    broker_compress); the protocol compresses with the one the server picked.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(FRAMED_MAGIC + (b"m" if codec == "msgpack" else b"j"))
+    await writer.drain()
+    reply = await reader.readexactly(len(FRAMED_MAGIC) + 1)
+    if reply[:-1] != FRAMED_MAGIC:
+        writer.close()
+        raise ConnectionError("Server does not support framed mode")
+    protocol = _FramedProtocol.negotiate(reply[-1:])
+    wanted = [name for name in compression if name in available_codecs()]
+    if wanted:
+        writer.write(protocol.encode({"action": "compression", "codecs": wanted}))
+        await writer.drain()
+        body = await read_frame(reader)
+        response = protocol.decode(body) if body is not None else {}
+        name = response.get("compression")
+        if response.get("status") == "success" and name is not None:
+            dictionary = base64.b64decode(response["dictionary"]) if response.get("dictionary") else b""
+            compressor = Compressor(name, dictionary, MAX_FRAME_SIZE)
+            protocol = _FramedProtocol(protocol.codec, compressor, response.get("min_size", COMPRESSION_MIN_SIZE))
+    return reader, writer, protocol
+
+
+class _Outbox:
+    """
+    Bounded outbound queue of one subscriber connection.
+
+    Data is written to the transport immediately while the connection keeps up.
+    Once a drain is in progress, new data waits in ``pending`` (at most
+    ``maxsize`` items) and is flushed by the connection's own writer task, so
+    publishers never wait on a slow subscriber's socket.
+    """
+
+    def __init__(
+        self, writer: asyncio.StreamWriter, maxsize: int, protocol: Any = None, metrics: Optional[Metrics] = None
+    ) -> None:
+        self.writer = writer
+        self.maxsize = maxsize
+        self.protocol = protocol or _NLJSONProtocol
+        self.metrics = metrics
+        self.pending: Deque[bytes] = deque()
+        self.busy = False  # drain in progress, new data has to be queued
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, data: bytes, policy: str) -> Optional[str]:
+        """Queue data for sending. Returns the applied overflow policy on drop, else None."""
+        if self.closed:
+            return "disconnect"
+        if not self.busy:
+            self.writer.write(data)
+            self.busy = True
+            if self._task is None:
+                self._task = asyncio.create_task(self._run())
+            self._wakeup.set()
+            return None
+        if len(self.pending) < self.maxsize:
+            self.pending.append(data)
+            return None
+        if policy == "drop_newest":
+            return policy
+        if policy == "drop_oldest":
+            self.pending.popleft()
+            self.pending.append(data)
+            return policy
+        self.close()
+        return "disconnect"
+
+    async def _run(self) -> None:
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                start = time.perf_counter_ns()
+                await self.writer.drain()
+                while self.pending:
+                    # hand the shared envelopes to the transport as-is, without joining copies
+                    batch = list(self.pending)
+                    self.pending.clear()
+                    self._room.set()
+                    if self.metrics is not None:
+                        self.metrics.counters["outbox_queued"] += len(batch)
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+                self.busy = False
+                if self.metrics is not None:
+                    self.metrics.observe("outbox_drain", start)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # broken connection; handle_client will notice and clean up
+            self.close()
+
+    async def wait_room(self) -> None:
+        """Wait until at most half of the queue is taken (for senders that may wait, unlike publish)."""
+        while not self.closed and len(self.pending) >= self.maxsize // 2:
+            self._room.clear()
+            await self._room.wait()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        self._room.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class _Message:
+    """
+    One published message, shared by the topic queue, the retained log and in-flight deliveries.
+
+    ``created`` is wall-clock seconds (replay by timestamp, the WAL); expiry is a
+    monotonic ``deadline``. The ISO ``expires_at`` clients see is only produced
+    when the message is serialized.
+    """
+
+    __slots__ = ("priority", "seq", "offset", "created", "deadline", "payload", "attempts", "size", "held")
+
+    def __init__(self, priority: int, seq: int, created: float, deadline: Optional[float], payload: Any) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.offset = -1  # assigned by _RetainedLog.append
+        self.created = created
+        self.deadline = deadline
+        self.payload = payload
+        self.attempts = 0  # deliveries to pull consumers so far
+        self.size = 0  # estimated bytes, counted against memory quotas (0 while none apply)
+        self.held = 0  # _IN_QUEUE | _IN_LOG: what keeps it in memory; its size is counted once
+
+    def expires_at(self) -> Optional[float]:
+        """Wall-clock expiry (Unix seconds), or None."""
+        if self.deadline is None:
+            return None
+        return time.time() + (self.deadline - time.monotonic())
+
+    def expires_iso(self) -> Optional[str]:
+        expires = self.expires_at()
+        return None if expires is None else datetime.fromtimestamp(expires, tz=timezone.utc).isoformat()
+
+    def to_record(self) -> Dict[str, Any]:
+        """Spill record; expiry is kept as wall-clock time, like in the WAL."""
+        return {"s": self.seq, "p": self.priority, "c": self.created, "e": self.expires_at(), "d": self.payload}
+
+    @classmethod
+    def from_record(cls, rec: Dict[str, Any], deadline: Optional[float]) -> "_Message":
+        return cls(rec["p"], rec["s"], rec["c"], deadline, rec["d"])
+
+
+# holders of a message's payload, see _Message.held
+_IN_QUEUE = 1
+_IN_LOG = 2
+
+
+def _message_size(payload: Any) -> int:
+    if isinstance(payload, (str, bytes)):
+        return MESSAGE_OVERHEAD + len(payload)
+    return MESSAGE_OVERHEAD + len(_COMPACT_JSON_ENCODER.encode(payload))
+
+
+class _MemoryBudget:
+    """Bytes of queued messages across all topics of a broker, against an optional limit."""
+
+    __slots__ = ("limit", "used")
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self.used = 0
+
+
+class _ExpiringQueue:
+    """
+    Priority queue of topic messages with a TTL index and optional memory quota.
+
+    The heap holds ``(priority, seq, message)`` entries, so ordering is decided
+    by C-level tuple comparison and never reaches the message itself. Live
+    messages are tracked in ``index`` (seq -> message), so the size is O(1).
+    Expiry pops a separate min-heap of ``(monotonic_deadline, seq)``; removed
+    entries stay in the priority heap and are skipped lazily when dequeued.
+
+    With a quota (``limit`` for the topic, ``budget`` for the whole broker) a
+    new message that does not fit goes to ``spill`` instead, at the tail of its
+    priority level; once a level has messages on disk, newer ones of that level
+    follow them there, so every level stays FIFO. ``pop`` pages spilled
+    messages back while there is room, and always before an in-memory message
+    of a lower priority would be handed out.
+
+    The quotas count every message kept in memory, including those only the
+    topic's retained ``log`` still holds after they were dequeued; when a new
+    message does not fit, the oldest retained messages are dropped from the log
+    first. Messages spilled at publish are not retained at all.
+
+    While ``dead`` is a list (the topic has a dead-letter topic), expired
+    messages are appended to it as ``(message, "expired")`` instead of vanishing.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = None,
+        budget: Optional[_MemoryBudget] = None,
+        spill: Optional[TopicSpill] = None,
+    ) -> None:
+        self.heap: List[Tuple[int, int, _Message]] = []
+        self.deadlines: List[Tuple[float, int]] = []
+        self.index: Dict[int, _Message] = {}
+        self.bytes = 0  # estimated size of the messages in memory
+        self.limit = limit
+        self.budget = budget
+        self.spill = spill
+        self.dead: Optional[List[Tuple[_Message, str]]] = None
+        self.log: Optional["_RetainedLog"] = None
+        self.log_only = 0  # bytes of messages that only the retained log keeps
+
+    def __len__(self) -> int:
+        spill = self.spill
+        return len(self.index) + spill.live() if spill is not None else len(self.index)
+
+    def pending(self) -> bool:
+        """Whether ``pop`` has anything to look at: expired spilled messages are only dropped as they are read back."""
+        return bool(self.index) or (self.spill is not None and self.spill.total > 0)
+
+    @property
+    def spilled(self) -> int:
+        """Spilled messages that have not expired."""
+        return self.spill.live() if self.spill is not None else 0
+
+    def push(self, message: _Message) -> None:
+        """Put a message in memory unconditionally (new ones go through ``put``)."""
+        seq = message.seq
+        self.index[seq] = message
+        heapq.heappush(self.heap, (message.priority, seq, message))
+        if message.deadline is not None:
+            heapq.heappush(self.deadlines, (message.deadline, seq))
+        size = message.size
+        if size:
+            held = message.held
+            if not held:
+                self._charge(size)
+            elif held == _IN_LOG:
+                self.log_only -= size
+            message.held = held | _IN_QUEUE
+
+    def put(self, message: _Message) -> bool:
+        """Enqueue a new message in memory or on disk; False when neither has room for it."""
+        if self.limit is None and self.budget is None:
+            self.push(message)
+            return True
+        message.size = _message_size(message.payload)
+        spill = self.spill
+        if spill is not None and spill.count(message.priority):
+            return spill.append(message.priority, message.to_record())
+        if self._fits(message.size) or (self.log_only and self._shed(message.size)):
+            self.push(message)
+            return True
+        return spill is not None and spill.append(message.priority, message.to_record())
+
+    def _fits(self, size: int, share: float = 1.0) -> bool:
+        """Whether ``size`` more bytes keep memory within ``share`` of the quotas."""
+        if self.limit is not None and self.bytes + size > self.limit * share:
+            return False
+        budget = self.budget
+        return budget is None or budget.limit is None or budget.used + size <= budget.limit * share
+
+    def _shed(self, size: int) -> bool:
+        """Drop the oldest retained messages until ``size`` more bytes fit (or nothing is left to free)."""
+        while self.log_only and not self._fits(size) and self.log.drop_oldest():
+            pass
+        return self._fits(size)
+
+    def _charge(self, size: int) -> None:
+        self.bytes += size
+        if self.budget is not None:
+            self.budget.used += size
+
+    def _release(self, message: _Message) -> None:
+        size = message.size
+        if size:
+            held = message.held = message.held & ~_IN_QUEUE
+            if held:
+                self.log_only += size
+            else:
+                self._charge(-size)
+
+    def retain(self, message: _Message) -> bool:
+        """Whether the retained log may keep ``message``: not when it went to disk instead of memory."""
+        if not message.size:
+            return True
+        if not message.held & _IN_QUEUE:
+            return False
+        message.held |= _IN_LOG
+        return True
+
+    def unretain(self, message: _Message) -> None:
+        size = message.size
+        if size:
+            held = message.held = message.held & ~_IN_LOG
+            if not held:
+                self.log_only -= size
+                self._charge(-size)
+
+    def _room(self, share: float = 1.0) -> float:
+        """Bytes that still fit under ``share`` of the quotas, counting what the retained log would give up."""
+        room = math.inf
+        if self.limit is not None:
+            room = self.limit * share - self.bytes
+        budget = self.budget
+        if budget is not None and budget.limit is not None:
+            room = min(room, budget.limit * share - budget.used)
+        return room + self.log_only
+
+    def _page_in(self) -> None:
+        """Read spilled messages back: the head of a more urgent level at once, the rest while under half quota."""
+        spill = self.spill
+        while spill.total:
+            priority = spill.first_priority()
+            urgent = not self.index or priority < self.heap[0][0]
+            if not urgent and not self._fits(0, 0.5):
+                return
+            # as many as the quota has room for (at least the head), estimated from their size on disk
+            estimate = spill.average_size(priority) + MESSAGE_OVERHEAD
+            batch = max(1, int(min(PAGE_IN_BATCH, self._room(1.0 if urgent else 0.5) // estimate)))
+            now_wall = time.time()
+            now = time.monotonic()
+            for rec in spill.read(priority, batch):
+                remaining = broker_wal.remaining_ttl(rec, now_wall)
+                if remaining is not None and remaining <= 0:
+                    # expired on disk
+                    if self.dead is not None:
+                        self.dead.append((_Message.from_record(rec, now), "expired"))
+                    continue
+                message = _Message.from_record(rec, now + remaining if remaining is not None else None)
+                message.size = _message_size(message.payload)
+                if self.log_only and not self._fits(message.size):
+                    self._shed(message.size)
+                self.push(message)
+            if urgent:
+                return
+
+    def pop(self) -> Optional[_Message]:
+        """Remove and return the highest-priority live message, or None."""
+        now = time.monotonic()
+        spill = self.spill
+        while True:
+            on_disk = spill.total if spill is not None else 0
+            if on_disk:
+                self._page_in()
+            if not self.heap:
+                if on_disk and spill.total < on_disk:
+                    continue  # everything read back had expired; there may be more behind it
+                return None
+            _, seq, message = heapq.heappop(self.heap)
+            if self.index.pop(seq, None) is None:
+                continue  # already expired or removed
+            self._release(message)
+            deadline = message.deadline
+            if deadline is not None and deadline <= now:
+                # expired, sweeper has not got to it yet
+                if self.dead is not None:
+                    self.dead.append((message, "expired"))
+                continue
+            return message
+
+    def expire_due(self, now: float) -> int:
+        """Drop in-memory items whose deadline has passed; returns how many were dropped."""
+        expired = 0
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, seq = heapq.heappop(deadlines)
+            message = self.index.pop(seq, None)
+            if message is not None:
+                self._release(message)
+                expired += 1
+                if self.dead is not None:
+                    self.dead.append((message, "expired"))
+        # rebuild once dead entries dominate so memory stays proportional to live items
+        if expired and len(self.heap) > 2 * len(self.index) + 64:
+            self.heap = [(m.priority, m.seq, m) for m in self.index.values()]
+            heapq.heapify(self.heap)
+        return expired
+
+    def messages(self) -> Iterator[_Message]:
+        """Every queued message, spilled ones included, without dequeuing anything."""
+        yield from self.index.values()
+        if self.spill is not None:
+            now_wall = time.time()
+            now = time.monotonic()
+            for rec in self.spill.scan():
+                remaining = broker_wal.remaining_ttl(rec, now_wall)
+                yield _Message.from_record(rec, now + remaining if remaining is not None else None)
+
+    def discard(self, seq: int) -> bool:
+        """Remove a live in-memory item by sequence id; the heap entry is skipped lazily."""
+        message = self.index.pop(seq, None)
+        if message is None:
+            return False
+        self._release(message)
+        return True
+
+    def clear(self) -> None:
+        for message in self.index.values():
+            self._release(message)
+        self.heap.clear()
+        self.deadlines.clear()
+        self.index.clear()
+        if self.spill is not None:
+            self.spill.clear()
+
+
+class _RetainedLog:
+    """
+    Ring buffer of a topic's last ``capacity`` published messages, addressed by offset.
+
+    Offsets grow by one per message and are never reused; the message with
+    offset ``o`` lives in slot ``o % capacity`` while ``first <= o < next``.
+    With a ``queue`` its memory quotas decide what is kept: a slot stays empty
+    for a message spilled to disk, and the queue drops the oldest entries when
+    it needs room (see _ExpiringQueue).
+    """
+
+    def __init__(self, capacity: int, queue: Optional[_ExpiringQueue] = None) -> None:
+        self.capacity = capacity
+        self.queue = queue
+        self.slots: List[Optional[_Message]] = []  # grows up to capacity, then wraps around
+        self.next = 0
+        self._floor = 0  # nothing older is retained (raised by resize and drop_oldest)
+
+    @property
+    def first(self) -> int:
+        return max(self._floor, self.next - self.capacity)
+
+    def append(self, message: _Message) -> int:
+        offset = message.offset = self.next
+        self.next += 1
+        if self.capacity:
+            queue = self.queue
+            kept: Optional[_Message] = message if queue is None or queue.retain(message) else None
+            i = offset % self.capacity
+            if i < len(self.slots):
+                old = self.slots[i]
+                self.slots[i] = kept
+                if old is not None and queue is not None:
+                    queue.unretain(old)
+            else:
+                self.slots.append(kept)
+        return offset
+
+    def read(self, start: int, limit: int) -> List[_Message]:
+        """Retained messages with offsets in [start, start + limit); empty slots are skipped."""
+        start = max(start, self.first)
+        end = min(self.next, start + limit)
+        slots, capacity = self.slots, self.capacity
+        return [m for m in (slots[o % capacity] for o in range(start, end)) if m is not None]
+
+    def offset_at(self, ts: float) -> int:
+        """First retained offset published at or after ``ts`` (``next`` when there is none)."""
+        lo, hi = self.first, self.next
+        slots, capacity = self.slots, self.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # compare the first message at or after mid; empty slots in between read as nothing
+            probe = mid
+            while probe < hi and slots[probe % capacity] is None:
+                probe += 1
+            if probe < hi and slots[probe % capacity].created < ts:
+                lo = probe + 1
+            else:
+                hi = mid
+        return lo
+
+    def drop_oldest(self) -> bool:
+        """Forget the oldest retained offset; False when nothing is retained."""
+        first = self.first
+        if first >= self.next or not self.capacity:
+            return False
+        i = first % self.capacity
+        message = self.slots[i]
+        self.slots[i] = None
+        self._floor = first + 1
+        if message is not None and self.queue is not None:
+            self.queue.unretain(message)
+        return True
+
+    def resize(self, capacity: int) -> None:
+        first = self.first
+        entries = self.read(first, self.next)
+        kept = [m for m in entries if m.offset >= self.next - capacity] if capacity else []
+        if self.queue is not None:
+            for message in entries[: len(entries) - len(kept)]:
+                self.queue.unretain(message)
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self._floor = first
+        for message in kept:
+            self.slots[message.offset % capacity] = message
+
+
+class _Consumer:
+    """Pull consumer of one topic: a connection with a window of delivery credits."""
+
+    def __init__(self, writer: asyncio.StreamWriter, outbox: _Outbox, prefetch: int, visibility_timeout: float) -> None:
+        self.writer = writer
+        self.outbox = outbox
+        self.prefetch = prefetch
+        self.credits = prefetch
+        self.visibility_timeout = visibility_timeout
+        # sequence ids delivered to this consumer and not yet acked
+        self.inflight: Set[int] = set()
+
+
+class _TopicState:
+    """Queue, subscribers and settings of one topic, guarded by the topic's own lock."""
+
+    def __init__(self, name: str, credential: Optional[TopicCredential] = None, retain: int = DEFAULT_RETAIN) -> None:
+        self.name = name
+        self.queue = _ExpiringQueue()
+        # published messages by offset, for subscribers that replay history; counted in the queue's quotas
+        self.log = self.queue.log = _RetainedLog(retain, self.queue)
+        self.subscribers: Set[asyncio.StreamWriter] = set()
+        # salted hash of the topic password (None: public topic)
+        self.credential = credential
+        # connections that have proven the password (maintained by broker_auth.Grants)
+        self.granted: Set[asyncio.StreamWriter] = set()
+        # overflow policy for subscriber queues (None -> broker default)
+        self.overflow: Optional[str] = None
+        # policy -> number of dropped deliveries
+        self.dropped: Dict[str, int] = {}
+        # messages are written to the broker's write-ahead log
+        self.durable = False
+        self.lock = asyncio.Lock()
+        # content filters of subscribers that gave one (writer -> compiled filter)
+        self.filters: Dict[asyncio.StreamWriter, Filter] = {}
+        # immutable fan-out snapshot: ((protocol, (outbox, ...), predicate or None), ...), one group
+        # per protocol and filter; rebuilt only when subscribers change, so publish neither
+        # copies the set nor looks up outboxes
+        self.fanout: Tuple[Tuple[Any, Tuple["_Outbox", ...], Optional[Callable[[Any], bool]]], ...] = ()
+        # work-queue mode: consumers in round-robin order
+        self.consumers: Dict[asyncio.StreamWriter, _Consumer] = {}
+        self.consumer_ring: Deque[_Consumer] = deque()
+        # seq -> (message, consumer, attempt) for delivered but unacked messages
+        self.inflight: Dict[int, Tuple[_Message, _Consumer, int]] = {}
+        # min-heap of (visibility_deadline, seq, attempt); stale entries are skipped
+        self.visibility: List[Tuple[float, int, int]] = []
+        # where messages the topic gives up on go, and how often a consumer may get one (None: no limit)
+        self.dead_letter: Optional[str] = None
+        self.max_attempts: Optional[int] = None
+        # (message, reason) waiting for the sweeper to move them to the dead-letter topic
+        self.dead: List[Tuple[_Message, str]] = []
+
+    def rebuild_fanout(
+        self,
+        outboxes: Dict[asyncio.StreamWriter, "_Outbox"],
+        pattern_subscribers: Iterable[Tuple[asyncio.StreamWriter, Optional[Filter]]] = (),
+    ) -> None:
+        wanted: Dict[asyncio.StreamWriter, List[Optional[Filter]]] = {w: [self.filters.get(w)] for w in self.subscribers}
+        for w, flt in pattern_subscribers:
+            wanted.setdefault(w, []).append(flt)
+        groups: Dict[Tuple[int, Optional[str]], Tuple[Any, List[_Outbox], Optional[Filter]]] = {}
+        # a writer subscribed by name and by pattern(s) still gets each message once:
+        # it takes it when any of its subscriptions would
+        for w, filters in wanted.items():
+            outbox = outboxes.get(w)
+            if outbox is None or outbox.closed:
+                continue
+            flt = None if None in filters else any_of(filters)
+            key = (id(outbox.protocol), flt.key if flt is not None else None)
+            groups.setdefault(key, (outbox.protocol, [], flt))[1].append(outbox)
+        self.fanout = tuple(
+            (protocol, tuple(group), flt.predicate if flt is not None else None) for protocol, group, flt in groups.values()
+        )
+
+    def set_credential(self, credential: Optional[TopicCredential]) -> None:
+        # grants were for the old password
+        self.credential = credential
+        self.granted.clear()
+
+    def set_dead_letter(self, topic: Optional[str]) -> None:
+        self.dead_letter = topic
+        # expired messages are only worth keeping while there is somewhere to move them
+        self.queue.dead = self.dead if topic is not None else None
+
+
+def _credential_record(state: _TopicState) -> Optional[Dict[str, Any]]:
+    return state.credential.to_record() if state.credential is not None else None
+
+
+def _config_record(state: _TopicState) -> Dict[str, Any]:
+    """CONFIG log record of a topic's settings."""
+    return {
+        "t": state.name,
+        "credential": _credential_record(state),
+        "overflow": state.overflow,
+        "durable": state.durable,
+        "dead_letter": state.dead_letter,
+        "max_attempts": state.max_attempts,
+    }
+
+
+# ---------------- Request schema ----------------
+
+class RequestError(ValueError):
+    """A request failed validation; the message goes back to the client as the error text."""
+
+
+class TopicRequest(NamedTuple):
+    topic: str
+    password: Optional[str] = None
+
+
+class PublishRequest(NamedTuple):
+    topic: str
+    payload: Any
+    priority: int  # index into PRIORITY_NAMES
+    ttl: Optional[int] = None  # positive seconds; None: never expires
+    password: Optional[str] = None
+    producer: Any = None  # with seq: idempotent publish (see broker_dedup)
+    seq: Optional[int] = None
+    delay: Optional[float] = None  # seconds until delivery; None: now
+
+
+class BatchRequest(NamedTuple):
+    messages: List[Any]
+    topic: Optional[str] = None  # default for items without their own
+    password: Optional[str] = None
+    producer: Any = None
+
+
+class SubscribeRequest(NamedTuple):
+    topic: str
+    password: Optional[str] = None
+    filter: Any = None
+    from_offset: Any = None
+    from_timestamp: Any = None
+
+
+class ConfigureRequest(NamedTuple):
+    topic: str
+    password: Optional[str] = None
+    overflow: Optional[str] = None
+    durable: Optional[bool] = None
+    retain: Any = None
+    memory_limit: Any = None
+    dead_letter: Any = None
+    max_attempts: Any = None
+
+
+class ConsumeRequest(NamedTuple):
+    topic: str
+    password: Optional[str] = None
+    prefetch: Any = DEFAULT_PREFETCH
+    visibility_timeout: Any = None  # None: the broker default
+
+
+class AckRequest(NamedTuple):
+    topic: str
+    id: int
+    requeue: bool = True
+
+
+class AuthRequest(NamedTuple):
+    topic: str
+    password: Optional[str] = None
+    proof: Optional[str] = None  # hex HMAC of the auth_challenge nonce
+
+
+class CompressionRequest(NamedTuple):
+    codecs: List[str]  # preferred first
+
+
+class Action(NamedTuple):
+    """
+    One request type of the protocol.
+
+    ``validate(msg)`` turns the decoded dict into the request object handed to
+    ``handler(broker, request, writer)``, or raises RequestError; without a
+    validator the handler gets the dict itself.
+    """
+
+    handler: Callable[[Any, Any, Any], Awaitable[None]]
+    validate: Optional[Callable[[Dict[str, Any]], Any]] = None
+
+
+def parse_priority(value: Any) -> int:
+    # exact names are the common case and skip the str()/lower() copies
+    prio = PRIORITY_ORDER.get(value) if type(value) is str else None
+    if prio is None:
+        prio = PRIORITY_ORDER.get(str(value).lower())
+        if prio is None:
+            raise RequestError("Invalid 'priority' (use high|normal|low)")
+    return prio
+
+
+def parse_producer(producer: Any, seq: Any) -> Optional[int]:
+    """Validated "seq" of an idempotent publish; None without a "producer"."""
+    if producer is None:
+        return None
+    if not isinstance(producer, (str, int)) or isinstance(producer, bool):
+        raise RequestError("Invalid 'producer' (string or integer expected)")
+    if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+        raise RequestError("Invalid 'seq' (non-negative integer expected with 'producer')")
+    return seq
+
+
+def parse_timestamp(value: Any, field: str) -> float:
+    """Epoch seconds of a number or an ISO 8601 string (UTC unless it has an offset)."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        raise RequestError(f"Invalid '{field}' (ISO 8601 or epoch seconds expected)") from None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def parse_delay(delay: Any, deliver_at: Any) -> Optional[float]:
+    """Seconds until a message is delivered, from "delay" or "deliver_at"; None for right away."""
+    if delay is not None:
+        if deliver_at is not None:
+            raise RequestError("Use either 'delay' or 'deliver_at'")
+        if not isinstance(delay, (int, float)) or isinstance(delay, bool) or not math.isfinite(delay):
+            raise RequestError("Invalid 'delay' (seconds expected)")
+        seconds = float(delay)
+    elif deliver_at is not None:
+        seconds = parse_timestamp(deliver_at, "deliver_at") - time.time()
+        if not math.isfinite(seconds):
+            raise RequestError("Invalid 'deliver_at' (ISO 8601 or epoch seconds expected)")
+    else:
+        return None
+    return seconds if seconds > 0 else None
+
+
+def parse_ttl(value: Any) -> Optional[int]:
+    """Seconds to live, or None for no expiry (absent or not positive)."""
+    if value is None:
+        return None
+    try:
+        ttl = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise RequestError("Invalid 'ttl' (seconds expected)") from None
+    return ttl if ttl > 0 else None
+
+
+# returned by _publish_one for a publish stored before (same producer, topic and seq)
+_DUPLICATE = "duplicate"
+
+
+# Validators build their request with tuple.__new__ and every field given: the
+# generated NamedTuple.__new__ is a Python-level call and costs more than the rest
+# of the validation.
+_new_request = tuple.__new__
+
+
+def validate_topic(msg: Dict[str, Any]) -> TopicRequest:
+    topic = msg.get("topic")
+    if not topic:
+        raise RequestError("Missing 'topic' field")
+    return _new_request(TopicRequest, (topic, msg.get("password")))
+
+
+def validate_publish(msg: Dict[str, Any]) -> PublishRequest:
+    topic = msg.get("topic")
+    payload = msg.get("message")
+    if topic is None or payload is None:
+        raise RequestError("Missing 'topic' or 'message' field")
+    producer = msg.get("producer")
+    return _new_request(
+        PublishRequest,
+        (
+            topic,
+            payload,
+            parse_priority(msg.get("priority", "normal")),
+            parse_ttl(msg.get("ttl")),
+            msg.get("password"),
+            producer,
+            parse_producer(producer, msg.get("seq")) if producer is not None else None,
+            parse_delay(msg.get("delay"), msg.get("deliver_at")),
+        ),
+    )
+
+
+def validate_publish_batch(msg: Dict[str, Any]) -> BatchRequest:
+    messages = msg.get("messages")
+    if not isinstance(messages, list) or not messages:
+        raise RequestError("Missing or empty 'messages' list")
+    return _new_request(BatchRequest, (messages, msg.get("topic"), msg.get("password"), msg.get("producer")))
+
+
+def validate_subscribe(msg: Dict[str, Any]) -> SubscribeRequest:
+    topic = msg.get("topic")
+    if not topic:
+        raise RequestError("Missing 'topic' field")
+    return _new_request(
+        SubscribeRequest,
+        (topic, msg.get("password"), msg.get("filter"), msg.get("from_offset"), msg.get("from_timestamp")),
+    )
+
+
+def validate_configure(msg: Dict[str, Any]) -> ConfigureRequest:
+    topic = msg.get("topic")
+    if not topic:
+        raise RequestError("Missing 'topic' field")
+    return _new_request(
+        ConfigureRequest,
+        (
+            topic,
+            msg.get("password"),
+            msg.get("overflow"),
+            msg.get("durable"),
+            msg.get("retain"),
+            msg.get("memory_limit"),
+            msg.get("dead_letter"),
+            msg.get("max_attempts"),
+        ),
+    )
+
+
+def validate_consume(msg: Dict[str, Any]) -> ConsumeRequest:
+    topic = msg.get("topic")
+    if not topic:
+        raise RequestError("Missing 'topic' field")
+    return _new_request(
+        ConsumeRequest,
+        (topic, msg.get("password"), msg.get("prefetch", DEFAULT_PREFETCH), msg.get("visibility_timeout")),
+    )
+
+
+def validate_ack(msg: Dict[str, Any]) -> AckRequest:
+    topic = msg.get("topic")
+    delivery_id = msg.get("id")
+    if not topic or not isinstance(delivery_id, int):
+        raise RequestError("Missing 'topic' or 'id' field")
+    return _new_request(AckRequest, (topic, delivery_id, bool(msg.get("requeue", True))))
+
+
+def validate_auth(msg: Dict[str, Any]) -> AuthRequest:
+    topic = msg.get("topic")
+    if not topic:
+        raise RequestError("Missing 'topic' field")
+    password, proof = msg.get("password"), msg.get("proof")
+    if password is None and proof is None:
+        raise RequestError("Missing 'password' or 'proof' field")
+    return _new_request(AuthRequest, (topic, password, proof))
+
+
+def validate_compression(msg: Dict[str, Any]) -> CompressionRequest:
+    codecs = msg.get("codecs")
+    if isinstance(codecs, str):
+        codecs = [codecs]
+    if not isinstance(codecs, list) or not all(isinstance(name, str) for name in codecs):
+        raise RequestError("Missing or invalid 'codecs' list")
+    return _new_request(CompressionRequest, (codecs,))
+
 
 class HomeworkBroker:
     """
     Асинхронный брокер сообщений на asyncio Streams.
 
     Возможности:
-    - Публикация/подписка по топикам
+    - Публикация/подписка по топикам, фильтры подписки по полям сообщения
+    - Иерархические топики (уровни через точку) и подписка по шаблонам:
+      "*" — ровно один уровень, "#" — любое число уровней (orders.*, metrics.#)
     - list_topics / queue_length / clear_topic
     - Приоритеты сообщений: high, normal, low
     - TTL для сообщений (секунды)
-    - Простейшая авторизация топиков (пароли при публикации/подписке)
+    - Пароли топиков: хранятся как соль + PBKDF2, проверяются один раз на
+      соединение (action "auth" или пароль в запросе) — дальше по кэшу допусков
+    - Ограниченная очередь отправки для каждого подписчика с политикой
+      переполнения на уровне топика (drop_oldest, drop_newest, disconnect)
+    - Очередь заданий: consume с окном prefetch, ack/nack и повторная
+      доставка после visibility timeout
+    - Метрики: счётчики и гистограммы задержек (action "stats", HTTP /metrics)
+    - Квоты памяти на очереди (общая и на топик) с вытеснением на диск и
+      отказом издателям, когда заполнен и диск
+    - Сжатие кадров в framed-режиме (action "compression": zstd или zlib
+      со словарём), сообщение сжимается один раз для всех подписчиков
 
     Формат сообщения от клиента (JSON per line):
     {
-      "action": "publish" | "subscribe" | "unsubscribe" | "list_topics" |
-                "queue_length" | "clear_topic",
+      "action": "publish" | "publish_batch" | "subscribe" | "unsubscribe" |
+                "consume" | "ack" | "nack" | "list_topics" | "queue_length" |
+                "clear_topic" | "configure_topic" | "stats" | "auth_challenge" | "auth" |
+                "compression",
       ... прочие поля ...
     }
     """
 
-    def __init__(self) -> None:
-        # topic -> asyncio.PriorityQueue of items
-        # item: (priority_int, created_ts, sequence_id, payload_dict)
-        self.queues: Dict[str, asyncio.PriorityQueue] = {}
-        # topic -> set of writers subscribed
-        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
-        # topic -> password (optional)
-        self.topic_passwords: Dict[str, str] = {}
+    def __init__(
+        self,
+        send_queue_size: int = DEFAULT_SEND_QUEUE_SIZE,
+        overflow_policy: str = "drop_oldest",
+        sweep_interval: float = DEFAULT_SWEEP_INTERVAL,
+        visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT,
+        data_dir: Optional[str] = None,
+        fsync: str = "always",
+        retain: int = DEFAULT_RETAIN,
+        metrics: bool = True,
+        memory_limit: Optional[int] = None,
+        topic_memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        spill_limit: Optional[int] = None,
+        dedup_producers: int = DEDUP_MAX_PRODUCERS,
+        timer_tick: float = TIMER_TICK,
+        compression_codecs: Optional[Iterable[str]] = None,
+        compression_min_size: int = COMPRESSION_MIN_SIZE,
+        compression_dictionary: bytes = DEFAULT_DICTIONARY,
+    ) -> None:
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}'")
+        codecs = available_codecs() if compression_codecs is None else tuple(compression_codecs)
+        unknown = set(codecs) - set(available_codecs())
+        if unknown:
+            raise ValueError(f"Compression not available: {', '.join(sorted(unknown))}")
+        if spill_limit is not None and spill_dir is None:
+            raise ValueError("spill_limit needs a spill_dir")
+        # topic -> its state; each topic has its own lock, so unrelated topics never contend
+        self.topics: Dict[str, _TopicState] = {}
+        # writer -> names of topics it is subscribed to (reverse index for cleanup)
+        self._writer_topics: Dict[asyncio.StreamWriter, Set[str]] = {}
+        # wildcard subscriptions: (writer, pattern) -> (password, filter), and writer -> its patterns
+        self._patterns = TopicTrie()
+        self._writer_patterns: Dict[asyncio.StreamWriter, Set[str]] = {}
+        # writer -> wire protocol negotiated at connect (NLJSON when absent)
+        self._protocols: Dict[asyncio.StreamWriter, Any] = {}
+        # frame compression offered by the "compression" action; one protocol object per
+        # (codec, compression), shared by its connections so fan-out compresses a message once
+        self.compression_codecs = codecs
+        self.compression_min_size = compression_min_size
+        self.compression_dictionary = compression_dictionary
+        self._compressed_protocols: Dict[Tuple[str, str], _FramedProtocol] = {}
+        # writer -> responses buffered while a pipelined chunk is processed
+        self._pending_responses: Dict[asyncio.StreamWriter, List[bytes]] = {}
+        # writer -> topics it has proven the password of (see broker_auth.Grants)
+        self._grants: Dict[asyncio.StreamWriter, Grants] = {}
+        # topic -> task checking pattern subscribers' passwords (a grant was evicted or the password changed)
+        self._pattern_checks: Dict[str, asyncio.Task] = {}
+        # writer -> "request_id" of the request being handled, echoed in its responses
+        self._request_ids: Dict[asyncio.StreamWriter, Any] = {}
+        # subscriber writer -> its bounded outbound queue
+        self._outboxes: Dict[asyncio.StreamWriter, _Outbox] = {}
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = overflow_policy
+        self.retain = retain
+        # writer -> topic -> task streaming retained messages before live push starts
+        self._replays: Dict[asyncio.StreamWriter, Dict[str, asyncio.Task]] = {}
+        # counters and latency histograms behind the "stats" action (None: not collected)
+        self.metrics: Optional[Metrics] = Metrics() if metrics else None
+        self._client_count = 0
+        # memory quotas of queued messages (bytes; None: unlimited) and the disk they overflow to
+        self._memory = _MemoryBudget(memory_limit) if memory_limit is not None else None
+        self.topic_memory_limit = topic_memory_limit
+        self._spill: Optional[SpillStore] = SpillStore(spill_dir, spill_limit) if spill_dir is not None else None
+        # recently stored "seq" numbers of idempotent publishers, per (producer, topic)
+        self._dedup = DedupIndex(max_producers=dedup_producers)
+        # action name -> handler and validator; a copy, so register_action stays per broker
+        self._actions: Dict[str, Action] = dict(ACTIONS)
 
         # strictly increasing sequence for queue ordering
         self._seq = 0
-        # protect small critical sections
-        self._lock = asyncio.Lock()
+        # topics that hold messages with a TTL or unacked deliveries; walked by the sweeper
+        self._ttl_topics: Set[str] = set()
+        self._inflight_topics: Set[str] = set()
+        # topics with a dead-letter topic; the sweeper moves what they give up on
+        self._dead_letter_topics: Set[str] = set()
+        self.sweep_interval = sweep_interval
+        self.visibility_timeout = visibility_timeout
+        self._sweeper: Optional[asyncio.Task] = None
+        # delayed publishes of all topics, released by one task while any are pending
+        self._timers = TimingWheel(tick=timer_tick)
+        self._timer_task: Optional[asyncio.Task] = None
+
+        # durable topics are logged here and rebuilt from it on startup
+        self._wal: Optional[WriteAheadLog] = None
+        if data_dir is not None:
+            self._wal = WriteAheadLog(data_dir, fsync=fsync)
+            self._recover()
 
     # ---------------- Core stream handling ----------------
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-        addr = writer.get_extra_info("peername")
+        self._client_opened()
         try:
-            while True:
-                line = await reader.readline()
-                if not line:
-                    break
-                await self.process_message(line, writer)
+            first = await reader.read(1)
+            if first == FRAMED_MAGIC[:1]:
+                await self._handle_framed(reader, writer)
+            elif first:
+                # plain NLJSON client: the byte we peeked starts its first line
+                buf = bytearray(first)
+                await self._serve_pipelined(reader, writer, buf, split_lines)
+                if buf:
+                    # last line without a trailing newline
+                    await self.process_message(bytes(buf), writer)
         except asyncio.CancelledError:
             raise
         except Exception as e:
@@ -79,124 +1243,510 @@ class HomeworkBroker:
             err = {"status": "error", "message": f"Server exception: {e.__class__.__name__}"}
             await self.send_response(err, writer)
         finally:
-            # remove writer from all subscribers sets
-            await self._cleanup_writer(writer)
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except Exception:
-                pass
+            await self._client_closed(writer)
+
+    def _client_opened(self) -> None:
+        self._client_count += 1
+        if self.metrics is not None:
+            self.metrics.counters["connections_opened"] += 1
+
+    async def _client_closed(self, writer: asyncio.StreamWriter) -> None:
+        # remove writer from all subscribers sets
+        await self._cleanup_writer(writer)
+        self._protocols.pop(writer, None)
+        self._client_count -= 1
+        if self.metrics is not None:
+            self.metrics.counters["connections_closed"] += 1
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def _handle_framed(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # the first magic byte was already consumed by handle_client
+        hello = await reader.readexactly(len(FRAMED_MAGIC))
+        if hello[:-1] != FRAMED_MAGIC[1:]:
+            return
+        protocol = _FramedProtocol.negotiate(hello[-1:])
+        self._protocols[writer] = protocol
+        writer.write(FRAMED_MAGIC + protocol.codec_byte)
+        await writer.drain()
+        await self._serve_pipelined(reader, writer, bytearray(), split_frames)
+
+    async def _serve_pipelined(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        buf: bytearray,
+        split: Callable[[bytearray], List[bytes]],
+    ) -> None:
+        """Handle every complete request already buffered, then answer them with one write."""
+        while True:
+            requests = split(buf)
+            if requests:
+                self._pending_responses[writer] = []
+                try:
+                    for raw in requests:
+                        await self.process_message(raw, writer)
+                finally:
+                    await self._flush_responses(writer)
+            data = await reader.read(READ_CHUNK_SIZE)
+            if not data:
+                return
+            buf += data
+
+    async def _flush_responses(self, writer: asyncio.StreamWriter) -> None:
+        pending = self._pending_responses.pop(writer, None)
+        if pending:
+            start = time.perf_counter_ns()
+            writer.writelines(pending)
+            await writer.drain()
+            if self.metrics is not None:
+                self.metrics.observe("send_response", start)
 
     async def _cleanup_writer(self, writer: asyncio.StreamWriter) -> None:
-        async with self._lock:
-            for topic, subs in self.subscribers.items():
-                subs.discard(writer)
+        for task in self._replays.pop(writer, {}).values():
+            task.cancel()
+        # only the topics this client subscribed to are touched
+        for name in self._writer_topics.pop(writer, ()):
+            state = self.topics.get(name)
+            if state is not None:
+                async with state.lock:
+                    state.subscribers.discard(writer)
+                    state.filters.pop(writer, None)
+                    self._rebuild_fanout(state)
+                    self._remove_consumer(state, writer)
+        for pattern in self._writer_patterns.pop(writer, ()):
+            self._patterns.remove(pattern, (writer, pattern))
+            await self._refresh_pattern(pattern)
+        outbox = self._outboxes.pop(writer, None)
+        if outbox is not None:
+            outbox.close()
+        grants = self._grants.pop(writer, None)
+        if grants is not None:
+            grants.revoke()
+
+    def _outbox_for(self, writer: asyncio.StreamWriter) -> _Outbox:
+        outbox = self._outboxes.get(writer)
+        if outbox is None:
+            protocol = self._protocols.get(writer, _NLJSONProtocol)
+            outbox = self._outboxes[writer] = _Outbox(writer, self.send_queue_size, protocol, self.metrics)
+        return outbox
+
+    def _get_or_create_topic(self, topic: str, password: Optional[str] = None) -> _TopicState:
+        # dict lookup and insert run without awaiting, so no registry lock is needed
+        state = self.topics.get(topic)
+        if state is None:
+            state = _TopicState(topic, TopicCredential.create(password) if password else None, self.retain)
+            queue = state.queue
+            queue.limit = self.topic_memory_limit
+            queue.budget = self._memory
+            if self._spill is not None:
+                queue.spill = self._spill.topic()
+            self.topics[topic] = state
+            if len(self._patterns):
+                if password:
+                    self._grant_patterns(state, password)
+                self._rebuild_fanout(state)
+        return state
+
+    def _grant_patterns(self, state: _TopicState, password: str) -> None:
+        # the creator's password is at hand, so pattern subscribers are checked against it without hashing
+        for (w, _), (given, _) in self._patterns.match(state.name):
+            if given is None:
+                continue
+            if same_password(given, password):
+                self._grants_of(w).add(state.name, state.granted)
+            else:
+                self._grants_of(w).refuse(state.name, state.credential, given)
+
+    def _known_access(self, state: _TopicState, password: Optional[str], writer: Any) -> Optional[bool]:
+        """The access answer when it needs no hashing (granted, public, no password, refused before), else None."""
+        credential = state.credential
+        if credential is None or writer in state.granted:
+            return True
+        if password is None:
+            return False
+        grants = self._grants.get(writer)
+        if grants is not None and grants.was_refused(state.name, credential, password):
+            return False
+        return None
+
+    async def _verify(self, state: _TopicState, password: Any, writer: Any) -> bool:
+        """Hash ``password`` off the event loop and remember the answer for this connection and topic."""
+        credential = state.credential
+        grants = self._grants_of(writer)
+        ok = await asyncio.get_running_loop().run_in_executor(None, credential.verify, password)
+        if self._grants.get(writer) is not grants:
+            # the connection closed meanwhile
+            return False
+        if state.credential is not credential:
+            # the password changed meanwhile: check against the new one
+            known = self._known_access(state, password, writer)
+            return known if known is not None else await self._verify(state, password, writer)
+        if ok:
+            grants.add(state.name, state.granted)
+        else:
+            grants.refuse(state.name, credential, password)
+        return ok
+
+    async def _authorized(self, state: _TopicState, password: Optional[str], writer: Any) -> bool:
+        """Access check of the hot path: one set lookup; a password is hashed once per connection and topic."""
+        ok = self._known_access(state, password, writer)
+        if ok is None:
+            ok = await self._verify(state, password, writer)
+        if not ok and password is not None and self.metrics is not None:
+            self.metrics.counters["auth_failures"] += 1
+        return ok
+
+    def _grants_of(self, writer: Any) -> Grants:
+        grants = self._grants.get(writer)
+        if grants is None:
+            grants = self._grants[writer] = Grants(writer)
+        return grants
 
     async def send_response(self, obj: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
-        writer.write(_NLJSONProtocol.encode(obj))
+        metrics = self.metrics
+        if metrics is not None and obj.get("status") == "error":
+            metrics.counters["request_errors"] += 1
+        if self._request_ids:
+            request_id = self._request_ids.get(writer)
+            if request_id is not None:
+                obj["request_id"] = request_id
+        data = self._protocols.get(writer, _NLJSONProtocol).encode(obj)
+        pending = self._pending_responses.get(writer)
+        if pending is not None:
+            # inside a pipelined read: coalesced into one write by _flush_responses (timed there)
+            pending.append(data)
+            return
+        start = time.perf_counter_ns()
+        writer.write(data)
         await writer.drain()
+        if metrics is not None:
+            metrics.observe("send_response", start)
 
     # ---------------- Message processing ----------------
 
     async def process_message(self, raw_line: bytes, writer: asyncio.StreamWriter) -> None:
+        metrics = self.metrics
+        start = time.perf_counter_ns() if metrics is not None else 0
+        protocol = self._protocols.get(writer, _NLJSONProtocol)
         try:
-            msg = _NLJSONProtocol.decode_line(raw_line)
-        except json.JSONDecodeError:
-            await self.send_response({"status": "error", "message": "Invalid JSON format"}, writer)
-            return
-
-        action = msg.get("action")
-        if not action:
-            await self.send_response({"status": "error", "message": "Missing 'action' field"}, writer)
-            return
-
-        # Route actions
-        if action == "list_topics":
-            await self.list_topics(writer)
-            return
-
-        if action == "queue_length":
-            topic = msg.get("topic")
-            if not topic:
-                await self.send_response({"status": "error", "message": "Missing 'topic' field"}, writer)
+            try:
+                msg = protocol.decode(raw_line)
+            except ValueError:
+                await self.send_response({"status": "error", "message": protocol.decode_error}, writer)
                 return
-            await self.queue_length(topic, writer)
-            return
-
-        if action == "clear_topic":
-            topic = msg.get("topic")
-            if not topic:
-                await self.send_response({"status": "error", "message": "Missing 'topic' field"}, writer)
+            if not isinstance(msg, dict):
+                await self.send_response({"status": "error", "message": "Message must be an object"}, writer)
                 return
-            await self.clear_topic(topic, msg.get("password"), writer)
-            return
-
-        if action == "publish":
-            topic = msg.get("topic")
-            payload = msg.get("message")
-            if topic is None or payload is None:
-                await self.send_response({"status": "error", "message": "Missing 'topic' or 'message' field"}, writer)
+            request_id = msg.get("request_id")
+            if request_id is None:
+                await self.handle_request(msg, writer)
                 return
-            priority = msg.get("priority", "normal")
-            ttl = msg.get("ttl")  # seconds
-            password = msg.get("password")
-            await self.publish(topic, payload, priority=priority, ttl=ttl, password=password, writer=writer)
-            return
+            # clients that pipeline requests match the responses by this id
+            self._request_ids[writer] = request_id
+            try:
+                await self.handle_request(msg, writer)
+            finally:
+                self._request_ids.pop(writer, None)
+        finally:
+            if metrics is not None:
+                metrics.observe("process_message", start)
 
-        if action == "subscribe":
-            topic = msg.get("topic")
-            if not topic:
-                await self.send_response({"status": "error", "message": "Missing 'topic' field"}, writer)
-                return
-            password = msg.get("password")
-            await self.subscribe(topic, writer, password=password)
+    async def handle_request(self, msg: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
+        """Route one decoded request to its registered action: one dict lookup, then its validator."""
+        name = msg.get("action")
+        try:
+            action = self._actions.get(name)
+        except TypeError:  # unhashable "action" value
+            action = None
+        if action is None:
+            message = f"Unknown action '{name}'" if name else "Missing 'action' field"
+            await self.send_response({"status": "error", "message": message}, writer)
             return
-
-        if action == "unsubscribe":
-            topic = msg.get("topic")
-            if not topic:
-                await self.send_response({"status": "error", "message": "Missing 'topic' field"}, writer)
+        handler, validate = action
+        request: Any = msg
+        if validate is not None:
+            try:
+                request = validate(msg)
+            except RequestError as e:
+                await self.send_response({"status": "error", "message": str(e)}, writer)
                 return
-            await self.unsubscribe(topic, writer)
-            return
+        await handler(self, request, writer)
 
-        await self.send_response({"status": "error", "message": f"Unknown action '{action}'"}, writer)
+    def register_action(
+        self,
+        name: str,
+        handler: Callable[[Any, Any, Any], Awaitable[None]],
+        validate: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ) -> None:
+        """
+        Add (or replace) an action of this broker.
+
+        ``handler(broker, request, writer)`` answers with ``broker.send_response``;
+        ``validate(msg)`` builds ``request`` from the decoded dict and raises
+        RequestError to reject it. Without a validator the handler gets the dict.
+        """
+        self._actions[name] = Action(handler, validate)
 
     # ---------------- Topic utilities ----------------
 
     async def list_topics(self, writer: asyncio.StreamWriter) -> None:
-        async with self._lock:
-            topics = sorted(self.queues.keys())
+        topics = sorted(self.topics.keys())
         await self.send_response({"status": "success", "topics": topics}, writer)
 
+    async def stats(self, writer: asyncio.StreamWriter) -> None:
+        if self.metrics is None:
+            await self.send_response({"status": "error", "message": "Metrics are disabled"}, writer)
+            return
+        await self.send_response({"status": "success", "stats": self.stats_snapshot()}, writer)
+
+    def stats_snapshot(self) -> Dict[str, Any]:
+        """Counters, current gauges and latency percentiles (microseconds) as one JSON object."""
+        assert self.metrics is not None
+        return self.metrics.snapshot(self._gauges(), self._state_counters())
+
+    def render_metrics(self) -> str:
+        """The same numbers in Prometheus text exposition format."""
+        assert self.metrics is not None
+        return self.metrics.render(self._gauges(), self._state_counters())
+
+    def _state_counters(self) -> Dict[str, Any]:
+        dropped: Dict[str, int] = {}
+        for state in self.topics.values():
+            for policy, n in state.dropped.items():
+                dropped[policy] = dropped.get(policy, 0) + n
+        counters: Dict[str, Any] = {"messages_dropped": dropped}
+        if self._spill is not None:
+            counters["messages_spilled"] = self._spill.written
+        return counters
+
+    def _gauges(self) -> Dict[str, Any]:
+        return {
+            "connections": self._client_count,
+            "topics": len(self.topics),
+            "subscribers": sum(len(s.subscribers) for s in self.topics.values()),
+            "pattern_subscriptions": len(self._patterns),
+            "consumers": sum(len(s.consumers) for s in self.topics.values()),
+            "inflight": sum(len(s.inflight) for s in self.topics.values()),
+            "outbox_pending": sum(len(o.pending) for o in self._outboxes.values()),
+            "queue_depth": {name: len(s.queue) for name, s in self.topics.items()},
+            "queue_memory_bytes": sum(s.queue.bytes for s in self.topics.values()),
+            "spilled_messages": self._spill.messages if self._spill is not None else 0,
+            "spill_bytes": self._spill.used if self._spill is not None else 0,
+            "dedup_windows": len(self._dedup),
+            "delayed_pending": len(self._timers),
+            "dead_letters_pending": sum(len(self.topics[t].dead) for t in self._dead_letter_topics),
+        }
+
     async def queue_length(self, topic: str, writer: asyncio.StreamWriter) -> None:
-        async with self._lock:
-            q = self.queues.get(topic)
-        if q is None:
+        state = self.topics.get(topic)
+        if state is None:
             await self.send_response({"status": "error", "message": f"Topic '{topic}' does not exist"}, writer)
             return
         await self._purge_expired(topic)
-        size = q.qsize()
-        await self.send_response({"status": "success", "topic": topic, "messages": size}, writer)
+        queue = state.queue
+        response = {"status": "success", "topic": topic, "messages": len(queue), "dropped": dict(state.dropped)}
+        if queue.limit is not None or queue.budget is not None:
+            response["memory_bytes"] = queue.bytes
+            response["spilled"] = queue.spilled
+        await self.send_response(response, writer)
 
     async def clear_topic(self, topic: str, password: Optional[str], writer: asyncio.StreamWriter) -> None:
-        async with self._lock:
-            q = self.queues.get(topic)
-            required = self.topic_passwords.get(topic)
-        if q is None:
+        state = self.topics.get(topic)
+        if state is None:
             await self.send_response({"status": "error", "message": f"Topic '{topic}' does not exist"}, writer)
             return
-        if required is not None and password != required:
+        if not await self._authorized(state, password, writer):
             await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
             return
         # Drain queue
-        try:
-            while True:
-                q.get_nowait()
-        except asyncio.QueueEmpty:
-            pass
+        async with state.lock:
+            state.queue.clear()
+            if self._journaled(state):
+                self._log(state, broker_wal.CLEAR, {"t": topic, "s": self._seq})
         await self.send_response({"status": "success", "topic": topic, "cleared": True}, writer)
 
+    async def configure_topic(
+        self,
+        topic: str,
+        writer: asyncio.StreamWriter,
+        overflow: Optional[str] = None,
+        password: Optional[str] = None,
+        durable: Optional[bool] = None,
+        retain: Any = None,
+        memory_limit: Any = None,
+        dead_letter: Any = None,
+        max_attempts: Any = None,
+    ) -> None:
+        if overflow is not None and overflow not in OVERFLOW_POLICIES:
+            await self.send_response(
+                {"status": "error", "message": "Invalid 'overflow' (use drop_oldest|drop_newest|disconnect)"}, writer
+            )
+            return
+        if retain is not None and (isinstance(retain, bool) or not isinstance(retain, int) or retain < 0):
+            await self.send_response(
+                {"status": "error", "message": "Invalid 'retain' (non-negative number of messages expected)"}, writer
+            )
+            return
+        if memory_limit is not None and (
+            isinstance(memory_limit, bool) or not isinstance(memory_limit, int) or memory_limit <= 0
+        ):
+            await self.send_response(
+                {"status": "error", "message": "Invalid 'memory_limit' (positive number of bytes expected)"}, writer
+            )
+            return
+        if dead_letter is not None and (
+            not isinstance(dead_letter, str) or is_pattern(dead_letter) or dead_letter == topic
+        ):
+            await self.send_response(
+                {"status": "error", "message": "Invalid 'dead_letter' (another topic name expected, \"\" for none)"},
+                writer,
+            )
+            return
+        if max_attempts is not None and (
+            isinstance(max_attempts, bool) or not isinstance(max_attempts, int) or max_attempts < 0
+        ):
+            await self.send_response(
+                {"status": "error", "message": "Invalid 'max_attempts' (positive number expected, 0 for no limit)"},
+                writer,
+            )
+            return
+        if durable and self._wal is None:
+            await self.send_response(
+                {"status": "error", "message": "Durable topics need the broker to run with a data directory"}, writer
+            )
+            return
+        state = self._get_or_create_topic(topic)
+        if not await self._authorized(state, password, writer):
+            await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
+            return
+        if state.durable and durable is False:
+            await self.send_response({"status": "error", "message": "A durable topic cannot be made transient"}, writer)
+            return
+        if overflow is not None:
+            state.overflow = overflow
+        if retain is not None and retain != state.log.capacity:
+            state.log.resize(retain)
+        if memory_limit is not None:
+            state.queue.limit = memory_limit
+        if durable:
+            state.durable = True
+        if dead_letter is not None:
+            self._set_dead_letter(state, dead_letter or None)
+            if state.dead_letter is not None:
+                self._ensure_sweeper()
+        if max_attempts is not None:
+            state.max_attempts = max_attempts or None
+        if self._journaled(state):
+            self._log(state, broker_wal.CONFIG, _config_record(state))
+        current = state.overflow or self.overflow_policy
+        await self.send_response(
+            {
+                "status": "success",
+                "topic": topic,
+                "overflow": current,
+                "durable": state.durable,
+                "retain": state.log.capacity,
+                "memory_limit": state.queue.limit,
+                "dead_letter": state.dead_letter,
+                "max_attempts": state.max_attempts,
+            },
+            writer,
+        )
+
+    # ---------------- Authentication ----------------
+
+    async def auth_challenge(self, topic: str, writer: asyncio.StreamWriter) -> None:
+        """Start a password proof: the client answers with HMAC(PBKDF2(password, salt), nonce) in "auth"."""
+        state = self.topics.get(topic)
+        if state is None:
+            await self.send_response({"status": "error", "message": f"Topic '{topic}' does not exist"}, writer)
+            return
+        credential = state.credential
+        if credential is None:
+            await self.send_response({"status": "error", "message": f"Topic '{topic}' has no password"}, writer)
+            return
+        nonce = self._grants_of(writer).challenge(topic)
+        await self.send_response(
+            {
+                "status": "success",
+                "topic": topic,
+                "salt": credential.salt.hex(),
+                "iterations": credential.iterations,
+                "nonce": nonce.hex(),
+            },
+            writer,
+        )
+
+    async def auth(self, request: AuthRequest, writer: asyncio.StreamWriter) -> None:
+        """Grant the connection a topic for its lifetime, by password or by the proof of a challenge."""
+        topic = request.topic
+        state = self.topics.get(topic)
+        if state is None:
+            await self.send_response({"status": "error", "message": f"Topic '{topic}' does not exist"}, writer)
+            return
+        credential = state.credential
+        if credential is None:
+            await self.send_response({"status": "error", "message": f"Topic '{topic}' has no password"}, writer)
+            return
+        grants = self._grants_of(writer)
+        if request.proof is not None:
+            # a nonce answers one attempt only
+            nonce = grants.nonces.pop(topic, None)
+            ok = nonce is not None and credential.verify_proof(nonce, request.proof)
+        else:
+            ok = await asyncio.get_running_loop().run_in_executor(None, credential.verify, request.password)
+        if not ok:
+            if self.metrics is not None:
+                self.metrics.counters["auth_failures"] += 1
+            await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
+            return
+        grants.add(topic, state.granted, session=True)
+        await self.send_response({"status": "success", "topic": topic, "authenticated": True}, writer)
+
+    async def compression(self, request: CompressionRequest, writer: asyncio.StreamWriter) -> None:
+        """Switch a framed connection to compressed frames with the first of ``codecs`` the broker offers."""
+        protocol = self._protocols.get(writer)
+        if not isinstance(protocol, _FramedProtocol):
+            await self.send_response({"status": "error", "message": "Compression needs a framed connection"}, writer)
+            return
+        name = pick_codec(request.codecs, self.compression_codecs)
+        if name is None:
+            await self.send_response({"status": "success", "compression": None}, writer)
+            return
+        # the answer itself still goes out uncompressed
+        await self.send_response(
+            {
+                "status": "success",
+                "compression": name,
+                "min_size": self.compression_min_size,
+                "dictionary": base64.b64encode(self.compression_dictionary).decode("ascii"),
+            },
+            writer,
+        )
+        key = (protocol.codec, name)
+        compressed = self._compressed_protocols.get(key)
+        if compressed is None:
+            compressor = Compressor(name, self.compression_dictionary, MAX_FRAME_SIZE)
+            compressed = self._compressed_protocols[key] = _FramedProtocol(
+                protocol.codec, compressor, self.compression_min_size
+            )
+        self._protocols[writer] = compressed
+        outbox = self._outboxes.get(writer)
+        if outbox is not None:
+            # fan-out groups subscribers by protocol: move this one to the compressed group
+            outbox.protocol = compressed
+            for topic in self._writer_topics.get(writer, ()):
+                state = self.topics.get(topic)
+                if state is not None:
+                    async with state.lock:
+                        self._rebuild_fanout(state)
+            for pattern in self._writer_patterns.get(writer, ()):
+                await self._refresh_pattern(pattern)
+
     # ---------------- Pub/Sub ----------------
 
     async def publish(
@@ -207,120 +1757,1135 @@ class HomeworkBroker:
         ttl: Optional[int] = None,
         password: Optional[str] = None,
         writer: Optional[asyncio.StreamWriter] = None,
+        producer: Any = None,
+        seq: Optional[int] = None,
+        delay: Optional[float] = None,
+        deliver_at: Any = None,
     ) -> None:
-        prio = PRIORITY_ORDER.get(str(priority).lower())
-        if prio is None:
-            await self.send_response({"status": "error", "message": "Invalid 'priority' (use high|normal|low)"}, writer)
+        try:
+            request = PublishRequest(
+                topic,
+                payload,
+                parse_priority(priority),
+                parse_ttl(ttl),
+                password,
+                producer,
+                parse_producer(producer, seq),
+                parse_delay(delay, deliver_at),
+            )
+        except RequestError as e:
+            await self.send_response({"status": "error", "message": str(e)}, writer)
+            return
+        await self._publish(request, writer)
+
+    async def _publish(self, request: PublishRequest, writer: Optional[asyncio.StreamWriter]) -> None:
+        commits: List[asyncio.Future] = []
+        error = await self._publish_one(
+            request.topic,
+            request.payload,
+            request.priority,
+            request.ttl,
+            request.password,
+            commits,
+            writer,
+            request.producer,
+            request.seq,
+            request.delay,
+        )
+        if error is _DUPLICATE:
+            # stored by an earlier attempt: acknowledged again, not stored twice
+            await self.send_response({"status": "success", "topic": request.topic, "duplicate": True}, writer)
             return
-        expires_at: Optional[datetime] = None
-        if ttl is not None:
+        if error is None and commits:
+            error = await self._wait_commits(commits)
+        if error is not None:
+            await self.send_response({"status": "error", "message": error}, writer)
+            return
+        await self.send_response({"status": "success", "topic": request.topic}, writer)
+
+    async def publish_batch(
+        self,
+        messages: List[Any],
+        writer: asyncio.StreamWriter,
+        topic: Optional[str] = None,
+        password: Optional[str] = None,
+        producer: Any = None,
+    ) -> None:
+        """Publish many messages from one request and answer with a single aggregated ack."""
+        published = 0
+        duplicates = 0
+        errors: List[Dict[str, Any]] = []
+        commits: List[asyncio.Future] = []
+        for index, item in enumerate(messages):
+            if not isinstance(item, dict):
+                errors.append({"index": index, "message": "Batch item must be an object"})
+                continue
+            item_topic = item.get("topic", topic)
+            payload = item.get("message")
+            if item_topic is None or payload is None:
+                errors.append({"index": index, "message": "Missing 'topic' or 'message' field"})
+                continue
+            item_producer = item.get("producer", producer)
             try:
-                ttl_int = int(ttl)
-                if ttl_int > 0:
-                    expires_at = utcnow() + timedelta(seconds=ttl_int)
-            except Exception:
-                await self.send_response({"status": "error", "message": "Invalid 'ttl' (seconds expected)"}, writer)
+                prio = parse_priority(item.get("priority", "normal"))
+                ttl = parse_ttl(item.get("ttl"))
+                seq = parse_producer(item_producer, item.get("seq"))
+                delay = parse_delay(item.get("delay"), item.get("deliver_at"))
+            except RequestError as e:
+                errors.append({"index": index, "message": str(e)})
+                continue
+            error = await self._publish_one(
+                item_topic, payload, prio, ttl, item.get("password", password), commits, writer, item_producer, seq, delay
+            )
+            if error is _DUPLICATE:
+                duplicates += 1
+            elif error is not None:
+                errors.append({"index": index, "message": error})
+            else:
+                published += 1
+        # one group commit covers the whole batch
+        if commits:
+            error = await self._wait_commits(commits)
+            if error is not None:
+                await self.send_response({"status": "error", "published": 0, "message": error}, writer)
                 return
+        response: Dict[str, Any] = {
+            "status": "success" if published or duplicates else "error",
+            "published": published,
+        }
+        if duplicates:
+            response["duplicates"] = duplicates
+        if errors:
+            response["errors"] = errors
+        await self.send_response(response, writer)
 
-        async with self._lock:
-            q = self.queues.get(topic)
-            if q is None:
-                # create new topic on first publish; store password if provided
-                q = asyncio.PriorityQueue()
-                self.queues[topic] = q
-                if password:
-                    self.topic_passwords[topic] = password
-            required = self.topic_passwords.get(topic)
+    async def _publish_one(
+        self,
+        topic: str,
+        payload: Any,
+        prio: int = PRIORITY_ORDER["normal"],
+        ttl: Optional[int] = None,
+        password: Optional[str] = None,
+        commits: Optional[List[asyncio.Future]] = None,
+        writer: Any = None,
+        producer: Any = None,
+        seq: Optional[int] = None,
+        delay: Optional[float] = None,
+        released: bool = False,
+    ) -> Optional[str]:
+        """
+        Store and fan out one message; returns an error message instead of raising.
 
-            # If topic has a password, require it for publishing too.
-            if required is not None and password != required:
-                await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
-                return
+        ``prio`` and ``ttl`` come already validated (parse_priority / parse_ttl).
+        For durable topics the pending fsync is appended to ``commits``; the caller
+        acknowledges the publish only after it resolves. With a ``producer`` a
+        ``seq`` already stored for it and the topic returns ``_DUPLICATE``. With a
+        ``delay`` the message waits in the timer wheel instead; its release comes
+        back here with ``released`` set, the checks having been made at publish.
+        """
+        if is_pattern(topic):
+            return "Wildcards are only allowed in subscribe and unsubscribe"
+        deadline = time.monotonic() + ttl if ttl is not None else None
+
+        # create new topic on first publish; store password if provided
+        state = self._get_or_create_topic(topic, password)
+
+        # If topic has a password, require it for publishing too.
+        if not released and not await self._authorized(state, password, writer):
+            return "Forbidden: wrong password"
 
+        metrics = self.metrics
+        # only contended acquisitions are timed; the uncontended path costs one check
+        lock_wait = time.perf_counter_ns() if metrics is not None and state.lock.locked() else 0
+        async with state.lock:
+            if lock_wait:
+                metrics.observe("lock_wait", lock_wait)
+            if delay is not None and self._journaled(state):
+                # the timer wheel is memory only: acking would promise what a restart or failover loses
+                return f"Topic '{topic}' is durable: delay and deliver_at are not supported"
+            if producer is not None:
+                # checked and recorded under the topic lock, so concurrent retries cannot both pass
+                seen = self._dedup.check((producer, topic), seq)
+                if seen != FRESH:
+                    if seen == DUPLICATE:
+                        if metrics is not None:
+                            metrics.counters["publishes_deduplicated"] += 1
+                        return _DUPLICATE
+                    return f"Sequence number {seq} of producer '{producer}' is older than the dedup window"
+            if delay is not None:
+                # stored when due; a retry in the meantime is still a duplicate
+                if producer is not None:
+                    self._dedup.add((producer, topic), seq)
+                self._timers.schedule(time.monotonic() + delay, (topic, payload, prio, ttl))
+                if metrics is not None:
+                    metrics.counters["messages_delayed"] += 1
+                if self._timer_task is None or self._timer_task.done():
+                    self._timer_task = asyncio.create_task(self._release_delayed())
+                return None
+            message = _Message(prio, self._seq + 1, time.time(), deadline, payload)
+            if not state.queue.put(message):
+                # memory and disk quotas are both used up: push back on the publisher
+                if metrics is not None:
+                    metrics.counters["publishes_rejected"] += 1
+                return f"Topic '{topic}' is full, retry later"
             self._seq += 1
-            item = (prio, utcnow().timestamp(), self._seq, {"data": payload, "expires_at": expires_at.isoformat() if expires_at else None})
-            await q.put(item)
+            if producer is not None:
+                self._dedup.add((producer, topic), seq)
+            offset = state.log.append(message)
+            fanout = state.fanout
+            if self._journaled(state):
+                expires = message.created + ttl if ttl is not None else None
+                record = broker_wal.put_record(topic, self._seq, prio, message.created, expires, payload)
+                self._log(state, broker_wal.PUT, record, commits)
+        if deadline is not None:
+            self._ttl_topics.add(topic)
+            self._ensure_sweeper()
 
-            # Copy subscribers to avoid holding the lock while IO
-            subs = list(self.subscribers.get(topic, set()))
+        # Hand the message to every subscriber's outbound queue; never wait on their sockets.
+        # The envelope is serialized once per wire protocol and the same bytes go to everyone;
+        # each distinct filter is evaluated once, however many subscribers share it.
+        if metrics is not None:
+            metrics.counters["messages_published"] += 1
+        if fanout:
+            start = time.perf_counter_ns() if metrics is not None else 0
+            delivered = 0
+            policy = state.overflow or self.overflow_policy
+            priority_name = PRIORITY_NAMES[prio]
+            expires_iso = message.expires_iso() if deadline is not None else None
+            disconnected = undelivered = False
+            encoded: Dict[Any, bytes] = {}
+            verdicts: Dict[Callable[[Any], bool], bool] = {}
+            for protocol, outboxes, predicate in fanout:
+                if predicate is not None:
+                    passed = verdicts.get(predicate)
+                    if passed is None:
+                        passed = verdicts[predicate] = predicate(payload)
+                    if not passed:
+                        continue
+                data = encoded.get(protocol)
+                if data is None:
+                    data = encoded[protocol] = protocol.encode_message(topic, payload, priority_name, expires_iso, offset)
+                delivered += len(outboxes)
+                for outbox in outboxes:
+                    try:
+                        dropped = outbox.put(data, policy)
+                    except Exception:
+                        # broken connection; cleanup will happen in handle_client
+                        dropped = "disconnect"
+                        outbox.close()
+                    if dropped is not None:
+                        state.dropped[dropped] = state.dropped.get(dropped, 0) + 1
+                        if dropped != "drop_oldest":
+                            undelivered = True  # this message, not an older one, missed a subscriber
+                        if dropped == "disconnect":
+                            state.subscribers.discard(outbox.writer)
+                            state.filters.pop(outbox.writer, None)
+                            disconnected = True
+            if disconnected:
+                self._rebuild_fanout(state)
+            if undelivered and state.dead_letter is not None:
+                state.dead.append((message, "undeliverable"))
+                self._ensure_sweeper()
+            if metrics is not None:
+                metrics.counters["messages_delivered"] += delivered
+                metrics.observe("publish_fanout", start)
 
-        # Push to subscribers
-        if subs:
-            message = {
-                "type": "message",
-                "topic": topic,
-                "payload": payload,
-                "priority": ["high", "normal", "low"][prio],
-            }
-            if expires_at:
-                message["expires_at"] = expires_at.isoformat()
-            data = _NLJSONProtocol.encode(message)
-            for w in subs:
-                try:
-                    w.write(data)
-                except Exception:
-                    # ignore broken connections here; cleanup will happen later
-                    pass
-            # drain concurrently
-            await asyncio.gather(*(w.drain() for w in subs), return_exceptions=True)
-
-        await self.send_response({"status": "success", "topic": topic}, writer)
-
-    async def subscribe(self, topic: str, writer: asyncio.StreamWriter, password: Optional[str] = None) -> None:
-        async with self._lock:
-            # create topic lazily on subscribe too (public topic)
-            if topic not in self.queues:
-                self.queues[topic] = asyncio.PriorityQueue()
-            required = self.topic_passwords.get(topic)
-            if required is not None and password != required:
-                await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
+        if state.consumers:
+            self._dispatch(state)
+        return None
+
+    async def subscribe(
+        self,
+        topic: str,
+        writer: asyncio.StreamWriter,
+        password: Optional[str] = None,
+        filter_spec: Any = None,
+        from_offset: Any = None,
+        from_timestamp: Any = None,
+    ) -> None:
+        """
+        Subscribe to a topic or pattern; with ``filter_spec`` only matching messages are pushed.
+
+        With ``from_offset`` or ``from_timestamp`` the retained messages from that point
+        are streamed first, then the subscription switches to live push.
+        """
+        try:
+            flt = parse_filter(filter_spec)
+        except ValueError as e:
+            await self.send_response({"status": "error", "message": f"Invalid filter: {e}"}, writer)
+            return
+        replay = from_offset is not None or from_timestamp is not None
+        if is_pattern(topic):
+            if replay:
+                await self.send_response(
+                    {"status": "error", "message": "Replay needs a topic name, not a pattern"}, writer
+                )
+                return
+            await self._subscribe_pattern(topic, writer, password, flt)
+            return
+        # create topic lazily on subscribe too (public topic)
+        state = self._get_or_create_topic(topic)
+        if not await self._authorized(state, password, writer):
+            await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
+            return
+        self._outbox_for(writer)
+        if replay:
+            try:
+                start = self._replay_start(state, from_offset, from_timestamp)
+            except ValueError as e:
+                await self.send_response({"status": "error", "message": str(e)}, writer)
                 return
-            self.subscribers.setdefault(topic, set()).add(writer)
-        await self.send_response({"status": "success", "topic": topic, "subscribed": True}, writer)
+            await self._start_replay(state, writer, start, flt)
+            return
+        async with state.lock:
+            state.subscribers.add(writer)
+            # subscribing again replaces the filter
+            if flt is None:
+                state.filters.pop(writer, None)
+            else:
+                state.filters[writer] = flt
+            self._rebuild_fanout(state)
+            # the first live message has this offset; a client can resume from it after a reconnect
+            next_offset = state.log.next
+        self._writer_topics.setdefault(writer, set()).add(topic)
+        await self.send_response(
+            {"status": "success", "topic": topic, "subscribed": True, "next_offset": next_offset}, writer
+        )
 
     async def unsubscribe(self, topic: str, writer: asyncio.StreamWriter) -> None:
-        async with self._lock:
-            subs = self.subscribers.get(topic)
-            if subs:
-                subs.discard(writer)
+        self._cancel_replay(writer, topic)
+        if is_pattern(topic):
+            patterns = self._writer_patterns.get(writer)
+            if patterns and topic in patterns:
+                patterns.discard(topic)
+                self._patterns.remove(topic, (writer, topic))
+                await self._refresh_pattern(topic)
+            await self.send_response({"status": "success", "topic": topic, "unsubscribed": True}, writer)
+            return
+        state = self.topics.get(topic)
+        if state is not None:
+            async with state.lock:
+                state.subscribers.discard(writer)
+                state.filters.pop(writer, None)
+                self._rebuild_fanout(state)
+                self._remove_consumer(state, writer)
+        topics = self._writer_topics.get(writer)
+        if topics:
+            topics.discard(topic)
         await self.send_response({"status": "success", "topic": topic, "unsubscribed": True}, writer)
 
+    # ---------------- Replay ----------------
+
+    @staticmethod
+    def _replay_start(state: _TopicState, from_offset: Any, from_timestamp: Any) -> int:
+        if from_offset is not None:
+            if isinstance(from_offset, bool) or not isinstance(from_offset, int) or from_offset < 0:
+                raise ValueError("Invalid 'from_offset' (non-negative integer expected)")
+            return max(from_offset, state.log.first)
+        try:
+            ts = parse_timestamp(from_timestamp, "from_timestamp")
+        except RequestError as e:
+            raise ValueError(str(e)) from None
+        return state.log.offset_at(ts)
+
+    async def _start_replay(
+        self, state: _TopicState, writer: asyncio.StreamWriter, start: int, flt: Optional[Filter]
+    ) -> None:
+        async with state.lock:
+            # a live subscription would duplicate what the replay sends
+            state.subscribers.discard(writer)
+            state.filters.pop(writer, None)
+            self._rebuild_fanout(state)
+        self._cancel_replay(writer, state.name)
+        self._writer_topics.setdefault(writer, set()).add(state.name)
+        await self.send_response(
+            {
+                "status": "success",
+                "topic": state.name,
+                "subscribed": True,
+                "from_offset": start,
+                "next_offset": state.log.next,
+            },
+            writer,
+        )
+        task = asyncio.create_task(self._replay(state, writer, start, flt))
+        self._replays.setdefault(writer, {})[state.name] = task
+
+    async def _replay(self, state: _TopicState, writer: asyncio.StreamWriter, cursor: int, flt: Optional[Filter]) -> None:
+        """
+        Stream retained messages from ``cursor`` in chunks, then switch the writer to live push.
+
+        The topic lock is never held across an await, so publishers keep going; the
+        writer joins the fan-out in the same step that sees it has caught up, which
+        leaves neither a gap nor a duplicate between the backlog and live messages.
+        """
+        outbox = self._outbox_for(writer)
+        protocol = outbox.protocol
+        log = state.log
+        try:
+            while True:
+                while cursor < log.next and not outbox.closed:
+                    # entries overwritten while the writer was catching up are skipped
+                    start = max(cursor, log.first)
+                    entries = log.read(start, REPLAY_CHUNK_SIZE)
+                    cursor = min(log.next, start + REPLAY_CHUNK_SIZE)
+                    now = time.monotonic()
+                    chunk = [
+                        protocol.encode_message(
+                            state.name, m.payload, PRIORITY_NAMES[m.priority], m.expires_iso(), m.offset
+                        )
+                        for m in entries
+                        if (m.deadline is None or m.deadline > now) and (flt is None or flt.predicate(m.payload))
+                    ]
+                    if chunk:
+                        await outbox.wait_room()
+                        # framed and NLJSON messages concatenate into one write
+                        items = [b"".join(chunk)] if isinstance(chunk[0], bytes) else chunk
+                        for data in items:
+                            outbox.put(data, "drop_newest")
+                    await asyncio.sleep(0)
+                if outbox.closed:
+                    return
+                async with state.lock:
+                    if cursor >= log.next:
+                        state.subscribers.add(writer)
+                        if flt is not None:
+                            state.filters[writer] = flt
+                        self._rebuild_fanout(state)
+                        return
+        finally:
+            replays = self._replays.get(writer)
+            if replays is not None and replays.get(state.name) is asyncio.current_task():
+                del replays[state.name]
+                if not replays:
+                    del self._replays[writer]
+
+    def _cancel_replay(self, writer: asyncio.StreamWriter, topic: str) -> None:
+        task = self._replays.get(writer, {}).pop(topic, None)
+        if task is not None:
+            task.cancel()
+
+    async def _subscribe_pattern(
+        self, pattern: str, writer: asyncio.StreamWriter, password: Optional[str], flt: Optional[Filter] = None
+    ) -> None:
+        """
+        Subscribe to every topic matching a wildcard pattern, current and future ones.
+
+        Password-protected topics are included only when ``password`` opens them.
+        """
+        self._outbox_for(writer)
+        self._patterns.add(pattern, (writer, pattern), (password, flt))
+        self._writer_patterns.setdefault(writer, set()).add(pattern)
+        await self._refresh_pattern(pattern)
+        await self.send_response({"status": "success", "topic": pattern, "subscribed": True, "pattern": True}, writer)
+
+    async def _refresh_pattern(self, pattern: str) -> None:
+        # existing topics the pattern covers pick up (or drop) its subscribers
+        for state in list(self.topics.values()):
+            if matches(pattern, state.name):
+                await self._check_patterns(state)
+                async with state.lock:
+                    self._rebuild_fanout(state)
+
+    async def _check_patterns(self, state: _TopicState) -> None:
+        # settle the passwords of pattern subscribers before the fan-out is built from cached answers
+        for (w, _), (password, _) in self._patterns.match(state.name):
+            if self._known_access(state, password, w) is None:
+                await self._verify(state, password, w)
+
+    def _rebuild_fanout(self, state: _TopicState) -> None:
+        """Rebuild under the topic lock; pattern passwords not checked yet are checked in the background."""
+        extra: List[Tuple[asyncio.StreamWriter, Optional[Filter]]] = []
+        unchecked = False
+        if len(self._patterns):
+            for (w, _), (password, flt) in self._patterns.match(state.name):
+                known = self._known_access(state, password, w)
+                if known:
+                    extra.append((w, flt))
+                unchecked = unchecked or known is None
+        state.rebuild_fanout(self._outboxes, extra)
+        if unchecked and state.name not in self._pattern_checks:
+            self._pattern_checks[state.name] = asyncio.create_task(self._recheck_patterns(state))
+
+    async def _recheck_patterns(self, state: _TopicState) -> None:
+        try:
+            await self._check_patterns(state)
+        finally:
+            del self._pattern_checks[state.name]
+        async with state.lock:
+            self._rebuild_fanout(state)
+
+    # ---------------- Work queue (consume / ack / nack) ----------------
+
+    async def consume(
+        self,
+        topic: str,
+        writer: asyncio.StreamWriter,
+        prefetch: Any = DEFAULT_PREFETCH,
+        visibility_timeout: Any = DEFAULT_VISIBILITY_TIMEOUT,
+        password: Optional[str] = None,
+    ) -> None:
+        """Start (or resize) pulling from a topic with a window of ``prefetch`` unacked deliveries."""
+        try:
+            prefetch = int(prefetch)
+            visibility_timeout = float(visibility_timeout)
+            if prefetch <= 0 or visibility_timeout <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            await self.send_response(
+                {"status": "error", "message": "Invalid 'prefetch' or 'visibility_timeout' (positive numbers expected)"},
+                writer,
+            )
+            return
+        if is_pattern(topic):
+            await self.send_response(
+                {"status": "error", "message": "Wildcards are only allowed in subscribe and unsubscribe"}, writer
+            )
+            return
+        state = self._get_or_create_topic(topic)
+        if not await self._authorized(state, password, writer):
+            await self.send_response({"status": "error", "message": "Forbidden: wrong password"}, writer)
+            return
+        async with state.lock:
+            consumer = state.consumers.get(writer)
+            if consumer is None:
+                consumer = _Consumer(writer, self._outbox_for(writer), prefetch, visibility_timeout)
+                state.consumers[writer] = consumer
+                state.consumer_ring.append(consumer)
+            else:
+                consumer.credits += prefetch - consumer.prefetch
+                consumer.prefetch = prefetch
+                consumer.visibility_timeout = visibility_timeout
+        self._writer_topics.setdefault(writer, set()).add(topic)
+        await self.send_response({"status": "success", "topic": topic, "consuming": True, "prefetch": prefetch}, writer)
+        self._dispatch(state)
+
+    async def ack(self, topic: str, delivery_id: int, writer: asyncio.StreamWriter) -> None:
+        state = self.topics.get(topic)
+        record = self._settle(state, delivery_id, writer) if state is not None else None
+        if record is None:
+            await self.send_response({"status": "error", "message": f"Unknown delivery id {delivery_id}"}, writer)
+            return
+        if self._journaled(state):
+            self._log(state, broker_wal.DELETE, {"t": topic, "s": delivery_id})
+        await self.send_response({"status": "success", "topic": topic, "id": delivery_id, "acked": True}, writer)
+        self._dispatch(state)
+
+    async def nack(self, topic: str, delivery_id: int, writer: asyncio.StreamWriter, requeue: bool = True) -> None:
+        state = self.topics.get(topic)
+        record = self._settle(state, delivery_id, writer) if state is not None else None
+        if record is None:
+            await self.send_response({"status": "error", "message": f"Unknown delivery id {delivery_id}"}, writer)
+            return
+        response = {"status": "success", "topic": topic, "id": delivery_id, "nacked": True, "requeued": False}
+        if requeue and not self._exhausted(state, record[0]):
+            state.queue.push(record[0])
+            response["requeued"] = True
+        else:
+            reason = "rejected" if not requeue else "max_attempts"
+            self._dead_letter(state, record[0], reason)
+            # where the message went instead: the dead-letter topic, or None when it was discarded
+            response["dead_letter"] = state.dead_letter
+            response["reason"] = reason
+        await self.send_response(response, writer)
+        self._dispatch(state)
+
+    def _settle(self, state: _TopicState, delivery_id: int, writer: asyncio.StreamWriter) -> Optional[tuple]:
+        """Take an unacked delivery of this writer out of flight and give its credit back."""
+        record = state.inflight.get(delivery_id)
+        if record is None or record[1].writer is not writer:
+            return None
+        del state.inflight[delivery_id]
+        consumer = record[1]
+        consumer.inflight.discard(delivery_id)
+        consumer.credits += 1
+        return record
+
+    def _dispatch(self, state: _TopicState) -> None:
+        """Deliver ready messages in priority order to consumers that have credits, round-robin."""
+        ring = state.consumer_ring
+        idle = 0
+        while ring and idle < len(ring) and state.queue.pending():
+            consumer = ring[0]
+            ring.rotate(-1)
+            if consumer.credits <= 0 or consumer.outbox.closed:
+                idle += 1
+                continue
+            message = state.queue.pop()
+            if message is None:
+                break
+            if self._deliver(state, consumer, message):
+                idle = 0
+            else:
+                idle += 1
+        if state.dead:
+            # pop() came across expired messages for the dead-letter topic
+            self._ensure_sweeper()
+
+    def _deliver(self, state: _TopicState, consumer: _Consumer, message: _Message) -> bool:
+        seq = message.seq
+        attempt = message.attempts + 1
+        envelope = _message_envelope(state.name, message.payload, PRIORITY_NAMES[message.priority], message.expires_iso())
+        envelope["type"] = "delivery"
+        envelope["id"] = seq
+        envelope["attempt"] = attempt
+        if consumer.outbox.put(consumer.outbox.protocol.encode(envelope), "drop_newest") is not None:
+            # the connection cannot take more data right now; keep the message ready
+            state.queue.push(message)
+            return False
+        message.attempts = attempt
+        consumer.credits -= 1
+        consumer.inflight.add(seq)
+        state.inflight[seq] = (message, consumer, attempt)
+        heapq.heappush(state.visibility, (time.monotonic() + consumer.visibility_timeout, seq, attempt))
+        self._inflight_topics.add(state.name)
+        self._ensure_sweeper()
+        return True
+
+    def _remove_consumer(self, state: _TopicState, writer: asyncio.StreamWriter) -> None:
+        consumer = state.consumers.pop(writer, None)
+        if consumer is None:
+            return
+        state.consumer_ring.remove(consumer)
+        # whatever it had not acked goes back to the queue for the other consumers
+        for seq in consumer.inflight:
+            state.queue.push(state.inflight.pop(seq)[0])
+        consumer.inflight.clear()
+        self._dispatch(state)
+
+    def _redeliver_expired(self, state: _TopicState, now: float) -> int:
+        """Return deliveries whose visibility timeout passed to the queue."""
+        returned = 0
+        heap = state.visibility
+        while heap and heap[0][0] <= now:
+            _, seq, attempt = heapq.heappop(heap)
+            record = state.inflight.get(seq)
+            if record is None or record[2] != attempt:
+                continue  # acked, nacked or already redelivered
+            del state.inflight[seq]
+            consumer = record[1]
+            consumer.inflight.discard(seq)
+            consumer.credits += 1
+            if self._exhausted(state, record[0]):
+                self._dead_letter(state, record[0], "max_attempts")
+                continue
+            state.queue.push(record[0])
+            returned += 1
+        if returned:
+            self._dispatch(state)
+        return returned
+
+    # ---------------- Dead letters ----------------
+
+    def _set_dead_letter(self, state: _TopicState, topic: Optional[str]) -> None:
+        # no sweeper here: recovery runs in __init__, possibly before there is an event loop
+        state.set_dead_letter(topic)
+        if topic is not None:
+            self._dead_letter_topics.add(state.name)
+        else:
+            self._dead_letter_topics.discard(state.name)
+            state.dead.clear()
+
+    @staticmethod
+    def _exhausted(state: _TopicState, message: _Message) -> bool:
+        return state.max_attempts is not None and message.attempts >= state.max_attempts
+
+    def _dead_letter(self, state: _TopicState, message: _Message, reason: str) -> None:
+        """Take a message the topic gives up on out of it: to the dead-letter topic if there is one."""
+        if self._journaled(state):
+            self._log(state, broker_wal.DELETE, {"t": state.name, "s": message.seq})
+        if state.dead_letter is not None:
+            state.dead.append((message, reason))
+            self._ensure_sweeper()
+        elif self.metrics is not None:
+            self.metrics.counters["messages_discarded"] += 1
+
+    async def _move_dead_letters(self, state: _TopicState) -> None:
+        """Publish the topic's pending dead letters to its dead-letter topic, as one batch."""
+        batch = list(state.dead)
+        state.dead.clear()
+        items = [
+            {
+                "message": {
+                    "topic": state.name,
+                    "reason": reason,
+                    "attempts": message.attempts,
+                    "priority": PRIORITY_NAMES[message.priority],
+                    "published_at": datetime.fromtimestamp(message.created, tz=timezone.utc).isoformat(),
+                    "message": message.payload,
+                },
+                "priority": PRIORITY_NAMES[message.priority],
+            }
+            for message, reason in batch
+        ]
+        moved = await self._publish_dead_letters(state.dead_letter, items)
+        if self.metrics is not None:
+            self.metrics.counters["messages_dead_lettered"] += moved
+            self.metrics.counters["dead_letters_rejected"] += len(items) - moved
+
+    async def _publish_dead_letters(self, topic: str, items: List[Dict[str, Any]]) -> int:
+        """Store dead letters in ``topic`` (no password needed: the broker moves them); returns how many."""
+        moved = 0
+        for item in items:
+            prio = PRIORITY_ORDER[item["priority"]]
+            if await self._publish_one(topic, item["message"], prio, released=True) is None:
+                moved += 1
+        return moved
+
+    # ---------------- Durability ----------------
+
+    def _journaled(self, state: _TopicState) -> bool:
+        """Whether changes of a topic are recorded as log records."""
+        return state.durable
+
+    def _log(
+        self, state: _TopicState, kind: int, record: Dict[str, Any], commits: Optional[List[asyncio.Future]] = None
+    ) -> None:
+        """Record a topic change; a pending fsync is appended to ``commits``."""
+        if state.durable:
+            commit = self._wal.append(kind, record)
+            if commit is not None and commits is not None:
+                commits.append(commit)
+
+    @staticmethod
+    def _message_from_record(rec: Dict[str, Any], now_wall: float, now: float) -> Optional[_Message]:
+        """Queued message for a PUT record, or None once its TTL has passed."""
+        remaining = broker_wal.remaining_ttl(rec, now_wall)
+        if remaining is not None and remaining <= 0:
+            return None
+        deadline = now + remaining if remaining is not None else None
+        return _Message(rec["p"], rec["s"], rec["c"], deadline, rec["d"])
+
+    async def _wait_commits(self, commits: List[asyncio.Future]) -> Optional[str]:
+        results = await asyncio.gather(*commits, return_exceptions=True)
+        if any(isinstance(r, BaseException) for r in results):
+            return "Failed to persist message"
+        return None
+
+    def _recover(self) -> None:
+        """Rebuild durable topics and their queues from the write-ahead log."""
+        configs, records, max_seq = self._wal.recover()
+        self._seq = max(self._seq, max_seq)
+        for name, config in configs.items():
+            state = self._get_or_create_topic(name)
+            state.set_credential(load_credential(config))
+            state.overflow = config.get("overflow")
+            state.durable = True
+            self._set_dead_letter(state, config.get("dead_letter"))
+            state.max_attempts = config.get("max_attempts")
+        now_wall = time.time()
+        now = time.monotonic()
+        for rec in records:
+            message = self._message_from_record(rec, now_wall, now)
+            if message is None:
+                continue
+            state = self._get_or_create_topic(rec["t"])
+            state.durable = True
+            # quotas apply to recovered messages too, but none is dropped for them
+            if not state.queue.put(message):
+                state.queue.push(message)
+            if message.deadline is not None:
+                self._ttl_topics.add(rec["t"])
+
     # ---------------- Expiration helpers ----------------
 
-    async def _purge_expired(self, topic: str) -> None:
-        """Remove expired items from a topic queue (non-blocking, approximate)."""
-        async with self._lock:
-            q = self.queues.get(topic)
-            if q is None or q.empty():
-                return
-            tmp: list = []
+    async def _purge_expired(self, topic: str) -> int:
+        """Drop expired items of a topic; cheap when nothing is due."""
+        state = self.topics.get(topic)
+        if state is None:
+            return 0
+        start = time.perf_counter_ns()
+        async with state.lock:
+            expired = state.queue.expire_due(time.monotonic())
+            if not state.queue.deadlines:
+                self._ttl_topics.discard(topic)
+        if self.metrics is not None:
+            self.metrics.counters["messages_expired"] += expired
+            self.metrics.observe("purge_expired", start)
+        return expired
+
+    def resume_sweeper(self) -> None:
+        """Start the sweeper for recovered topics with TTLs or dead letters to move (call from the event loop)."""
+        if self._sweep_pending():
+            self._ensure_sweeper()
+
+    def _sweep_pending(self) -> bool:
+        """Whether the sweeper has anything to watch; whoever queues such work calls _ensure_sweeper()."""
+        if self._ttl_topics or self._inflight_topics:
+            return True
+        return any(self.topics[t].dead for t in self._dead_letter_topics)
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_expired())
+
+    async def _sweep_expired(self) -> None:
+        """Background task: drop expired messages, redeliver unacked ones past their timeout, move dead letters."""
+        while self._sweep_pending():
+            await asyncio.sleep(self.sweep_interval)
+            for topic in list(self._ttl_topics):
+                await self._purge_expired(topic)
+            now = time.monotonic()
+            for topic in list(self._inflight_topics):
+                state = self.topics.get(topic)
+                if state is None:
+                    self._inflight_topics.discard(topic)
+                    continue
+                async with state.lock:
+                    self._redeliver_expired(state, now)
+                    if not state.inflight:
+                        state.visibility.clear()
+                        self._inflight_topics.discard(topic)
+            for topic in list(self._dead_letter_topics):
+                state = self.topics[topic]
+                if state.dead:
+                    await self._move_dead_letters(state)
+
+    async def _release_delayed(self) -> None:
+        """Background task: publish delayed messages as their time comes, while any are pending."""
+        timers = self._timers
+        while len(timers):
+            await asyncio.sleep(timers.tick)
+            for i, (topic, payload, prio, ttl) in enumerate(timers.advance()):
+                # ttl counts from delivery: the deadline is taken now
+                error = await self._publish_one(topic, payload, prio, ttl, released=True)
+                if error is not None and self.metrics is not None:
+                    self.metrics.counters["delayed_rejected"] += 1
+                if i % RELEASE_CHUNK_SIZE == RELEASE_CHUNK_SIZE - 1:
+                    await asyncio.sleep(0)  # a large batch falling due must not starve clients
+
+    async def close(self) -> None:
+        """Stop background tasks of the broker and flush the write-ahead log."""
+        for task in (self._sweeper, self._timer_task, *self._pattern_checks.values()):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._sweeper = self._timer_task = None
+        if self._wal is not None:
+            await self._wal.close()
+
+
+# ---------------- Raw transport ----------------
+
+TRANSPORTS = ("streams", "protocol")
+EVENT_LOOPS = ("asyncio", "uvloop")
+# bytes waiting to be parsed before a protocol connection stops reading from its socket
+MAX_BUFFERED = 256 * 1024
+
+
+def use_event_loop(name: str) -> None:
+    """Select the event loop asyncio.run() creates from now on: "asyncio" or "uvloop"."""
+    if name not in EVENT_LOOPS:
+        raise ValueError(f"Unknown event loop '{name}'")
+    if name == "uvloop":
+        if uvloop is None:
+            raise RuntimeError("uvloop is not installed (pip install uvloop)")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(None)
+
+
+class _TransportWriter:
+    """
+    The part of the StreamWriter interface the broker uses, on a bare transport.
+
+    Flow control comes from BrokerProtocol.pause_writing/resume_writing:
+    drain() returns at once unless the transport is over its high-water mark.
+    """
+
+    __slots__ = ("transport", "_paused", "_drain_waiters", "_lost", "_closed")
+
+    def __init__(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self._paused = False
+        # one future per drain() in progress: the outbox task and the request loop may both wait
+        self._drain_waiters: Deque[asyncio.Future] = deque()
+        self._lost = False
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    def writelines(self, data: Iterable[bytes]) -> None:
+        self.transport.writelines(data)
+
+    async def drain(self) -> None:
+        if self._lost:
+            raise ConnectionResetError("Connection lost")
+        if self._paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
             try:
-                while True:
-                    item = q.get_nowait()
-                    tmp.append(item)
-            except asyncio.QueueEmpty:
-                pass
-
-            now = utcnow()
-            # Reinsert only non-expired
-            for prio, ts, seq, payload in tmp:
-                exp = payload.get("expires_at")
-                if exp:
+                await waiter
+            finally:
+                self._drain_waiters.remove(waiter)
+            if self._lost:
+                raise ConnectionResetError("Connection lost")
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    async def wait_closed(self) -> None:
+        await self._closed
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        return self.transport.get_extra_info(name, default)
+
+    def _set_paused(self, paused: bool) -> None:
+        self._paused = paused
+        if not paused:
+            self._wake_drain()
+
+    def _connection_lost(self) -> None:
+        self._lost = True
+        self._wake_drain()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def _wake_drain(self) -> None:
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class BrokerProtocol(asyncio.Protocol):
+    """
+    Broker connection served straight from transport callbacks, without the streams layer.
+
+    data_received appends to one buffer; a single task per connection splits
+    it with the same parsers as the stream mode (lines or frames) and answers
+    everything it found with one write. A burst of pipelined requests costs
+    one wakeup instead of a StreamReader round trip per read. Reading pauses
+    while more than MAX_BUFFERED bytes wait for that task.
+    """
+
+    def __init__(self, broker: HomeworkBroker) -> None:
+        self.broker = broker
+        self.buf = bytearray()
+        self.transport: Optional[asyncio.Transport] = None
+        self.writer: Optional[_TransportWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._waiter: Optional[asyncio.Future] = None
+        self._eof = False
+        self._reading_paused = False
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+        self.writer = _TransportWriter(transport)
+        self.broker._client_opened()
+        self._task = asyncio.get_running_loop().create_task(self._serve())
+
+    def data_received(self, data: bytes) -> None:
+        self.buf += data
+        if len(self.buf) > MAX_BUFFERED and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        self._wake()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wake()
+        return True  # keep the transport open: responses to the last requests are still to be written
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._eof = True
+        self.writer._connection_lost()
+        self._wake()
+
+    def pause_writing(self) -> None:
+        self.writer._set_paused(True)
+
+    def resume_writing(self) -> None:
+        self.writer._set_paused(False)
+
+    def _wake(self) -> None:
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait(self) -> None:
+        # everything buffered has been handled: let the socket fill the buffer again
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    async def _handshake(self) -> Optional[Callable[[bytearray], List[bytes]]]:
+        """Tell NLJSON from framed clients by the first byte; returns the request splitter, None to hang up."""
+        buf = self.buf
+        hello_size = len(FRAMED_MAGIC) + 1
+        while not buf or (buf[:1] == FRAMED_MAGIC[:1] and len(buf) < hello_size):
+            if self._eof:
+                return None
+            await self._wait()
+        if buf[:1] != FRAMED_MAGIC[:1]:
+            return split_lines
+        hello = bytes(buf[:hello_size])
+        del buf[:hello_size]
+        if hello[:-1] != FRAMED_MAGIC:
+            return None
+        protocol = _FramedProtocol.negotiate(hello[-1:])
+        self.broker._protocols[self.writer] = protocol
+        self.writer.write(FRAMED_MAGIC + protocol.codec_byte)
+        await self.writer.drain()
+        return split_frames
+
+    async def _serve(self) -> None:
+        broker = self.broker
+        writer = self.writer
+        try:
+            split = await self._handshake()
+            if split is None:
+                return
+            buf = self.buf
+            while True:
+                requests = split(buf)
+                if requests:
+                    broker._pending_responses[writer] = []
                     try:
-                        if datetime.fromisoformat(exp) <= now:
-                            continue  # drop expired
-                    except Exception:
-                        pass
-                q.put_nowait((prio, ts, seq, payload))
+                        for raw in requests:
+                            await broker.process_message(raw, writer)
+                    finally:
+                        await broker._flush_responses(writer)
+                elif self._eof:
+                    break
+                else:
+                    await self._wait()
+            if buf and split is split_lines:
+                # last line without a trailing newline
+                await broker.process_message(bytes(buf), writer)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not writer.is_closing():
+                err = {"status": "error", "message": f"Server exception: {e.__class__.__name__}"}
+                await broker.send_response(err, writer)
+        finally:
+            await broker._client_closed(writer)
+
+
+async def start_broker_server(
+    broker: HomeworkBroker, host: str, port: int, transport: str = "streams", **kwargs: Any
+) -> asyncio.AbstractServer:
+    """Listen on host:port with either connection implementation; kwargs go to the server factory."""
+    if transport == "streams":
+        return await asyncio.start_server(broker.handle_client, host, port, **kwargs)
+    if transport == "protocol":
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(lambda: BrokerProtocol(broker), host, port, **kwargs)
+    raise ValueError(f"Unknown transport '{transport}'")
+
 
+# ---------------- Actions ----------------
 
-async def main(host: str = "127.0.0.1", port: int = 8888):
-    broker = HomeworkBroker()
-    server = await asyncio.start_server(broker.handle_client, host, port)
+# built-in actions; every broker starts from a copy (see HomeworkBroker.register_action).
+# Handlers go through the instance, so subclasses overriding e.g. subscribe() are still used.
+ACTIONS: Dict[str, Action] = {
+    "list_topics": Action(lambda b, r, w: b.list_topics(w)),
+    "stats": Action(lambda b, r, w: b.stats(w)),
+    "queue_length": Action(lambda b, r, w: b.queue_length(r.topic, w), validate_topic),
+    "clear_topic": Action(lambda b, r, w: b.clear_topic(r.topic, r.password, w), validate_topic),
+    "publish": Action(lambda b, r, w: b._publish(r, w), validate_publish),
+    "publish_batch": Action(
+        lambda b, r, w: b.publish_batch(r.messages, w, topic=r.topic, password=r.password, producer=r.producer),
+        validate_publish_batch,
+    ),
+    "subscribe": Action(
+        lambda b, r, w: b.subscribe(
+            r.topic,
+            w,
+            password=r.password,
+            filter_spec=r.filter,
+            from_offset=r.from_offset,
+            from_timestamp=r.from_timestamp,
+        ),
+        validate_subscribe,
+    ),
+    "configure_topic": Action(
+        lambda b, r, w: b.configure_topic(
+            r.topic,
+            w,
+            overflow=r.overflow,
+            password=r.password,
+            durable=r.durable,
+            retain=r.retain,
+            memory_limit=r.memory_limit,
+            dead_letter=r.dead_letter,
+            max_attempts=r.max_attempts,
+        ),
+        validate_configure,
+    ),
+    "consume": Action(
+        lambda b, r, w: b.consume(
+            r.topic,
+            w,
+            prefetch=r.prefetch,
+            visibility_timeout=b.visibility_timeout if r.visibility_timeout is None else r.visibility_timeout,
+            password=r.password,
+        ),
+        validate_consume,
+    ),
+    "ack": Action(lambda b, r, w: b.ack(r.topic, r.id, w), validate_ack),
+    "nack": Action(lambda b, r, w: b.nack(r.topic, r.id, w, requeue=r.requeue), validate_ack),
+    "unsubscribe": Action(lambda b, r, w: b.unsubscribe(r.topic, w), validate_topic),
+    "auth_challenge": Action(lambda b, r, w: b.auth_challenge(r.topic, w), validate_topic),
+    "auth": Action(lambda b, r, w: b.auth(r, w), validate_auth),
+    "compression": Action(lambda b, r, w: b.compression(r, w), validate_compression),
+}
+
+
+async def main(
+    host: str = "127.0.0.1",
+    port: int = 8888,
+    data_dir: Optional[str] = None,
+    fsync: str = "always",
+    metrics_port: Optional[int] = None,
+    memory_limit: Optional[int] = None,
+    topic_memory_limit: Optional[int] = None,
+    spill_dir: Optional[str] = None,
+    spill_limit: Optional[int] = None,
+    transport: str = "streams",
+    compression_min_size: int = COMPRESSION_MIN_SIZE,
+    compression_dictionary: Optional[bytes] = None,
+):
+    """Run a broker server. The event loop is picked before asyncio.run(), see use_event_loop()."""
+    broker = HomeworkBroker(
+        data_dir=data_dir,
+        fsync=fsync,
+        memory_limit=memory_limit,
+        topic_memory_limit=topic_memory_limit,
+        spill_dir=spill_dir,
+        spill_limit=spill_limit,
+        compression_min_size=compression_min_size,
+        compression_dictionary=DEFAULT_DICTIONARY if compression_dictionary is None else compression_dictionary,
+    )
+    broker.resume_sweeper()
+    server = await start_broker_server(broker, host, port, transport)
     addr = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-    print(f"Server listening on {addr}")
-    async with server:
-        await server.serve_forever()
+    loop_name = type(asyncio.get_running_loop()).__module__.split(".")[0]
+    print(f"Server listening on {addr} ({transport} transport, {loop_name} loop)")
+    metrics_server = None
+    if metrics_port is not None:
+        # Prometheus scrape target: GET http://host:metrics_port/metrics
+        metrics_server = await start_http_server(broker.render_metrics, host, metrics_port)
+        print(f"Metrics on http://{host}:{metrics_port}/metrics")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await broker.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# load_broker.py - Load generator for HomeworkBroker
+# Starts homework_broker.main in a child process and drives it over TCP with
+# async publishers and subscribers. Every run reports throughput, end-to-end
+# latency percentiles, server CPU per message and server memory growth.
+# Usage: python load_broker.py [scenario ...] [--seconds S] [--output runs.jsonl]
+#        python load_broker.py --compare base.jsonl new.jsonl
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import homework_broker
+from bench_broker import HOST, BenchConn, _free_port, available_modes, report
+from broker_metrics import Histogram
+from homework_broker import PRIORITY_NAMES
+
+
+class LoadConfig(NamedTuple):
+    publishers: int = 4
+    subscribers: int = 1  # per topic
+    topics: int = 1
+    size: int = 64
+    # share of high / normal / low publishes
+    priority_mix: Tuple[float, float, float] = (0.0, 1.0, 0.0)
+    # share of publishes that carry a TTL, and that TTL (seconds)
+    ttl_share: float = 0.0
+    ttl: int = 1
+    # unacknowledged publishes each publisher keeps in flight
+    window: int = 32
+    seconds: float = 3.0
+    warmup: float = 0.5
+    mode: str = "nljson"
+    # server side: connection implementation and event loop (see homework_broker.TRANSPORTS / EVENT_LOOPS)
+    transport: str = "streams"
+    loop: str = "asyncio"
+
+
+# scenario -> list of overrides of the base LoadConfig, one run each
+SCENARIOS: Dict[str, List[Dict[str, Any]]] = {
+    "size": [{"size": size} for size in (16, 256, 4096, 16384)],
+    "topics": [{"topics": topics, "publishers": 8} for topics in (1, 16, 256)],
+    "fanout": [{"subscribers": subscribers} for subscribers in (1, 10, 100)],
+    "priority": [
+        {"priority_mix": mix} for mix in ((0.0, 1.0, 0.0), (1 / 3, 1 / 3, 1 / 3), (0.1, 0.2, 0.7))
+    ],
+    "ttl": [{"ttl_share": share} for share in (0.0, 0.5, 1.0)],
+    # uvloop rows only where it is installed
+    "transport": [
+        {"transport": transport, "loop": loop}
+        for loop in homework_broker.EVENT_LOOPS
+        if loop != "uvloop" or homework_broker.uvloop is not None
+        for transport in homework_broker.TRANSPORTS
+    ],
+}
+
+
+def _label(overrides: Dict[str, Any]) -> str:
+    return ",".join(
+        f"{k}={'/'.join(f'{x:g}' for x in v) if isinstance(v, tuple) else v}" for k, v in overrides.items()
+    )
+
+
+# ---------------- Server process ----------------
+
+def _serve(port: int, transport: str = "streams", loop: str = "asyncio") -> None:
+    sys.stdout = open(os.devnull, "w")
+    homework_broker.use_event_loop(loop)
+    try:
+        asyncio.run(homework_broker.main(HOST, port, transport=transport))
+    except KeyboardInterrupt:
+        pass
+
+
+def _proc_usage(pid: int) -> Tuple[Optional[float], Optional[int]]:
+    """CPU seconds (user + system) and resident set size in bytes; None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # fields after the parenthesised command name; utime and stime are fields 14 and 15
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return cpu, rss
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+async def _wait_listening(port: int, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.02)
+            continue
+        writer.close()
+        return
+
+
+# ---------------- Clients ----------------
+
+class _RunStats:
+    def __init__(self) -> None:
+        self.measuring = False
+        self.published = 0
+        self.delivered = 0
+        self.latency = Histogram()  # nanoseconds, publish -> delivery
+
+
+def _topic(cfg: LoadConfig, i: int) -> str:
+    return f"load.{i % cfg.topics}"
+
+
+async def _publisher(conn: BenchConn, cfg: LoadConfig, index: int, stats: _RunStats, stop: asyncio.Event) -> None:
+    rng = random.Random(index)
+    # precomputed choices keep the random module out of the send loop
+    priorities = rng.choices(PRIORITY_NAMES, weights=cfg.priority_mix, k=1024)
+    ttls = [cfg.ttl if rng.random() < cfg.ttl_share else None for _ in range(1024)]
+    pad = "x" * cfg.size
+    k = index
+    while not stop.is_set():
+        for _ in range(cfg.window):
+            request = {
+                "action": "publish",
+                "topic": _topic(cfg, k),
+                "message": {"t": time.perf_counter(), "p": pad},
+                "priority": priorities[k % 1024],
+            }
+            ttl = ttls[k % 1024]
+            if ttl is not None:
+                request["ttl"] = ttl
+            conn.send(request)
+            k += 1
+        await conn.writer.drain()
+        for _ in range(cfg.window):
+            await conn.recv()
+        if stats.measuring:
+            stats.published += cfg.window
+
+
+async def _subscriber(conn: BenchConn, stats: _RunStats) -> None:
+    record = stats.latency.record
+    while True:
+        msg = await conn.recv()
+        if msg.get("type") != "message":
+            continue
+        if stats.measuring:
+            stats.delivered += 1
+            record(int((time.perf_counter() - msg["payload"]["t"]) * 1e9))
+
+
+async def _server_stats(port: int, mode: str) -> Dict[str, Any]:
+    conn = await BenchConn.open(port, mode)
+    conn.send({"action": "stats"})
+    response = await conn.recv()
+    await conn.close()
+    return response.get("stats", {})
+
+
+async def run_load(cfg: LoadConfig) -> Dict[str, Any]:
+    """One run against a fresh server process; returns the measured numbers."""
+    port = _free_port()
+    server = multiprocessing.Process(target=_serve, args=(port, cfg.transport, cfg.loop), daemon=True)
+    server.start()
+    tasks: List[asyncio.Task] = []
+    conns: List[BenchConn] = []
+    try:
+        await _wait_listening(port)
+        stats = _RunStats()
+        for t in range(cfg.topics):
+            for _ in range(cfg.subscribers):
+                conn = await BenchConn.open(port, cfg.mode)
+                conn.send({"action": "subscribe", "topic": _topic(cfg, t)})
+                await conn.recv()
+                conns.append(conn)
+                tasks.append(asyncio.create_task(_subscriber(conn, stats)))
+        _, rss_start = _proc_usage(server.pid)
+        stop = asyncio.Event()
+        publishers = []
+        for i in range(cfg.publishers):
+            conn = await BenchConn.open(port, cfg.mode)
+            conns.append(conn)
+            publishers.append(asyncio.create_task(_publisher(conn, cfg, i, stats, stop)))
+        tasks.extend(publishers)
+
+        await asyncio.sleep(cfg.warmup)
+        cpu_start, _ = _proc_usage(server.pid)
+        client_cpu_start = time.process_time()
+        started = time.perf_counter()
+        stats.measuring = True
+        await asyncio.sleep(cfg.seconds)
+        stats.measuring = False
+        elapsed = time.perf_counter() - started
+        cpu_end, rss_end = _proc_usage(server.pid)
+        client_cpu = time.process_time() - client_cpu_start
+
+        stop.set()
+        await asyncio.wait(publishers, timeout=5)
+        server_stats = await _server_stats(port, cfg.mode)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for conn in conns:
+            await conn.close()
+        server.terminate()
+        server.join(5)
+
+    published = max(1, stats.published)
+    latency = stats.latency
+    result: Dict[str, Any] = {
+        "msgs_per_sec": stats.published / elapsed,
+        "deliveries_per_sec": stats.delivered / elapsed,
+        "p50_us": latency.percentile(0.5) / 1000,
+        "p99_us": latency.percentile(0.99) / 1000,
+        "p999_us": latency.percentile(0.999) / 1000,
+        "max_us": latency.max / 1000,
+        "server_cpu_us_per_msg": None,
+        "client_cpu_us_per_msg": client_cpu / published * 1e6,
+        "rss_start_mb": None,
+        "rss_growth_mb": None,
+        "server_p99_us": server_stats.get("latency", {}).get("process_message", {}).get("p99_us"),
+    }
+    if cpu_start is not None and cpu_end is not None:
+        result["server_cpu_us_per_msg"] = (cpu_end - cpu_start) / published * 1e6
+    if rss_start is not None and rss_end is not None:
+        result["rss_start_mb"] = rss_start / 2**20
+        result["rss_growth_mb"] = (rss_end - rss_start) / 2**20
+    return result
+
+
+# ---------------- Runs and comparison ----------------
+
+def _environment() -> Dict[str, Any]:
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+async def run(names: Iterable[str], base: LoadConfig) -> List[Dict[str, Any]]:
+    env = _environment()
+    rows: List[Dict[str, Any]] = []
+    for name in names:
+        scenario_rows = []
+        for overrides in SCENARIOS[name]:
+            cfg = base._replace(**overrides)
+            row = {"scenario": name, "label": _label(overrides)}
+            row.update(await run_load(cfg))
+            row["config"] = cfg._asdict()
+            row["env"] = env
+            scenario_rows.append(row)
+        rows.extend(scenario_rows)
+        report(name, [_table_row(r) for r in scenario_rows])
+    return rows
+
+
+def _table_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    keys = ("label", "msgs_per_sec", "p50_us", "p99_us", "p999_us", "server_cpu_us_per_msg", "rss_growth_mb")
+    return {k: ("-" if row[k] is None else row[k]) for k in keys}
+
+
+def _load_rows(path: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    rows = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                rows[(row["scenario"], row["label"])] = row
+    return rows
+
+
+def compare(base_path: str, new_path: str) -> List[Dict[str, Any]]:
+    """Relative change of throughput, tail latency and CPU per message between two result files."""
+    base, new = _load_rows(base_path), _load_rows(new_path)
+    out = []
+    for key, row in new.items():
+        old = base.get(key)
+        if old is None:
+            continue
+        diff: Dict[str, Any] = {"scenario": key[0], "label": key[1]}
+        for metric in ("msgs_per_sec", "p99_us", "p999_us", "server_cpu_us_per_msg"):
+            if old.get(metric) and row.get(metric) is not None:
+                diff[f"{metric}_%"] = (row[metric] / old[metric] - 1) * 100
+            else:
+                diff[f"{metric}_%"] = "-"
+        out.append(diff)
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    defaults = LoadConfig()
+    parser = argparse.ArgumentParser(description="Load-test HomeworkBroker over TCP")
+    parser.add_argument("scenarios", nargs="*", help=f"any of: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--seconds", type=float, default=defaults.seconds, help="measured time of each run")
+    parser.add_argument("--publishers", type=int, default=defaults.publishers)
+    parser.add_argument("--window", type=int, default=defaults.window, help="in-flight publishes per publisher")
+    parser.add_argument("--mode", choices=available_modes(), default=defaults.mode)
+    parser.add_argument("--transport", choices=homework_broker.TRANSPORTS, default=defaults.transport)
+    parser.add_argument("--loop", choices=homework_broker.EVENT_LOOPS, default=defaults.loop, help="server event loop")
+    parser.add_argument("--output", help="append one JSON object per run to this file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON lines instead of tables")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two --output files")
+    args = parser.parse_args(argv)
+    if args.compare:
+        report(f"{args.compare[1]} vs {args.compare[0]}", compare(*args.compare))
+        return
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    base = LoadConfig(
+        seconds=args.seconds,
+        publishers=args.publishers,
+        window=args.window,
+        mode=args.mode,
+        transport=args.transport,
+        loop=args.loop,
+    )
+    if args.json:
+        # keep stdout machine-readable: tables go to stderr
+        sys.stdout, tables = sys.stderr, sys.stdout
+    rows = asyncio.run(run(args.scenarios or list(SCENARIOS), base))
+    if args.json:
+        sys.stdout = tables
+        for row in rows:
+            print(json.dumps(row))
+    if args.output:
+        with open(args.output, "a") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,72 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
-from homework_broker import main
+from broker_compress import COMPRESSION_MIN_SIZE, DEFAULT_DICTIONARY
+from homework_broker import EVENT_LOOPS, TRANSPORTS, main, use_event_loop, uvloop
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the HomeworkBroker server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--data-dir", help="enable durable topics, stored in this directory")
+    parser.add_argument("--fsync", choices=["always", "interval", "never"], default="always")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument(
+        "--metrics-port", type=int, help="serve Prometheus metrics at http://host:PORT/metrics (worker N: PORT+N)"
+    )
+    parser.add_argument("--memory-limit", type=int, help="bytes of queued messages across all topics")
+    parser.add_argument("--topic-memory-limit", type=int, help="bytes of queued messages per topic")
+    parser.add_argument("--spill-dir", help="spill messages over the memory limits to files in this directory")
+    parser.add_argument("--spill-limit", type=int, help="bytes of spilled messages before publishes are refused")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="streams", help="connection implementation")
+    parser.add_argument("--loop", choices=EVENT_LOOPS, default="asyncio", help="event loop (uvloop must be installed)")
+    parser.add_argument(
+        "--compression-min-size", type=int, default=COMPRESSION_MIN_SIZE, help="smallest frame body worth compressing"
+    )
+    parser.add_argument("--compression-dict", help="file with typical payloads, used as the compression dictionary")
+    args = parser.parse_args()
+    compression_dictionary = DEFAULT_DICTIONARY
+    if args.compression_dict:
+        with open(args.compression_dict, "rb") as f:
+            compression_dictionary = f.read()
+    if args.loop == "uvloop" and uvloop is None:
+        parser.error("uvloop is not installed (pip install uvloop)")
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            from broker_workers import run_workers
+            run_workers(
+                args.workers,
+                args.host,
+                args.port,
+                data_dir=args.data_dir,
+                fsync=args.fsync,
+                transport=args.transport,
+                loop=args.loop,
+                memory_limit=args.memory_limit,
+                topic_memory_limit=args.topic_memory_limit,
+                spill_dir=args.spill_dir,
+                spill_limit=args.spill_limit,
+                metrics_port=args.metrics_port,
+                compression_min_size=args.compression_min_size,
+                compression_dictionary=compression_dictionary,
+            )
+        else:
+            use_event_loop(args.loop)
+            asyncio.run(
+                main(
+                    args.host,
+                    args.port,
+                    data_dir=args.data_dir,
+                    fsync=args.fsync,
+                    metrics_port=args.metrics_port,
+                    memory_limit=args.memory_limit,
+                    topic_memory_limit=args.topic_memory_limit,
+                    spill_dir=args.spill_dir,
+                    spill_limit=args.spill_limit,
+                    transport=args.transport,
+                    compression_min_size=args.compression_min_size,
+                    compression_dictionary=compression_dictionary,
+                )
+            )
     except KeyboardInterrupt:
         print("Server stopped")
@@ -2,7 +2,22 @@
 import asyncio
 import json
 import unittest
-from homework_broker import HomeworkBroker, _NLJSONProtocol
+from unittest import mock
+import os
+import random
+import tempfile
+import time
+import broker_wal
+from broker_wal import WriteAheadLog
+from broker_client import BrokerClient, BrokerError
+from broker_cluster import ClusterBroker, ClusterNode
+from broker_auth import TopicCredential, client_proof
+from broker_dedup import DedupIndex
+from broker_metrics import Histogram, start_http_server
+from broker_timers import TimingWheel
+from broker_trie import TopicTrie
+from broker_workers import ShardedBroker
+from homework_broker import HomeworkBroker, RequestError, _ExpiringQueue, _Message, _NLJSONProtocol, _TransportWriter, _message_size, open_framed_connection, read_frame, start_broker_server
 
 class FakeWriter:
     def __init__(self):
@@ -12,6 +27,10 @@ class FakeWriter:
     def write(self, data: bytes):
         self.buffer.extend(data)
 
+    def writelines(self, chunks):
+        for data in chunks:
+            self.write(data)
+
     async def drain(self):
         await asyncio.sleep(0)
 
@@ -30,6 +49,20 @@ class FakeWriter:
     async def wait_closed(self):
         pass
 
+class SlowWriter(FakeWriter):
+    """Writer whose drain() blocks while stalled, like a laggy consumer."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.release.set()
+
+    def stall(self):
+        self.release.clear()
+
+    async def drain(self):
+        await self.release.wait()
+
 class BrokerTest(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
         self.broker = HomeworkBroker()
@@ -87,6 +120,1192 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
         res = await self._read_jsons(self.w1)
         self.assertEqual(res[-1]["messages"], 0)
 
+    async def test_slow_subscriber_does_not_block_publish(self):
+        slow = SlowWriter()
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"s"}), slow)
+        slow.stall()
+        for i in range(3):
+            await asyncio.wait_for(
+                self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"s","message":i}), self.w1),
+                timeout=1,
+            )
+        res = await self._read_jsons(self.w1)
+        self.assertEqual([r["status"] for r in res], ["success"] * 3)
+        slow.release.set()
+        await asyncio.sleep(0.01)
+        payloads = [m["payload"] for m in await self._read_jsons(slow) if m.get("type") == "message"]
+        self.assertEqual(payloads, [0, 1, 2])
+
+    async def test_overflow_policies_count_drops(self):
+        broker = HomeworkBroker(send_queue_size=1)
+        slow = SlowWriter()
+        await broker.process_message(_NLJSONProtocol.encode({"action":"configure_topic","topic":"o","overflow":"drop_newest"}), self.w1)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"o"}), slow)
+        slow.stall()
+        # first message goes straight to the socket, second is queued, the rest overflow
+        for i in range(4):
+            await broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"o","message":i}), self.w1)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"queue_length","topic":"o"}), self.w1)
+        res = await self._read_jsons(self.w1)
+        self.assertEqual(res[-1]["dropped"], {"drop_newest": 2})
+
+        await broker.process_message(_NLJSONProtocol.encode({"action":"configure_topic","topic":"o","overflow":"disconnect"}), self.w1)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"o","message":"x"}), self.w1)
+        self.assertTrue(slow.closed)
+
+    async def test_configure_topic_rejects_unknown_policy(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"configure_topic","topic":"c","overflow":"nope"}), self.w1)
+        res = await self._read_jsons(self.w1)
+        self.assertEqual(res[-1]["status"], "error")
+
+    async def test_topics_do_not_share_a_lock(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"a","message":1}), self.w1)
+        async with self.broker.topics["a"].lock:
+            await asyncio.wait_for(
+                self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"b","message":2}), self.w2),
+                timeout=1,
+            )
+        res = await self._read_jsons(self.w2)
+        self.assertEqual(res[-1], {"status": "success", "topic": "b"})
+
+    async def test_cleanup_only_touches_client_topics(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"x"}), self.w1)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"y"}), self.w2)
+        await self.broker._cleanup_writer(self.w1)
+        self.assertEqual(self.broker.topics["x"].subscribers, set())
+        self.assertEqual(self.broker.topics["y"].subscribers, {self.w2})
+        self.assertNotIn(self.w1, self.broker._writer_topics)
+
+    async def test_wildcard_subscriptions(self):
+        send = lambda obj, w: self.broker.process_message(_NLJSONProtocol.encode(obj), w)
+        pub = FakeWriter()
+        await send({"action":"subscribe","topic":"orders.*"}, self.w1)
+        await send({"action":"subscribe","topic":"metrics.#"}, self.w2)
+        await send({"action":"subscribe","topic":"metrics.cpu"}, self.w2)
+        for topic in ("orders.eu", "orders.eu.created", "metrics", "metrics.cpu", "metrics.cpu.host1"):
+            await send({"action":"publish","topic":topic,"message":topic}, pub)
+        async def got(w):
+            return [m["topic"] for m in await self._read_jsons(w) if m.get("type") == "message"]
+        self.assertEqual(await got(self.w1), ["orders.eu"])
+        # subscribed by name and by pattern, still delivered once
+        self.assertEqual(await got(self.w2), ["metrics", "metrics.cpu", "metrics.cpu.host1"])
+
+        await send({"action":"unsubscribe","topic":"orders.*"}, self.w1)
+        await send({"action":"publish","topic":"orders.us","message":1}, pub)
+        self.assertEqual(await got(self.w1), ["orders.eu"])
+        await send({"action":"publish","topic":"orders.#","message":1}, pub)
+        self.assertEqual((await self._read_jsons(pub))[-1]["status"], "error")
+
+    async def test_subscription_filters(self):
+        send = lambda obj, w: self.broker.process_message(_NLJSONProtocol.encode(obj), w)
+        w3 = FakeWriter()
+        cheap_eu = {"price": {"$gte": 10, "$lt": 100}, "region": {"$in": ["eu", "us"]}}
+        await send({"action":"subscribe","topic":"orders","filter":cheap_eu}, self.w1)
+        await send({"action":"subscribe","topic":"orders","filter":dict(reversed(list(cheap_eu.items())))}, self.w2)
+        await send({"action":"subscribe","topic":"orders","filter":{"$or":[{"kind":"refund"},{"$not":{"price":{"$exists":True}}}]}}, w3)
+        # identical filters share one group, so one evaluation per message
+        self.assertEqual(sorted(len(group[1]) for group in self.broker.topics["orders"].fanout), [1, 2])
+
+        pub = FakeWriter()
+        for payload in ({"price": 50, "region": "eu"}, {"price": 500, "region": "eu"}, {"price": "x", "region": "us"},
+                        {"kind": "refund", "price": 5}, {"region": "eu"}, "plain text"):
+            await send({"action":"publish","topic":"orders","message":payload}, pub)
+        async def got(w):
+            return [m["payload"] for m in await self._read_jsons(w) if m.get("type") == "message"]
+        self.assertEqual(await got(self.w1), [{"price": 50, "region": "eu"}])
+        self.assertEqual(await got(self.w2), [{"price": 50, "region": "eu"}])
+        self.assertEqual(await got(w3), [{"kind": "refund", "price": 5}, {"region": "eu"}, "plain text"])
+
+        await send({"action":"subscribe","topic":"orders","filter":{"price":{"$between":[1, 2]}}}, pub)
+        self.assertEqual((await self._read_jsons(pub))[-1]["message"], "Invalid filter: Unknown operator $between")
+
+    async def test_replay_from_offset_then_live(self):
+        send = lambda obj, w: self.broker.process_message(_NLJSONProtocol.encode(obj), w)
+        async def pushed(w):
+            return [(m["offset"], m["payload"]) for m in await self._read_jsons(w) if m.get("type") == "message"]
+        for i in range(3):
+            await send({"action":"publish","topic":"h","message":i}, self.w2)
+        await asyncio.sleep(0.02)
+        since = time.time()
+        for i in range(3, 5):
+            await send({"action":"publish","topic":"h","message":i}, self.w2)
+
+        await send({"action":"subscribe","topic":"h","from_offset":2}, self.w1)
+        res = (await self._read_jsons(self.w1))[0]
+        self.assertEqual((res["from_offset"], res["next_offset"]), (2, 5))
+        await asyncio.sleep(0.01)
+        await send({"action":"publish","topic":"h","message":5}, self.w2)
+        self.assertEqual(await pushed(self.w1), [(2, 2), (3, 3), (4, 4), (5, 5)])
+
+        w3 = FakeWriter()
+        await send({"action":"subscribe","topic":"h","from_timestamp":since}, w3)
+        await asyncio.sleep(0.01)
+        self.assertEqual(await pushed(w3), [(3, 3), (4, 4), (5, 5)])
+
+        # only the last two messages are retained now
+        await send({"action":"configure_topic","topic":"h","retain":2}, self.w2)
+        w4 = FakeWriter()
+        await send({"action":"subscribe","topic":"h","from_offset":0}, w4)
+        await asyncio.sleep(0.01)
+        self.assertEqual((await self._read_jsons(w4))[0]["from_offset"], 4)
+        self.assertEqual(await pushed(w4), [(4, 4), (5, 5)])
+
+    async def test_replay_does_not_block_publishers(self):
+        broker = HomeworkBroker(retain=5000)
+        send = lambda obj, w: broker.process_message(_NLJSONProtocol.encode(obj), w)
+        for i in range(3000):
+            await broker.publish("r", i, writer=self.w2)
+        await send({"action":"subscribe","topic":"r","from_offset":0}, self.w1)
+        # live publishes interleave with the chunked catch-up
+        for i in range(3000, 3020):
+            await asyncio.wait_for(broker.publish("r", i, writer=self.w2), timeout=0.5)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.05)
+        got = [m["offset"] for m in await self._read_jsons(self.w1) if m.get("type") == "message"]
+        self.assertEqual(got, list(range(3020)))
+        self.assertIn(self.w1, broker.topics["r"].subscribers)
+
+    def test_topic_trie_matching(self):
+        trie = TopicTrie()
+        for pattern in ("*.errors.#", "a.*.c", "#"):
+            trie.add(pattern, pattern)
+        match = lambda topic: sorted(key for key, _ in trie.match(topic))
+        self.assertEqual(match("api.errors"), ["#", "*.errors.#"])
+        self.assertEqual(match("db.errors.timeout.x"), ["#", "*.errors.#"])
+        self.assertEqual(match("a.b.c"), ["#", "a.*.c"])
+        self.assertEqual(match("a.c"), ["#"])
+        self.assertTrue(trie.remove("#", "#"))
+        self.assertEqual(match("a.c"), [])
+        self.assertEqual(len(trie), 2)
+
+    async def test_stats_reports_counters_gauges_and_latency(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"m"}), self.w1)
+        for i in range(5):
+            await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"m","message":i}), self.w2)
+        await self.broker.process_message(b'not json', self.w2)
+        self.w2.reset()
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"stats"}), self.w2)
+        stats = (await self._read_jsons(self.w2))[-1]["stats"]
+        self.assertEqual(stats["counters"]["messages_published"], 5)
+        self.assertEqual(stats["counters"]["messages_delivered"], 5)
+        self.assertEqual(stats["counters"]["request_errors"], 1)
+        self.assertEqual(stats["gauges"]["subscribers"], 1)
+        self.assertEqual(stats["gauges"]["queue_depth"], {"m": 5})
+        self.assertEqual(stats["latency"]["process_message"]["count"], 7)
+        self.assertEqual(stats["latency"]["publish_fanout"]["count"], 5)
+        self.assertGreater(stats["latency"]["send_response"]["p99_us"], 0)
+
+    async def test_metrics_http_endpoint(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"m","message":1}), self.w1)
+        server = await start_http_server(self.broker.render_metrics, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+            text = (await reader.read()).decode()
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+        self.assertTrue(text.startswith("HTTP/1.1 200 OK"))
+        self.assertIn("broker_messages_published_total 1", text)
+        self.assertIn('broker_queue_depth{topic="m"} 1', text)
+        self.assertIn('broker_process_message_seconds{quantile="0.99"}', text)
+
+    def test_histogram_percentiles_within_bucket_error(self):
+        h = Histogram()
+        for v in range(1, 100001):
+            h.record(v)
+        for q in (0.5, 0.99, 0.999):
+            self.assertAlmostEqual(h.percentile(q), q * 100000, delta=q * 100000 * 0.07)
+        self.assertEqual(h.percentile(1.0), 100000)
+        self.assertEqual(h.count, 100000)
+
+    async def test_sweeper_drops_expired_in_background(self):
+        broker = HomeworkBroker(sweep_interval=0.05)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"ttl","message":"tmp","ttl":1}), self.w1)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"ttl","message":"keep"}), self.w1)
+        await asyncio.sleep(1.15)
+        self.assertEqual(len(broker.topics["ttl"].queue), 1)
+        self.assertNotIn("ttl", broker._ttl_topics)
+        await broker.close()
+
+    def test_expiring_queue_pops_by_priority_and_skips_expired(self):
+        q = _ExpiringQueue()
+        now = time.monotonic()
+        q.push(_Message(1, 1, 0.0, None, "normal"))
+        q.push(_Message(0, 2, 0.0, now - 1, "stale"))
+        q.push(_Message(0, 3, 0.0, None, "high"))
+        self.assertEqual(q.pop().payload, "high")
+        self.assertEqual(q.pop().payload, "normal")
+        self.assertIsNone(q.pop())
+        self.assertEqual(len(q), 0)
+
+    async def test_fanout_shares_one_envelope(self):
+        class RecordingWriter(FakeWriter):
+            def __init__(self):
+                super().__init__()
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+                super().write(data)
+
+        subs = [RecordingWriter() for _ in range(3)]
+        for w in subs:
+            await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"f"}), w)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"f","message":"m"}), self.w1)
+        pushed = [w.chunks[-1] for w in subs]
+        self.assertTrue(all(chunk is pushed[0] for chunk in pushed))
+
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"unsubscribe","topic":"f"}), subs[0])
+        outboxes = self.broker.topics["f"].fanout[0][1]
+        self.assertEqual({o.writer for o in outboxes}, set(subs[1:]))
+
+    async def test_publish_batch_aggregated_ack(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"b1"}), self.w2)
+        await self.broker.process_message(_NLJSONProtocol.encode({
+            "action": "publish_batch",
+            "topic": "b1",
+            "messages": [{"message": 1}, {"message": 2, "priority": "high"}, {"topic": "b2", "message": 3}, {"message": 4, "priority": "urgent"}],
+        }), self.w1)
+        res = await self._read_jsons(self.w1)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0]["published"], 3)
+        self.assertEqual(res[0]["errors"][0]["index"], 3)
+        await asyncio.sleep(0.01)  # let the subscriber's writer task flush its queue
+        payloads = [m["payload"] for m in await self._read_jsons(self.w2) if m.get("type") == "message"]
+        self.assertEqual(payloads, [1, 2])
+        self.assertEqual(len(self.broker.topics["b2"].queue), 1)
+
+    async def test_request_validation_errors(self):
+        requests = [
+            ({}, "Missing 'action' field"),
+            ({"action": "teleport"}, "Unknown action 'teleport'"),
+            ({"action": ["publish"]}, "Unknown action '['publish']'"),
+            ({"action": "publish", "topic": "v"}, "Missing 'topic' or 'message' field"),
+            ({"action": "publish", "topic": "v", "message": 1, "priority": "urgent"}, "Invalid 'priority' (use high|normal|low)"),
+            ({"action": "publish", "topic": "v", "message": 1, "ttl": "soon"}, "Invalid 'ttl' (seconds expected)"),
+            ({"action": "ack", "topic": "v", "id": "1"}, "Missing 'topic' or 'id' field"),
+            ({"action": "unsubscribe"}, "Missing 'topic' field"),
+        ]
+        for request, message in requests:
+            self.w1.reset()
+            await self.broker.process_message(_NLJSONProtocol.encode(request), self.w1)
+            self.assertEqual(await self._read_jsons(self.w1), [{"status": "error", "message": message}])
+        # priority names are case-insensitive, as before
+        self.w1.reset()
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"v","message":1,"priority":"HIGH"}), self.w1)
+        self.assertEqual((await self._read_jsons(self.w1))[-1]["status"], "success")
+
+    async def test_custom_action_registration(self):
+        def validate(msg):
+            if not isinstance(msg.get("n"), int):
+                raise RequestError("Missing 'n' field")
+            return msg["n"]
+
+        async def double(broker, n, writer):
+            await broker.send_response({"status": "success", "result": n * 2}, writer)
+
+        self.broker.register_action("double", double, validate)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"double","n":21,"request_id":7}), self.w1)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"double"}), self.w1)
+        res = await self._read_jsons(self.w1)
+        self.assertEqual(res[0], {"status": "success", "result": 42, "request_id": 7})
+        self.assertEqual(res[1], {"status": "error", "message": "Missing 'n' field"})
+        # registrations are per broker
+        other = HomeworkBroker()
+        await other.process_message(_NLJSONProtocol.encode({"action":"double","n":1}), self.w2)
+        self.assertEqual((await self._read_jsons(self.w2))[-1]["message"], "Unknown action 'double'")
+
+    async def test_topic_password_is_hashed_and_checked_once_per_connection(self):
+        send = lambda obj, w: self.broker.process_message(_NLJSONProtocol.encode(obj), w)
+        await send({"action":"publish","topic":"s","message":1,"password":"pw"}, self.w1)
+        credential = self.broker.topics["s"].credential
+        self.assertNotIn(b"pw", credential.key + credential.salt)
+        # the connection that proved the password needs it no more
+        await send({"action":"publish","topic":"s","message":2}, self.w1)
+        await send({"action":"publish","topic":"s","message":3}, self.w2)
+        await send({"action":"publish","topic":"s","message":4,"password":"nope"}, self.w2)
+        r1, r2 = await self._read_jsons(self.w1), await self._read_jsons(self.w2)
+        self.assertEqual([r["status"] for r in r1], ["success", "success"])
+        self.assertEqual([r.get("message") for r in r2], ["Forbidden: wrong password"] * 2)
+        self.assertEqual(self.broker.metrics.counters["auth_failures"], 1)
+        await self.broker._cleanup_writer(self.w1)
+        self.assertEqual(self.broker.topics["s"].granted, set())
+
+    async def test_pattern_passwords_are_not_rehashed_on_fanout_rebuilds(self):
+        send = lambda obj, w: self.broker.process_message(_NLJSONProtocol.encode(obj), w)
+        w3, pub = FakeWriter(), FakeWriter()
+        await send({"action":"publish","topic":"s.old","message":0,"password":"pw"}, pub)
+        with mock.patch.object(TopicCredential, "verify", autospec=True, side_effect=TopicCredential.verify) as verify:
+            await send({"action":"subscribe","topic":"s.*","password":"pw"}, self.w1)
+            await send({"action":"subscribe","topic":"s.*","password":"nope"}, self.w2)
+            # a topic created with a password is checked against it in plain, without hashing
+            await send({"action":"publish","topic":"s.new","message":1,"password":"pw"}, pub)
+            for _ in range(3):
+                await send({"action":"subscribe","topic":"s.old"}, w3)
+                await send({"action":"unsubscribe","topic":"s.old"}, w3)
+            await send({"action":"publish","topic":"s.old","message":2}, pub)
+            # a refused password is not hashed again on retry
+            await send({"action":"publish","topic":"s.old","message":3,"password":"nope"}, self.w2)
+        # the two pattern subscriptions on s.old and the publisher's own password on s.new
+        self.assertEqual(verify.call_count, 3)
+        messages = lambda res: [m["payload"] for m in res if m.get("type") == "message"]
+        self.assertEqual(messages(await self._read_jsons(self.w1)), [1, 2])
+        self.assertEqual(messages(await self._read_jsons(self.w2)), [])
+        # only the request counts as a failed attempt, not the pattern subscriptions
+        self.assertEqual(self.broker.metrics.counters["auth_failures"], 1)
+
+    async def test_auth_challenge_proof_opens_a_session(self):
+        send = lambda obj, w: self.broker.process_message(_NLJSONProtocol.encode(obj), w)
+        await send({"action":"publish","topic":"s","message":1,"password":"pw"}, self.w1)
+        await send({"action":"auth_challenge","topic":"s"}, self.w2)
+        challenge = (await self._read_jsons(self.w2))[-1]
+        proof = client_proof("pw", challenge["salt"], challenge["iterations"], challenge["nonce"])
+        await send({"action":"auth","topic":"s","proof":proof}, self.w2)
+        await send({"action":"subscribe","topic":"s"}, self.w2)
+        # a nonce is good for one attempt
+        await send({"action":"auth","topic":"s","proof":proof}, self.w2)
+        res = (await self._read_jsons(self.w2))[1:]
+        self.assertEqual(res[0], {"status": "success", "topic": "s", "authenticated": True})
+        self.assertTrue(res[1]["subscribed"])
+        self.assertEqual(res[2]["message"], "Forbidden: wrong password")
+
+    async def test_idempotent_publish_is_stored_once(self):
+        send = lambda obj: self.broker.process_message(_NLJSONProtocol.encode(obj), self.w1)
+        for seq in (0, 0, 5, 3, 3):  # a retry, a gap, out of order, another retry
+            await send({"action":"publish","topic":"i","message":seq,"producer":"p1","seq":seq})
+        await send({"action":"publish","topic":"i","message":"other","producer":"p2","seq":0})
+        await send({"action":"publish_batch","topic":"i","producer":"p1","messages":[
+            {"message":"a","seq":5}, {"message":"b","seq":6}, {"message":"c","seq":6}]})
+        await send({"action":"publish","topic":"i","message":"x","producer":"p1","seq":-1})
+        res = await self._read_jsons(self.w1)
+        self.assertEqual([r.get("duplicate", False) for r in res[:6]], [False, True, False, False, True, False])
+        self.assertEqual((res[6]["published"], res[6]["duplicates"]), (1, 2))
+        self.assertEqual(res[7]["status"], "error")
+        self.assertEqual(len(self.broker.topics["i"].queue), 5)
+        self.assertEqual(self.broker.metrics.counters["publishes_deduplicated"], 4)
+        # beyond the window there is no telling: refused rather than stored twice
+        await send({"action":"publish","topic":"i","message":"y","producer":"p1","seq":5000})
+        await send({"action":"publish","topic":"i","message":"z","producer":"p1","seq":6})
+        self.assertIn("older than the dedup window", (await self._read_jsons(self.w1))[-1]["message"])
+
+    async def test_delayed_publish_is_delivered_when_due(self):
+        send = lambda obj: self.broker.process_message(_NLJSONProtocol.encode(obj), self.w2)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"subscribe","topic":"later"}), self.w1)
+        await send({"action":"publish","topic":"later","message":"b","delay":0.1})
+        await send({"action":"publish","topic":"later","message":"a","deliver_at":time.time() + 0.05,"ttl":60})
+        await send({"action":"publish","topic":"later","message":"now","deliver_at":"2000-01-01T00:00:00"})
+        await send({"action":"publish","topic":"later","message":"x","delay":1,"deliver_at":1})
+        await send({"action":"publish","topic":"later","message":"x","delay":"soon"})
+        res = await self._read_jsons(self.w2)
+        self.assertEqual([r["status"] for r in res], ["success"] * 3 + ["error"] * 2)
+        self.assertEqual(len(self.broker.topics["later"].queue), 1)
+        self.assertEqual(self.broker.stats_snapshot()["gauges"]["delayed_pending"], 2)
+        await asyncio.sleep(0.3)
+        pushed = [m for m in await self._read_jsons(self.w1) if m.get("type") == "message"]
+        self.assertEqual([m["payload"] for m in pushed], ["now", "a", "b"])
+        self.assertIsNotNone(pushed[1]["expires_at"])  # the ttl starts at delivery
+        self.assertEqual(self.broker.metrics.counters["messages_delayed"], 2)
+
+    async def test_delayed_publish_to_durable_topic_is_refused(self):
+        tmp = tempfile.TemporaryDirectory()
+        broker = HomeworkBroker(data_dir=tmp.name)
+        send = lambda obj: broker.process_message(_NLJSONProtocol.encode(obj), self.w1)
+        await send({"action":"configure_topic","topic":"d","durable":True})
+        await send({"action":"publish","topic":"d","message":"x","delay":5,"producer":"p","seq":1})
+        # the refused seq was not recorded: the retry without a delay is stored
+        await send({"action":"publish","topic":"d","message":"x","producer":"p","seq":1})
+        res = await self._read_jsons(self.w1)
+        self.assertEqual([r["status"] for r in res], ["success", "error", "success"])
+        self.assertIn("durable", res[1]["message"])
+        self.assertEqual(len(broker._timers), 0)
+        self.assertEqual(len(broker.topics["d"].queue), 1)
+        await broker.close()
+        tmp.cleanup()
+
+    def test_timing_wheel_fires_in_order_never_early(self):
+        wheel = TimingWheel(tick=1.0, start=0.0)
+        deadlines = [0.5, 3, 255, 256, 300.5, 70_000, 2**32 + 7, 2**40]  # every level, and beyond the last
+        for d in reversed(deadlines):
+            wheel.schedule(d, d)
+        fired = []
+        for now in (1, 2, 299, 301, 10**5, 2**33, 2**41):
+            due = wheel.advance(now)
+            self.assertTrue(all(d <= now for d in due))
+            fired += due
+        self.assertEqual(fired, deadlines)
+        self.assertEqual(len(wheel), 0)
+
+    def test_timing_wheel_with_few_levels_holds_long_delays(self):
+        rng = random.Random(7)
+        for levels in (1, 2):
+            wheel = TimingWheel(tick=1.0, levels=levels, start=0.0)
+            deadlines = sorted(rng.uniform(0, 30_000) for _ in range(200)) + [22_504.0]
+            for d in deadlines:
+                wheel.schedule(d, d)
+            fired, now = [], 0.0
+            while now < 31_000:
+                now += rng.uniform(1, 700)
+                due = wheel.advance(now)
+                self.assertTrue(all(d <= now for d in due), (levels, now))
+                fired += due
+            self.assertEqual(sorted(fired), sorted(deadlines))
+            self.assertEqual(len(wheel), 0)
+
+    def test_dedup_index_memory_is_bounded(self):
+        index = DedupIndex(window=64, idle=10.0, max_producers=3)
+        for producer in range(5):
+            index.add((producer, "t"), 1, now=0.0)
+        self.assertEqual((len(index), index.forgotten), (3, 2))
+        index.add((2, "t"), 2, now=5.0)
+        index.add(("new", "t"), 0, now=12.0)  # producers 3 and 4 have been idle too long
+        self.assertEqual(len(index), 2)
+        index.add((2, "t"), 10**12, now=12.0)  # a far jump resets the bitmap instead of growing it
+        self.assertLess(index._windows[(2, "t")].bits.bit_length(), 65)
+
+    async def test_pipelined_requests_get_one_coalesced_write(self):
+        class CountingWriter(FakeWriter):
+            def __init__(self):
+                super().__init__()
+                self.calls = 0
+
+            def write(self, data):
+                self.calls += 1
+                super().write(data)
+
+            def writelines(self, chunks):
+                self.calls += 1
+                for data in chunks:
+                    super().write(data)
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(_NLJSONProtocol.encode({"action":"publish","topic":"p","message":i}) for i in range(5)))
+        reader.feed_eof()
+        writer = CountingWriter()
+        await self.broker.handle_client(reader, writer)
+        res = await self._read_jsons(writer)
+        self.assertEqual([r["status"] for r in res], ["success"] * 5)
+        self.assertEqual(writer.calls, 1)
+
+    async def _deliveries(self, writer):
+        await asyncio.sleep(0.01)
+        return [m for m in await self._read_jsons(writer) if m.get("type") == "delivery"]
+
+    async def test_consume_respects_priority_and_prefetch(self):
+        for text, prio in (("low", "low"), ("high", "high"), ("normal", "normal")):
+            await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"jobs","message":text,"priority":prio}), self.w1)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"consume","topic":"jobs","prefetch":2}), self.w2)
+        got = await self._deliveries(self.w2)
+        self.assertEqual([d["payload"] for d in got], ["high", "normal"])
+
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"ack","topic":"jobs","id":got[0]["id"]}), self.w2)
+        got = await self._deliveries(self.w2)
+        self.assertEqual([d["payload"] for d in got], ["high", "normal", "low"])
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"queue_length","topic":"jobs"}), self.w1)
+        self.assertEqual((await self._read_jsons(self.w1))[-1]["messages"], 0)
+
+    async def test_nack_requeues_and_ack_unknown_id_fails(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"consume","topic":"n","prefetch":1}), self.w2)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"n","message":"job"}), self.w1)
+        first = (await self._deliveries(self.w2))[0]
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"nack","topic":"n","id":first["id"]}), self.w2)
+        again = (await self._deliveries(self.w2))[-1]
+        self.assertEqual((again["id"], again["attempt"]), (first["id"], 2))
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"ack","topic":"n","id":again["id"]}), self.w1)
+        self.assertEqual((await self._read_jsons(self.w1))[-1]["status"], "error")
+
+    async def test_unacked_delivery_redelivered_after_visibility_timeout(self):
+        broker = HomeworkBroker(sweep_interval=0.02)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"consume","topic":"v","prefetch":1,"visibility_timeout":0.05}), self.w2)
+        await broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"v","message":"slow"}), self.w1)
+        await asyncio.sleep(0.2)
+        attempts = [d["attempt"] for d in await self._deliveries(self.w2)]
+        self.assertGreaterEqual(len(attempts), 2)
+        self.assertEqual(attempts[:2], [1, 2])
+        await broker.close()
+
+    async def test_dead_letter_topic_collects_what_the_topic_gives_up_on(self):
+        broker = HomeworkBroker(sweep_interval=0.02, send_queue_size=1)
+        send = lambda obj, w=self.w1: broker.process_message(_NLJSONProtocol.encode(obj), w)
+        await send({"action":"configure_topic","topic":"jobs","dead_letter":"jobs.dlq","max_attempts":2,"overflow":"drop_newest"})
+        await send({"action":"configure_topic","topic":"jobs","dead_letter":"jobs"})
+        res = await self._read_jsons(self.w1)
+        self.assertEqual((res[0]["dead_letter"], res[0]["max_attempts"], res[1]["status"]), ("jobs.dlq", 2, "error"))
+        # rejected twice (the limit), rejected for good, expired, and missed by a stalled subscriber
+        await send({"action":"consume","topic":"jobs","prefetch":2}, self.w2)
+        await send({"action":"publish","topic":"jobs","message":"retried"})
+        await send({"action":"publish","topic":"jobs","message":"refused"})
+        retried, refused = await self._deliveries(self.w2)
+        await send({"action":"nack","topic":"jobs","id":retried["id"]}, self.w2)
+        await send({"action":"nack","topic":"jobs","id":refused["id"],"requeue":False}, self.w2)
+        await send({"action":"nack","topic":"jobs","id":retried["id"]}, self.w2)
+        nacks = [r for r in await self._read_jsons(self.w2) if r.get("nacked")]
+        self.assertEqual(
+            [(r["requeued"], r.get("dead_letter"), r.get("reason")) for r in nacks],
+            [(True, None, None), (False, "jobs.dlq", "rejected"), (False, "jobs.dlq", "max_attempts")],
+        )
+        await broker._cleanup_writer(self.w2)
+        await send({"action":"publish","topic":"jobs","message":"stale","ttl":60})
+        for message in broker.topics["jobs"].queue.index.values():
+            message.deadline = 0.0
+        broker.topics["jobs"].queue.deadlines = [(0.0, seq) for _, seq in broker.topics["jobs"].queue.deadlines]
+        slow = SlowWriter()
+        await send({"action":"subscribe","topic":"jobs"}, slow)
+        slow.stall()
+        for i in range(3):
+            await send({"action":"publish","topic":"jobs","message":f"fanout-{i}"})
+        await asyncio.sleep(0.1)
+        letters = {m.payload["message"]: m.payload for m in broker.topics["jobs.dlq"].queue.messages()}
+        self.assertEqual(
+            {payload: (letter["reason"], letter["attempts"]) for payload, letter in letters.items()},
+            {
+                "retried": ("max_attempts", 2),
+                "refused": ("rejected", 1),
+                "stale": ("expired", 0),
+                "fanout-2": ("undeliverable", 0),
+            },
+        )
+        self.assertEqual(letters["stale"]["topic"], "jobs")
+        self.assertEqual(broker.metrics.counters["messages_dead_lettered"], 4)
+        # with every letter moved and nothing expiring or in flight, the sweeper stops
+        await asyncio.sleep(0.05)
+        self.assertTrue(broker._sweeper.done())
+        await broker.close()
+
+    async def test_disconnected_consumer_work_goes_to_others(self):
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"consume","topic":"d","prefetch":1}), self.w1)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"publish","topic":"d","message":"task"}), self.w1)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"consume","topic":"d","prefetch":1}), self.w2)
+        self.assertEqual(await self._deliveries(self.w2), [])
+        await self.broker._cleanup_writer(self.w1)
+        self.assertEqual([d["payload"] for d in await self._deliveries(self.w2)], ["task"])
+
+
+class FramedProtocolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.broker = HomeworkBroker()
+        self.server = await asyncio.start_server(self.broker.handle_client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.broker.close()
+
+    async def test_framed_publisher_reaches_nljson_subscriber(self):
+        sub_reader, sub_writer = await asyncio.open_connection("127.0.0.1", self.port)
+        sub_writer.write(_NLJSONProtocol.encode({"action":"subscribe","topic":"mix"}))
+        await sub_writer.drain()
+        self.assertTrue(json.loads(await sub_reader.readline())["subscribed"])
+
+        reader, writer, protocol = await open_framed_connection("127.0.0.1", self.port, codec="json")
+        writer.write(protocol.encode({"action":"publish","topic":"mix","message":{"n":1}}))
+        await writer.drain()
+        self.assertEqual(protocol.decode(await read_frame(reader)), {"status":"success","topic":"mix"})
+
+        pushed = json.loads(await asyncio.wait_for(sub_reader.readline(), timeout=1))
+        self.assertEqual(pushed["payload"], {"n": 1})
+        for w in (writer, sub_writer):
+            w.close()
+            await w.wait_closed()
+
+    async def test_framed_invalid_body_returns_error(self):
+        reader, writer, protocol = await open_framed_connection("127.0.0.1", self.port, codec="json")
+        writer.write(b"\x00\x00\x00\x03{{{")
+        await writer.drain()
+        self.assertEqual(protocol.decode(await read_frame(reader))["status"], "error")
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_compressed_frames_are_shared_by_subscribers(self):
+        conns = []
+        # one subscriber switches to compression after subscribing, the other before
+        for late in (True, False):
+            reader, writer, protocol = await open_framed_connection(
+                "127.0.0.1", self.port, codec="json", compression=() if late else ("zlib",)
+            )
+            writer.write(protocol.encode({"action": "subscribe", "topic": "big"}))
+            await writer.drain()
+            self.assertTrue(protocol.decode(await read_frame(reader))["subscribed"])
+            if late:
+                writer.write(protocol.encode({"action": "compression", "codecs": ["nope", "zlib"]}))
+                await writer.drain()
+                self.assertEqual(protocol.decode(await read_frame(reader))["compression"], "zlib")
+            conns.append((reader, writer))
+        _, idle, decoder = await open_framed_connection("127.0.0.1", self.port, codec="json", compression=("zlib",))
+        self.assertEqual(decoder.name, "framed-json-zlib")
+
+        reader, writer, protocol = await open_framed_connection("127.0.0.1", self.port, codec="json", compression=("zlib",))
+        payload = {"rows": [{"name": "widget", "price": 9.99, "n": i} for i in range(50)]}
+        frame = protocol.encode({"action": "publish", "topic": "big", "message": payload})
+        self.assertEqual(frame[4:5], b"\x00")
+        writer.write(frame + protocol.encode({"action": "publish", "topic": "big", "message": "small"}))
+        await writer.drain()
+        self.assertEqual(protocol.decode(await read_frame(reader))["status"], "success")
+
+        bodies = [await asyncio.wait_for(read_frame(r), timeout=1) for r, _ in conns]
+        self.assertEqual(bodies[0], bodies[1])
+        self.assertEqual(bodies[0][:1], b"\x00")
+        self.assertLess(len(bodies[0]), len(json.dumps(payload)) // 4)
+        self.assertEqual(decoder.decode(bodies[0])["payload"], payload)
+        # below the size threshold frames stay uncompressed
+        small = await asyncio.wait_for(read_frame(conns[0][0]), timeout=1)
+        self.assertEqual(json.loads(small)["payload"], "small")
+        for _, w in conns + [(reader, writer), (None, idle)]:
+            w.close()
+            await w.wait_closed()
+
+    async def test_compression_needs_framed_connection_and_common_codec(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(_NLJSONProtocol.encode({"action": "compression", "codecs": ["zlib"]}))
+        await writer.drain()
+        self.assertEqual(json.loads(await reader.readline())["status"], "error")
+        writer.close()
+        await writer.wait_closed()
+
+        reader, writer, protocol = await open_framed_connection("127.0.0.1", self.port, codec="json")
+        writer.write(protocol.encode({"action": "compression", "codecs": ["brotli"]}))
+        # a compressed frame before negotiation is rejected, not misread
+        writer.write(b"\x00\x00\x00\x02\x00x")
+        await writer.drain()
+        self.assertEqual(protocol.decode(await read_frame(reader)), {"status": "success", "compression": None})
+        self.assertEqual(protocol.decode(await read_frame(reader))["status"], "error")
+        writer.close()
+        await writer.wait_closed()
+
+
+class ProtocolTransportTest(FramedProtocolTest):
+    """The framed tests again, plus NLJSON pipelining, over BrokerProtocol instead of streams."""
+
+    async def asyncSetUp(self):
+        self.broker = HomeworkBroker()
+        self.server = await start_broker_server(self.broker, "127.0.0.1", 0, transport="protocol")
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def test_concurrent_drains_all_wake_on_resume_and_loss(self):
+        writer = _TransportWriter(FakeWriter())
+        # resumed: both return; connection lost: both raise
+        for wake, expected in ((lambda: writer._set_paused(False), [None, None]), (writer._connection_lost, None)):
+            writer._set_paused(True)
+            drains = [asyncio.create_task(writer.drain()) for _ in range(2)]
+            await asyncio.sleep(0)
+            self.assertFalse(any(d.done() for d in drains))
+            wake()
+            results = await asyncio.wait_for(asyncio.gather(*drains, return_exceptions=True), timeout=1)
+            if expected is None:
+                self.assertTrue(all(isinstance(r, ConnectionResetError) for r in results))
+            else:
+                self.assertEqual(results, expected)
+
+    async def test_pipelined_lines_and_last_line_at_eof(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        lines = [_NLJSONProtocol.encode({"action":"publish","topic":"p","message":i,"request_id":i}) for i in range(50)]
+        # split mid-line, and the last request has no trailing newline
+        data = b"".join(lines) + b'{"action":"queue_length","topic":"p"}'
+        writer.write(data[:1001])
+        await writer.drain()
+        writer.write(data[1001:])
+        writer.write_eof()
+        res = [json.loads(line) for line in (await reader.read()).splitlines()]
+        self.assertEqual([r["request_id"] for r in res[:50]], list(range(50)))
+        self.assertEqual(res[50]["messages"], 50)
+        writer.close()
+        await writer.wait_closed()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.broker._client_count, 0)
+
+
+class DurableTopicTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.w = FakeWriter()
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    async def _send(self, broker, obj):
+        await broker.process_message(_NLJSONProtocol.encode(obj), self.w)
+        return json.loads(self.w.getvalue().decode("utf-8").strip().splitlines()[-1])
+
+    async def test_durable_topic_survives_restart(self):
+        broker = HomeworkBroker(data_dir=self.tmp.name)
+        await self._send(broker, {"action":"publish","topic":"d","message":"first","password":"pw"})
+        res = await self._send(broker, {"action":"configure_topic","topic":"d","durable":True,"password":"pw"})
+        self.assertTrue(res["durable"])
+        for i in range(3):
+            await self._send(broker, {"action":"publish","topic":"d","message":i,"password":"pw","priority":"high" if i == 2 else "normal"})
+        await self._send(broker, {"action":"consume","topic":"d","prefetch":1,"password":"pw"})
+        delivery = next(m for m in map(json.loads, self.w.getvalue().decode().splitlines()) if m.get("type") == "delivery")
+        await self._send(broker, {"action":"ack","topic":"d","id":delivery["id"]})
+        await broker.close()
+
+        restarted = HomeworkBroker(data_dir=self.tmp.name)
+        self.assertEqual((await self._send(restarted, {"action":"publish","topic":"d","message":"x"}))["status"], "error")
+        self.assertEqual((await self._send(restarted, {"action":"queue_length","topic":"d"}))["messages"], 2)
+        self.assertEqual(restarted.topics["d"].queue.pop().payload, 0)
+        await restarted.close()
+
+    async def test_dead_letter_topic_recovers_outside_event_loop(self):
+        broker = HomeworkBroker(data_dir=self.tmp.name)
+        await self._send(broker, {"action":"configure_topic","topic":"jobs","durable":True,"dead_letter":"jobs.dlq"})
+        await broker.close()
+        # built like in run_server.py, before asyncio.run(): no running loop during recovery
+        restarted = await asyncio.to_thread(HomeworkBroker, data_dir=self.tmp.name)
+        self.assertEqual(restarted.topics["jobs"].dead_letter, "jobs.dlq")
+        self.assertIsNone(restarted._sweeper)
+        # a dead-letter topic alone is nothing to sweep
+        restarted.resume_sweeper()
+        self.assertIsNone(restarted._sweeper)
+        await self._send(restarted, {"action":"publish","topic":"jobs","message":"m","ttl":60})
+        await restarted.close()
+        recovered = await asyncio.to_thread(HomeworkBroker, data_dir=self.tmp.name)
+        recovered.resume_sweeper()
+        self.assertIsNotNone(recovered._sweeper)
+        await recovered.close()
+
+    async def test_durable_requires_data_dir(self):
+        res = await self._send(HomeworkBroker(), {"action":"configure_topic","topic":"d","durable":True})
+        self.assertEqual(res["status"], "error")
+
+    async def test_torn_tail_is_ignored(self):
+        wal = WriteAheadLog(self.tmp.name)
+        wal.recover()
+        await wal.append(broker_wal.PUT, broker_wal.put_record("t", 1, 1, 0.0, None, "ok"))
+        await wal.close()
+        path = os.path.join(self.tmp.name, broker_wal.segment_name(1))
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x00\x10garbage")
+        _, records, max_seq = WriteAheadLog(self.tmp.name).recover()
+        self.assertEqual([r["d"] for r in records], ["ok"])
+        self.assertEqual(max_seq, 1)
+
+    async def test_compaction_keeps_only_live_messages(self):
+        wal = WriteAheadLog(self.tmp.name, fsync="never", segment_bytes=256, compact_after=2)
+        wal.recover()
+        for seq in range(1, 41):
+            wal.append(broker_wal.PUT, broker_wal.put_record("t", seq, 1, 0.0, None, "m" * 20))
+            if seq % 2 == 0:
+                wal.append(broker_wal.DELETE, {"t": "t", "s": seq})
+            await asyncio.sleep(0)
+        # the background compaction only covers what was sealed when it started: finish it,
+        # then fold everything sealed since, so the segment count does not depend on timing
+        if wal._compacting is not None:
+            await wal._compacting
+        wal.compact([i for i in wal.segments() if i < wal._active_index])
+        await wal.close()
+        self.assertNotIn(1, wal.segments())  # folded into a compacted segment
+        self.assertEqual(len(wal.segments()), 2)  # the compacted segment and the active one
+        _, records, _ = WriteAheadLog(self.tmp.name).recover()
+        self.assertEqual([r["s"] for r in records], list(range(1, 41, 2)))
+
+
+    async def test_crash_during_compaction_keeps_deletes(self):
+        wal = WriteAheadLog(self.tmp.name, fsync="never", segment_bytes=1, compact_after=100)
+        wal.recover()
+        # one record per segment: the delete of 1 lives in the newest sealed segment
+        for kind, rec in ((broker_wal.PUT, broker_wal.put_record("t", 1, 1, 0.0, None, "a")),
+                          (broker_wal.PUT, broker_wal.put_record("t", 2, 1, 0.0, None, "b")),
+                          (broker_wal.DELETE, {"t": "t", "s": 1})):
+            wal.append(kind, rec)
+            await asyncio.sleep(0)
+        await wal.close()
+        sealed = wal.segments()
+        # crash after the output is complete, before any input is removed
+        with mock.patch("broker_wal.os.remove", side_effect=OSError("crash")):
+            with self.assertRaises(OSError):
+                WriteAheadLog(self.tmp.name).compact(sealed)
+        _, records, _ = WriteAheadLog(self.tmp.name).recover()
+        self.assertEqual([r["s"] for r in records], [2])
+        self.assertFalse([n for n in os.listdir(self.tmp.name) if not n.endswith(".log")])
+
+
+class MemoryQuotaTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.w = FakeWriter()
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    async def _send(self, broker, obj):
+        await broker.process_message(_NLJSONProtocol.encode(obj), self.w)
+        return json.loads(self.w.getvalue().decode("utf-8").strip().splitlines()[-1])
+
+    async def test_spilled_messages_page_back_in_priority_order(self):
+        # room for about four messages in memory
+        broker = HomeworkBroker(topic_memory_limit=1200, spill_dir=self.tmp.name)
+        published = [(f"low{i}", "low") for i in range(10)] + [(f"high{i}", "high") for i in range(10)]
+        for text, prio in published:
+            self.assertEqual((await self._send(broker, {"action":"publish","topic":"q","message":text,"priority":prio}))["status"], "success")
+        res = await self._send(broker, {"action":"queue_length","topic":"q"})
+        self.assertEqual(res["messages"], 20)
+        self.assertEqual(res["spilled"], 16)
+        self.assertLessEqual(res["memory_bytes"], 1200)
+        self.assertTrue(os.listdir(self.tmp.name))
+
+        consumer = FakeWriter()
+        await broker.process_message(_NLJSONProtocol.encode({"action":"consume","topic":"q","prefetch":100}), consumer)
+        await asyncio.sleep(0.01)
+        got = [m["payload"] for m in map(json.loads, consumer.getvalue().decode().splitlines()) if m.get("type") == "delivery"]
+        # the spilled highs overtake the lows that stayed in memory; each level stays FIFO
+        self.assertEqual(got, [f"high{i}" for i in range(10)] + [f"low{i}" for i in range(10)])
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(broker.stats_snapshot()["gauges"]["spill_bytes"], 0)
+        await broker.close()
+
+    async def test_spill_bounds_open_files_and_reads_ahead(self):
+        broker = HomeworkBroker(topic_memory_limit=600, spill_dir=self.tmp.name)
+        broker._spill.max_open = 2
+        for i in range(10):
+            for t in range(5):
+                await self._send(broker, {"action":"publish","topic":f"t{t}","message":f"{t}-{i}"})
+        fifos = lambda: [f for state in broker.topics.values() for f in state.queue.spill.fifos.values()]
+        self.assertEqual(len(fifos()), 5)
+        # two FIFOs with a reader and a writer at most; the others reopen where they stopped
+        self.assertLessEqual(sum(f.open_files() for f in fifos()), 4)
+        for t in range(5):
+            queue = broker.topics[f"t{t}"].queue
+            fifo = queue.spill.fifos[1]
+            got = []
+            while not fifo.ahead:
+                got.append(queue.pop().payload)
+                while fifo._reading is not None:
+                    await asyncio.sleep(0.001)
+            # the rest was read in a worker thread: the loop does no more reads
+            with mock.patch.object(fifo, "_read", side_effect=AssertionError("read on the loop")):
+                got += [m.payload for m in iter(queue.pop, None)]
+            self.assertEqual(got, [f"{t}-{i}" for i in range(10)])
+            self.assertLessEqual(sum(f.open_files() for f in fifos()), 4)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        await broker.close()
+
+    async def test_expired_spilled_messages_are_not_counted(self):
+        broker = HomeworkBroker(topic_memory_limit=600, spill_dir=self.tmp.name)
+        for i in range(2):  # what fits in memory
+            await self._send(broker, {"action":"publish","topic":"q","message":f"kept{i}"})
+        for i in range(5):
+            await self._send(broker, {"action":"publish","topic":"q","message":f"brief{i}","ttl":1})
+        await self._send(broker, {"action":"publish","topic":"q","message":"last"})
+        res = await self._send(broker, {"action":"queue_length","topic":"q"})
+        self.assertEqual((res["messages"], res["spilled"]), (8, 6))
+        # spilled records carry wall-clock expiry
+        with mock.patch("time.time", return_value=time.time() + 2):
+            res = await self._send(broker, {"action":"queue_length","topic":"q"})
+            self.assertEqual((res["messages"], res["spilled"]), (3, 1))
+            queue = broker.topics["q"].queue
+            self.assertEqual([m.payload for m in iter(queue.pop, None)], ["kept0", "kept1", "last"])
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        await broker.close()
+
+    async def test_publishers_are_refused_when_disk_budget_is_used_up(self):
+        broker = HomeworkBroker(memory_limit=1000, spill_dir=self.tmp.name, spill_limit=500)
+        statuses = [(await self._send(broker, {"action":"publish","topic":f"t{i % 2}","message":"x" * 100}))["status"] for i in range(12)]
+        self.assertIn("error", statuses)
+        self.assertEqual(self.w.getvalue().decode().splitlines()[-1], json.dumps({"status": "error", "message": "Topic 't1' is full, retry later"}))
+        accepted = statuses.count("success")
+        self.assertEqual(sum(len(s.queue) for s in broker.topics.values()), accepted)
+        self.assertEqual(broker.stats_snapshot()["counters"]["publishes_rejected"], 12 - accepted)
+        # draining makes room again
+        await self._send(broker, {"action":"clear_topic","topic":"t0"})
+        await self._send(broker, {"action":"clear_topic","topic":"t1"})
+        self.assertEqual((await self._send(broker, {"action":"publish","topic":"t1","message":"y"}))["status"], "success")
+        await broker.close()
+
+    async def test_retained_log_counts_against_memory_limit(self):
+        broker = HomeworkBroker(memory_limit=10_000, spill_dir=self.tmp.name)
+        state = broker._get_or_create_topic("big")
+
+        def resident():
+            held = {id(m): m for m in state.queue.index.values()}
+            held.update((id(m), m) for m in state.log.read(state.log.first, state.log.capacity))
+            return sum(_message_size(m.payload) for m in held.values())
+
+        for round_ in range(2):
+            for i in range(50):
+                res = await self._send(broker, {"action": "publish", "topic": "big", "message": "x" * 1000})
+                self.assertEqual(res["status"], "success")
+            self.assertGreater(state.queue.spilled, 0)
+            self.assertLessEqual(resident(), 10_000)
+            self.assertEqual(resident(), broker._memory.used)
+            # consumed messages stay retained for replay, still within the limit
+            while state.queue.pop() is not None:
+                self.assertLessEqual(resident(), 10_000)
+        # under pressure the log gave way; with room again it retains what is consumed
+        for i in range(3):
+            await self._send(broker, {"action": "publish", "topic": "big", "message": i})
+        while state.queue.pop() is not None:
+            pass
+        self.assertEqual([m.payload for m in state.log.read(state.log.next - 3, 3)], [0, 1, 2])
+        self.assertEqual(resident(), broker._memory.used)
+        await broker.close()
+
+    async def test_configure_topic_memory_limit_without_spill(self):
+        broker = HomeworkBroker()
+        res = await self._send(broker, {"action":"configure_topic","topic":"m","memory_limit":700})
+        self.assertEqual(res["memory_limit"], 700)
+        first = await self._send(broker, {"action":"publish","topic":"m","message":"a"})
+        second = await self._send(broker, {"action":"publish","topic":"m","message":"b"})
+        third = await self._send(broker, {"action":"publish","topic":"m","message":"c"})
+        self.assertEqual([first["status"], second["status"], third["status"]], ["success", "success", "error"])
+        self.assertEqual((await self._send(broker, {"action":"configure_topic","topic":"m","memory_limit":-1}))["status"], "error")
+        await broker.close()
+
+
+class ShardedWorkersTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.brokers = [ShardedBroker(i, 2, self.tmp.name) for i in range(2)]
+        self.servers = []
+        self.ports = []
+        for broker in self.brokers:
+            await broker.start_link_server()
+            server = await asyncio.start_server(broker.handle_client, "127.0.0.1", 0)
+            self.servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+        self.conns = []
+        # one topic owned by each worker
+        names = (f"topic-{i}" for i in range(100))
+        self.owned = {}
+        for name in names:
+            self.owned.setdefault(self.brokers[0].owner(name), name)
+            if len(self.owned) == 2:
+                break
+
+    async def asyncTearDown(self):
+        for _, writer in self.conns:
+            writer.close()
+        await asyncio.sleep(0.05)
+        for server, broker in zip(self.servers, self.brokers):
+            server.close()
+            await server.wait_closed()
+            await broker.close()
+        self.tmp.cleanup()
+
+    async def _connect(self, worker):
+        conn = await asyncio.open_connection("127.0.0.1", self.ports[worker])
+        self.conns.append(conn)
+        return conn
+
+    async def _call(self, conn, obj):
+        reader, writer = conn
+        writer.write(_NLJSONProtocol.encode(obj))
+        await writer.drain()
+        while True:
+            res = json.loads(await asyncio.wait_for(reader.readline(), timeout=2))
+            if "status" in res:
+                return res
+
+    async def test_cross_worker_publish_subscribe(self):
+        remote_topic = self.owned[1]
+        sub = await self._connect(0)
+        pub = await self._connect(1)
+        self.assertTrue((await self._call(sub, {"action":"subscribe","topic":remote_topic}))["subscribed"])
+        self.assertEqual((await self._call(pub, {"action":"publish","topic":remote_topic,"message":"hi"}))["status"], "success")
+        pushed = json.loads(await asyncio.wait_for(sub[0].readline(), timeout=2))
+        self.assertEqual((pushed["topic"], pushed["payload"]), (remote_topic, "hi"))
+        self.assertEqual(self.brokers[0].topics.get(remote_topic), None)
+        self.assertEqual(len(self.brokers[1].topics[remote_topic].queue), 1)
+
+        sub[1].close()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.brokers[1].topics[remote_topic].subscribers, set())
+
+    async def test_wildcard_subscription_spans_workers(self):
+        sub = await self._connect(0)
+        pub = await self._connect(1)
+        self.assertTrue((await self._call(sub, {"action":"subscribe","topic":"#"}))["pattern"])
+        for topic in (self.owned[0], self.owned[1]):
+            await self._call(pub, {"action":"publish","topic":topic,"message":topic})
+        pushed = [json.loads(await asyncio.wait_for(sub[0].readline(), timeout=2)) for _ in range(2)]
+        self.assertEqual(sorted(m["topic"] for m in pushed), sorted(self.owned.values()))
+
+    async def test_batch_and_list_topics_span_workers(self):
+        conn = await self._connect(0)
+        res = await self._call(conn, {"action":"publish_batch","messages":[
+            {"topic": self.owned[0], "message": 1},
+            {"topic": self.owned[1], "message": 2},
+            {"topic": self.owned[1], "message": 3, "priority": "bogus"},
+        ]})
+        self.assertEqual(res["published"], 2)
+        self.assertEqual(res["errors"][0]["index"], 2)
+        res = await self._call(conn, {"action":"list_topics"})
+        self.assertEqual(res["topics"], sorted(self.owned.values()))
+        res = await self._call(conn, {"action":"queue_length","topic":self.owned[1]})
+        self.assertEqual(res["messages"], 1)
+
+
+def _free_ports(count):
+    import socket
+    socks = [socket.socket() for _ in range(count)]
+    for sock in socks:
+        sock.bind(("127.0.0.1", 0))
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+class ClusterTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        ports = _free_ports(6)
+        self.nodes = [ClusterNode("127.0.0.1", ports[2 * i], ports[2 * i + 1]) for i in range(3)]
+        self.brokers = [
+            ClusterBroker(i, self.nodes, partitions=4, acks="quorum", heartbeat_interval=0.05, failure_timeout=0.3)
+            for i in range(3)
+        ]
+        for broker in self.brokers:
+            await broker.start()
+        await asyncio.sleep(0.2)  # every node has seen the others ready
+        self.conns = []
+
+    async def asyncTearDown(self):
+        for _, writer in self.conns:
+            writer.close()
+        for broker in self.brokers:
+            await broker.close()
+
+    async def _call(self, node, obj):
+        conn = await asyncio.open_connection("127.0.0.1", self.nodes[node].port)
+        self.conns.append(conn)
+        reader, writer = conn
+        writer.write(_NLJSONProtocol.encode(obj))
+        await writer.drain()
+        while True:
+            res = json.loads(await asyncio.wait_for(reader.readline(), timeout=3))
+            if "status" in res:
+                return res
+
+    async def test_publish_through_any_node_is_replicated(self):
+        leader = self.brokers[0].owner("orders")
+        other = (leader + 1) % 3
+        res = await self._call(other, {"action":"publish","topic":"orders","message":{"id":1}})
+        self.assertEqual(res["status"], "success")
+        located = await self._call(other, {"action":"locate","topic":"orders"})
+        self.assertEqual((located["leader"], located["address"]), (leader, f"127.0.0.1:{self.nodes[leader].port}"))
+        # quorum ack: the leader and at least one follower already hold the message
+        await asyncio.sleep(0.05)
+        self.assertEqual([len(b.topics["orders"].queue) for b in self.brokers], [1, 1, 1])
+
+    async def test_follower_takes_over_when_leader_dies(self):
+        leader = self.brokers[0].owner("orders")
+        for i in range(3):
+            res = await self._call(leader, {"action":"publish","topic":"orders","message":i})
+            self.assertEqual(res["status"], "success")
+        consumed = await self._call(leader, {"action":"consume","topic":"orders","prefetch":1})
+        self.assertTrue(consumed["consuming"])
+        await self.brokers[leader].close()
+        await asyncio.sleep(0.6)
+
+        survivor = (leader + 1) % 3
+        self.assertNotEqual(self.brokers[survivor].owner("orders"), leader)
+        # the delivery was never acked, so the new leader still has all three messages
+        res = await self._call(survivor, {"action":"queue_length","topic":"orders"})
+        self.assertEqual(res["messages"], 3)
+        res = await self._call(survivor, {"action":"publish","topic":"orders","message":3})
+        self.assertEqual(res["status"], "success")
+
+
+class BrokerClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.broker = HomeworkBroker()
+        self.server = await asyncio.start_server(self.broker.handle_client, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.client = BrokerClient("127.0.0.1", self.port, pool_size=2, timeout=2)
+        await self.client.connect()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await asyncio.sleep(0.05)
+        self.server.close()
+        await self.server.wait_closed()
+        await self.broker.close()
+
+    async def test_request_id_is_echoed(self):
+        w = FakeWriter()
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"queue_length","topic":"x","request_id":7}), w)
+        await self.broker.process_message(_NLJSONProtocol.encode({"action":"list_topics"}), w)
+        res = [json.loads(x) for x in w.getvalue().splitlines()]
+        self.assertEqual((res[0]["status"], res[0]["request_id"]), ("error", 7))
+        self.assertNotIn("request_id", res[1])
+
+    async def test_pipelined_requests_and_batched_publishes(self):
+        await asyncio.gather(*(self.client.publish(f"t{i % 3}", i) for i in range(250)))
+        lengths = await asyncio.gather(*(self.client.queue_length(f"t{i}") for i in range(3)))
+        self.assertEqual(lengths, [84, 83, 83])
+        # 250 publishes went out as batches of at most 100, not one request each
+        self.assertLessEqual(self.broker.metrics.histograms["process_message"].count, 3 + 3)
+        with self.assertRaises(BrokerError):
+            await self.client.publish("t0", 1, priority="urgent")
+        with self.assertRaises(BrokerError):
+            await self.client.queue_length("missing")
+
+    async def test_subscription_iterates_and_survives_reconnect(self):
+        sub = await self.client.subscribe("news")
+        await self.client.publish("news", "a")
+        self.assertEqual((await sub.get(timeout=2)).payload, "a")
+        # drop the client's connection on the server side, publish while it is away
+        for writer in list(self.broker._writer_topics):
+            writer.close()
+        await asyncio.sleep(0.05)
+        await self.broker.publish("news", "b", writer=FakeWriter())
+        await self.broker.publish("news", "c", writer=FakeWriter())
+        got = [(await sub.get(timeout=2)).payload for _ in range(2)]
+        self.assertEqual(got, ["b", "c"])
+        await self.client.publish("news", "d")
+        self.assertEqual((await sub.get(timeout=2)).offset, 3)
+        await sub.close()
+        self.assertEqual([m async for m in sub], [])
+        self.assertEqual(self.broker.topics["news"].subscribers, set())
+
+    async def test_concurrent_subscribes_to_one_topic_send_one_request(self):
+        results = await asyncio.gather(*(self.client.subscribe("once") for _ in range(3)), return_exceptions=True)
+        subs = [r for r in results if not isinstance(r, BaseException)]
+        self.assertEqual(len(subs), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results if r is not subs[0]))
+        self.assertEqual(len(self.broker.topics["once"].subscribers), 1)
+        # a refused subscribe gives the topic back
+        await self.broker.publish("locked", "a", password="pw", writer=FakeWriter())
+        with self.assertRaises(BrokerError):
+            await self.client.subscribe("locked", password="wrong")
+        await self.client.subscribe("locked", password="pw")
+
+    async def test_authenticate_covers_pool_and_reconnects(self):
+        await self.broker.publish("secret", "a", password="pw", writer=FakeWriter())
+        with self.assertRaises(BrokerError):
+            await self.client.authenticate("secret", "wrong")
+        await self.client.authenticate("secret", "pw")
+        self.assertEqual(len(self.broker._grants), 3)  # the publisher and both pooled connections
+        for _ in range(2):
+            await self.client.clear_topic("secret")
+        for writer in list(self.broker._grants):
+            writer.close()
+        await asyncio.sleep(0.3)
+        await self.client.clear_topic("secret")
+        await self.client.clear_topic("secret")
+
+    async def test_idempotent_publish_retried_after_lost_ack(self):
+        client = BrokerClient("127.0.0.1", self.port, pool_size=1, timeout=2, idempotent=True)
+        await client.connect()
+        send_response = self.broker.send_response
+        lost = []
+
+        async def drop_first_ack(response, writer):
+            if not lost and response.get("published"):
+                lost.append(response)
+                writer.close()  # stored, but the connection dies before the ack
+                return
+            await send_response(response, writer)
+
+        self.broker.send_response = drop_first_ack
+        await client.publish("once", "m")
+        await client.publish("once", "n")
+        await client.close()
+        self.assertEqual(len(lost), 1)
+        self.assertEqual(len(self.broker.topics["once"].queue), 2)
+        self.assertEqual(self.broker.metrics.counters["publishes_deduplicated"], 1)
+
 
 if __name__ == "__main__":
     unittest.main()